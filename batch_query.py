@@ -0,0 +1,152 @@
+import os
+import sys
+import json
+import time
+import argparse
+from multiprocessing import Pool
+from functools import partial
+
+import warnings
+warnings.filterwarnings("ignore")
+
+import numpy as np
+
+import metrics
+from fingerprint import fingerprint_file
+from storage import lookup_hashes, lookup_hash_df, get_info_for_song_id, get_spectrogram_params
+from matching import sort_rows, select_rows, join_matches
+from recognize import rank_matches
+from ingest import find_songs
+from peak_cache import PeakCache
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--db_path", type=str, default=None)
+    # directories are searched for audio files, anything else is taken as a file
+    parser.add_argument("--queries", type=str, nargs="+", default=[])
+    parser.add_argument("--num_workers", type=int, default=6)
+    # clips whose hashes share one database lookup
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--top_k", type=int, default=1)
+    # hashes found in more songs than this are stop words and are not looked up
+    parser.add_argument("--max_df", type=int, default=None)
+    parser.add_argument("--sample_rate", type=int, default=44100)
+    parser.add_argument("--fft_window_size", type=float, default=0.2)
+    parser.add_argument("--peak_box_size", type=int, default=30)
+    parser.add_argument("--point_efficiency", type=float, default=0.8)
+    parser.add_argument("--target_t", type=float, default=1.8)
+    parser.add_argument("--target_f", type=int, default=4000)
+    parser.add_argument("--target_start", type=float, default=0.05)
+    # default to the front end, hop and highest frequency the database was built with
+    parser.add_argument("--front_end", type=str, default=None)
+    parser.add_argument("--hop_length", type=int, default=None)
+    parser.add_argument("--max_freq", type=float, default=None)
+    parser.add_argument("--cache_dir", type=str, default=None)
+    parser.add_argument("--cache_max_mb", type=int, default=2048)
+
+    args = parser.parse_args()
+
+    return args
+
+
+def expand_queries(queries):
+    files = []
+    for query in queries:
+        if os.path.isdir(query):
+            files.extend(find_songs(query))
+        else:
+            files.append(query)
+    return files
+
+
+def fingerprint_clip(filename, **fingerprint_params):
+    try:
+        return filename, fingerprint_file(filename, **fingerprint_params), None
+    except Exception as e:
+        return filename, None, repr(e)
+
+
+def recognize_batch(clips, db_path, top_k=1, max_df=None):
+    """Recognize many fingerprinted clips with one deduplicated lookup, yield (filename, ranked, stats).
+
+    With max_df, stop-word hashes are dropped before the lookup and stats counts each
+    clip's dropped hashes and the rows they would have fetched, otherwise it is None.
+    """
+    keys = np.unique(np.concatenate([fingerprint.hashes for _, fingerprint in clips]))
+    if max_df is not None:
+        df_songs, df_rows = lookup_hash_df(keys, db_path=db_path)
+        stop = df_songs > max_df
+        rows = sort_rows(*lookup_hashes(keys[~stop], db_path=db_path))
+    else:
+        rows = sort_rows(*lookup_hashes(keys, db_path=db_path))
+    for filename, fingerprint in clips:
+        clip_keys = np.unique(fingerprint.hashes)
+        stats = None
+        if max_df is not None:
+            clip_stop = np.searchsorted(keys, clip_keys)
+            clip_stop = clip_stop[stop[clip_stop]]
+            stats = {"stop_hashes": len(clip_stop), "rows_skipped": int(df_rows[clip_stop].sum())}
+        clip_rows = select_rows(*rows, keys=clip_keys)
+        metrics.count("candidate_rows", len(clip_rows[0]))
+        yield filename, rank_matches(join_matches(fingerprint, *clip_rows), top_k=top_k), stats
+
+
+def describe_matches(ranked, db_path):
+    matches = []
+    for song_id, score, offset in ranked:
+        info = get_info_for_song_id(song_id=song_id, db_path=db_path)
+        artist, album, title = info if info is not None else (None, None, None)
+        matches.append({"song_id": song_id, "artist": artist, "album": album, "title": title,
+                        "score": score, "offset": offset})
+    return matches
+
+
+def result_line(filename, ranked, db_path, stats=None):
+    result = {"file": filename, "matches": describe_matches(ranked, db_path=db_path)}
+    if stats is not None:
+        result.update(stats)
+    return json.dumps(result, ensure_ascii=False)
+
+
+def batch_query(queries, db_path, num_workers, batch_size, top_k, out=sys.stdout, front_end=None, max_df=None,
+                hop_length=None, max_freq=None, **fingerprint_params):
+    files = expand_queries(queries)
+    spectrogram_params = get_spectrogram_params(db_path, front_end=front_end, hop_length=hop_length,
+                                                max_freq=max_freq)
+    start = time.perf_counter()
+    recognized = 0
+    fingerprint_a_clip = partial(fingerprint_clip, **spectrogram_params, **fingerprint_params)
+    with Pool(processes=num_workers) as p:
+        clips = []
+        for i, (filename, fingerprint, error) in enumerate(p.imap(fingerprint_a_clip, files)):
+            if error is not None:
+                out.write(json.dumps({"file": filename, "error": error}) + "\n")
+            else:
+                clips.append((filename, fingerprint))
+            if len(clips) >= batch_size or (i == len(files) - 1 and clips):
+                for filename, ranked, stats in recognize_batch(clips, db_path=db_path, top_k=top_k, max_df=max_df):
+                    out.write(result_line(filename, ranked, db_path=db_path, stats=stats) + "\n")
+                out.flush()
+                recognized += len(clips)
+                clips = []
+    elapsed = time.perf_counter() - start
+    print("Recognized {} clips in {:.2f} seconds, {:.1f} clips/s".format(
+        recognized, elapsed, recognized / max(elapsed, 1e-9)), file=sys.stderr)
+    return recognized, elapsed
+
+
+if __name__ == '__main__':
+    args = get_args()
+
+    assert 0. < args.fft_window_size < 1.
+    assert 0. < args.point_efficiency <= 1.
+
+    cache = None if args.cache_dir is None else PeakCache(args.cache_dir, max_bytes=args.cache_max_mb * 1024 ** 2)
+    batch_query(queries=args.queries, db_path=args.db_path, num_workers=args.num_workers,
+                batch_size=args.batch_size, top_k=args.top_k, max_df=args.max_df, sample_rate=args.sample_rate,
+                fft_window_size=args.fft_window_size, peak_box_size=args.peak_box_size,
+                point_efficiency=args.point_efficiency, target_t=args.target_t, target_f=args.target_f,
+                target_start=args.target_start, cache=cache, front_end=args.front_end, hop_length=args.hop_length,
+                max_freq=args.max_freq)
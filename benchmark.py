@@ -0,0 +1,511 @@
+import os
+import io
+import sys
+import json
+import argparse
+import subprocess
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import warnings
+warnings.filterwarnings("ignore")
+
+import numpy as np
+
+import metrics
+from fingerprint import (Fingerprint, target_zone, hash_point_pair, hash_points, quantize_time, find_peaks,
+                         fingerprint_file, song_uuid_for_file, TIME_RESOLUTION)
+from spectrogram import spectrogram_plan, compute_spectrogram
+from storage import (setup_db, store_song, insert_songs, begin_bulk_load, finish_bulk_load, get_matches, get_cursor,
+                     checkpoint_db, songs_db_path, db_size)
+from matching import score_matches
+from ingest import ingest_directory
+from synthetic_corpus import generate_corpus, make_song, write_wav, SONG_KINDS
+from hash_index import export_index
+from reshard_db import reshard_db
+
+
+def synthetic_peaks(num_points, sample_rate=44100, fft_window_size=0.2, peaks_per_second=20, seed=0):
+    # peaks sit on the spectrogram grid, like the output of find_peaks
+    rng = np.random.default_rng(seed)
+    nperseg = int(sample_rate * fft_window_size)
+    hop = nperseg - nperseg // 8
+    num_frames = max(int(num_points / peaks_per_second * sample_rate / hop), 1)
+    f = np.fft.rfftfreq(nperseg, 1.0 / sample_rate)
+    t = (np.arange(num_frames) * hop + nperseg / 2) / sample_rate
+    return np.column_stack((f[rng.integers(0, len(f), num_points)], t[rng.integers(0, len(t), num_points)]))
+
+
+def target_zone_hashes(points, target_t, target_f, target_start):
+    # the pairing loop hash_points used before it was vectorized
+    hashes = []
+    for anchor in points:
+        for target in target_zone(anchor=anchor, points=points, width=target_t, height=target_f, t=target_start):
+            hashes.append((hash_point_pair(p1=anchor, p2=target), int(quantize_time(anchor[1]))))
+    return hashes
+
+
+def bench_pairing(sizes, max_reference_points, target_t, target_f, target_start):
+    """Time hash_points against the target_zone loop, returns the sizes where their hashes differ."""
+    failures = []
+    for size in sizes:
+        points = synthetic_peaks(size)
+        start = time.perf_counter()
+        fingerprint = hash_points(points=points, filename="benchmark", target_t=target_t, target_f=target_f,
+                                  target_start=target_start)
+        vectorized = time.perf_counter() - start
+        line = "points: {:>6} pairs: {:>8} searchsorted: {:8.3f}s".format(size, len(fingerprint.hashes), vectorized)
+        if size <= max_reference_points:
+            start = time.perf_counter()
+            reference = target_zone_hashes(points=points, target_t=target_t, target_f=target_f,
+                                           target_start=target_start)
+            loop = time.perf_counter() - start
+            same = reference == list(zip(fingerprint.hashes.tolist(), fingerprint.offsets.tolist()))
+            line += " target_zone: {:8.3f}s speedup: {:7.1f}x identical: {}".format(loop, loop / vectorized, same)
+            if not same:
+                failures.append("pairing of {} points differs from target_zone".format(size))
+        print(line)
+    return failures
+
+
+def synthetic_fingerprint(num_hashes, rng, vocabulary=1 << 22, duration=30000, song_uuid="benchmark"):
+    # a limited hash vocabulary gives the repeated hashes real catalogues have
+    hashes = rng.integers(0, vocabulary, num_hashes).astype(np.uint32) * np.uint32(1024 - 1)
+    offsets = np.sort(rng.integers(0, duration, num_hashes))
+    return Fingerprint(hashes=hashes, offsets=offsets, song_uuid=song_uuid)
+
+
+def synthetic_songs(num_songs, hashes_per_song, seed=0):
+    rng = np.random.default_rng(seed)
+    return [(synthetic_fingerprint(hashes_per_song, rng, song_uuid=str(i)), ("artist", "album", "title {}".format(i)))
+            for i in range(num_songs)]
+
+
+def bulk_load(db_path, songs, songs_per_transaction=50):
+    setup_db(db_path=db_path, bulk=True)
+    with get_cursor(db_path=db_path) as (conn, c):
+        begin_bulk_load(c)
+        for i in range(0, len(songs), songs_per_transaction):
+            insert_songs(c, songs[i:i + songs_per_transaction])
+            conn.commit()
+        finish_bulk_load(c)
+
+
+def build_synthetic_db(db_path, num_songs, hashes_per_song, seed=0):
+    songs = synthetic_songs(num_songs=num_songs, hashes_per_song=hashes_per_song, seed=seed)
+    bulk_load(db_path=db_path, songs=songs)
+    return [fingerprint for fingerprint, _ in songs]
+
+
+def bench_ingest(num_songs, hashes_per_song):
+    songs = synthetic_songs(num_songs=num_songs, hashes_per_song=hashes_per_song)
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "per_song.sqlite")
+        start = time.perf_counter()
+        setup_db(db_path=db_path)
+        for fingerprint, song_info in songs:
+            store_song(fingerprint, song_info, db_path=db_path)
+        checkpoint_db(db_path=db_path)
+        per_song = time.perf_counter() - start
+
+        db_path = os.path.join(tmp, "bulk.sqlite")
+        start = time.perf_counter()
+        bulk_load(db_path=db_path, songs=songs)
+        bulk = time.perf_counter() - start
+    rows = num_songs * hashes_per_song
+    print("rows: {} store_song per song: {:.2f}s ({:.0f} rows/s) bulk import: {:.2f}s ({:.0f} rows/s) "
+          "speedup: {:.1f}x".format(rows, per_song, rows / per_song, bulk, rows / bulk, per_song / bulk))
+
+
+def in_literal_matches(hashes, db_path):
+    # get_matches as it was: one IN (...) literal per query on a fresh connection
+    h_dict = dict(zip(hashes.hashes.tolist(), hashes.offsets.tolist()))
+    in_values = "({})".format(",".join(map(str, hashes.hashes.tolist())))
+    with get_cursor(db_path=db_path) as (conn, c):
+        c.execute(f"SELECT hash, offset, song_id FROM hash WHERE hash IN {in_values}")
+        results = c.fetchall()
+    result_dict = defaultdict(list)
+    for r in results:
+        result_dict[r[2]].append((r[1], h_dict[r[0]]))
+    return result_dict
+
+
+def match_triples(matches):
+    # (song_id, db offset, query offset) of every match, in a canonical order
+    return sorted(zip(*(np.asarray(column).tolist() for column in matches)))
+
+
+def reference_matches(hashes, db_path):
+    # every row of every query hash, paired with every query offset of that hash
+    query_offsets = defaultdict(list)
+    for h, offset in zip(hashes.hashes.tolist(), hashes.offsets.tolist()):
+        query_offsets[h].append(offset)
+    in_values = "({})".format(",".join(map(str, query_offsets)))
+    with get_cursor(db_path=db_path) as (conn, c):
+        rows = c.execute(f"SELECT hash, offset, song_id FROM hash WHERE hash IN {in_values}").fetchall()
+    return sorted((song_id, offset, query_offset) for h, offset, song_id in rows for query_offset in query_offsets[h])
+
+
+def median_seconds(func, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings))
+
+
+def bench_lookup(query_lengths, num_songs, hashes_per_song, repeats, num_shards=4):
+    """Time the lookup paths, returns the ones whose matches differ from a plain SQL join."""
+    rng = np.random.default_rng(1)
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "benchmark.sqlite")
+        index_path = os.path.join(tmp, "benchmark.hidx")
+        songs = build_synthetic_db(db_path=db_path, num_songs=num_songs, hashes_per_song=hashes_per_song)
+        export_index(db_path=db_path, index_path=index_path)
+        shards_path = os.path.join(tmp, "benchmark.shards")
+        reshard_db(db_path=db_path, out_path=shards_path, num_shards=num_shards)
+        for length in query_lengths:
+            song = songs[rng.integers(0, len(songs))]
+            picked = rng.integers(0, len(song.hashes), length)
+            query = Fingerprint(hashes=song.hashes[picked], offsets=song.offsets[picked], song_uuid="query")
+            expected = reference_matches(query, db_path)
+            for name, path in [("chunked", db_path), ("mmap index", index_path), ("sharded", shards_path)]:
+                if match_triples(get_matches(query, path)) != expected:
+                    failures.append("{} lookup of {} hashes differs from the SQL join".format(name, length))
+            literal = median_seconds(lambda: in_literal_matches(query, db_path), repeats)
+            chunked = median_seconds(lambda: get_matches(query, db_path), repeats)
+            mapped = median_seconds(lambda: get_matches(query, index_path), repeats)
+            sharded = median_seconds(lambda: get_matches(query, shards_path), repeats)
+            print("query hashes: {:>6} IN literal: {:8.2f}ms chunked: {:8.2f}ms mmap index: {:8.2f}ms "
+                  "{} shards: {:8.2f}ms".format(length, literal * 1e3, chunked * 1e3, mapped * 1e3, num_shards,
+                                                sharded * 1e3))
+    return failures
+
+
+def bench_batch_query(db_path, queries, num_workers, max_single_clips):
+    # batch_query pulls in recognize and its recording dependencies, only load it for this benchmark
+    from batch_query import batch_query, expand_queries
+
+    files = expand_queries(queries)
+    recognized, elapsed = batch_query(queries=files, db_path=db_path, num_workers=num_workers, batch_size=256,
+                                      top_k=1, out=io.StringIO(), sample_rate=44100, fft_window_size=0.2,
+                                      peak_box_size=30, point_efficiency=0.8, target_t=1.8, target_f=4000,
+                                      target_start=0.05)
+    # the single-clip path is one query_song.py process per clip
+    single = files[:max_single_clips]
+    start = time.perf_counter()
+    for filename in single:
+        subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "query_song.py"),
+                        "--db_path", db_path, "--query_song", filename], stdout=subprocess.DEVNULL, check=True)
+    single_elapsed = time.perf_counter() - start
+    print("batch_query: {:.1f} clips/s query_song.py per clip: {:.2f} clips/s".format(
+        recognized / elapsed, len(single) / single_elapsed))
+
+
+def bench_spectrogram(seconds, max_freqs, hop_lengths, repeats, sample_rate=44100, fft_window_size=0.2,
+                      peak_box_size=30, point_efficiency=0.8):
+    from scipy.signal import spectrogram
+
+    audio = np.random.default_rng(0).integers(-20000, 20000, int(seconds * sample_rate)).astype(np.int16)
+    nperseg = int(sample_rate * fft_window_size)
+    _, _, Sxx = spectrogram(audio, sample_rate, nperseg=nperseg)
+    fft_time = median_seconds(lambda: spectrogram(audio, sample_rate, nperseg=nperseg), repeats)
+    peak_time = median_seconds(lambda: find_peaks(Sxx, peak_box_size, point_efficiency), repeats)
+    print("scipy float64: {:>5} bins spectrogram: {:8.2f}ms peaks: {:8.2f}ms".format(
+        Sxx.shape[0], fft_time * 1e3, peak_time * 1e3))
+    for hop_length in hop_lengths:
+        for max_freq in max_freqs:
+            plan = spectrogram_plan(sample_rate, fft_window_size, hop_length=hop_length or None,
+                                    max_freq=max_freq or None)
+            _, _, Sxx = compute_spectrogram(audio, plan=plan, sample_rate=sample_rate)
+            fft_time = median_seconds(lambda: compute_spectrogram(audio, plan=plan, sample_rate=sample_rate), repeats)
+            peak_time = median_seconds(lambda: find_peaks(Sxx, peak_box_size, point_efficiency), repeats)
+            print("plan float32 hop {:>5} max_freq {:>5}: {:>5} bins spectrogram: {:8.2f}ms peaks: {:8.2f}ms".format(
+                plan.hop_length, max_freq or "all", Sxx.shape[0], fft_time * 1e3, peak_time * 1e3))
+
+
+# fingerprint parameters of the suite, the defaults of the command line tools
+SUITE_PARAMS = dict(sample_rate=44100, fft_window_size=0.2, peak_box_size=30, point_efficiency=0.8, target_t=1.8,
+                    target_f=4000, target_start=0.05)
+
+
+def run_queries(manifest, db_path):
+    # (kind, correct, latency ns) of every query, end to end from the file to the best song
+    with get_cursor(db_path=songs_db_path(db_path)) as (conn, c):
+        song_ids = dict(c.execute("SELECT uuid, song_id FROM song_info").fetchall())
+    binwidth = int(round(0.5 / TIME_RESOLUTION))
+    results = []
+    for entry in manifest:
+        start = time.perf_counter_ns()
+        hashes = fingerprint_file(entry["query"], **SUITE_PARAMS)
+        song_ids_found, _, _ = score_matches(get_matches(hashes, db_path=db_path), binwidth=binwidth, top_k=1)
+        elapsed = time.perf_counter_ns() - start
+        expected = song_ids.get(song_uuid_for_file(entry["song"]))
+        results.append((entry["kind"], len(song_ids_found) > 0 and int(song_ids_found[0]) == expected, elapsed))
+    return results
+
+
+def latency_summary(latencies_ns):
+    latencies = np.asarray(latencies_ns) * 1e-6
+    return {"mean": float(latencies.mean()), "p50": float(np.percentile(latencies, 50)),
+            "p90": float(np.percentile(latencies, 90)), "p99": float(np.percentile(latencies, 99)),
+            "max": float(latencies.max())}
+
+
+def bench_suite(num_songs, song_seconds, queries_per_song, query_seconds, num_workers, seed=0, snr_db=5.0,
+                gain_db=-12.0, work_dir=None):
+    """Ingest a synthetic corpus and query it, returns the results: throughput, size, latency, accuracy, stages."""
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp:
+        start = time.perf_counter()
+        manifest = generate_corpus(out_dir=tmp, num_songs=num_songs, song_seconds=song_seconds,
+                                   queries_per_song=queries_per_song, query_seconds=query_seconds,
+                                   sample_rate=SUITE_PARAMS["sample_rate"], snr_db=snr_db, gain_db=gain_db, seed=seed)
+        print("Generated {} songs and {} queries in {:.1f}s".format(num_songs, len(manifest),
+                                                                    time.perf_counter() - start))
+        db_path = os.path.join(tmp, "suite.sqlite")
+        metrics.reset()
+        metrics.enable()
+        try:
+            setup_db(db_path=db_path)
+            start = time.perf_counter()
+            ingest_directory(path=os.path.join(tmp, "songs"), num_workers=num_workers, db_path=db_path,
+                             **SUITE_PARAMS)
+            ingest_seconds = time.perf_counter() - start
+            ingest_metrics = metrics.snapshot()
+            metrics.reset()
+            query_results = run_queries(manifest, db_path=db_path)
+            query_metrics = metrics.snapshot()
+        finally:
+            metrics.disable()
+            metrics.reset()
+        size = db_size(db_path)
+
+    hashes = ingest_metrics["counters"].get("hashes", {}).get("total", 0)
+    accuracy = {}
+    for kind in sorted({kind for kind, _, _ in query_results}):
+        correct = [ok for k, ok, _ in query_results if k == kind]
+        accuracy[kind] = sum(correct) / len(correct)
+    accuracy["all"] = sum(ok for _, ok, _ in query_results) / len(query_results)
+    return {"config": {"num_songs": num_songs, "song_seconds": song_seconds, "queries_per_song": queries_per_song,
+                       "query_seconds": query_seconds, "num_workers": num_workers, "seed": seed, "snr_db": snr_db,
+                       "gain_db": gain_db},
+            "ingest": {"seconds": ingest_seconds, "songs_per_second": num_songs / ingest_seconds, "hashes": hashes,
+                       "hashes_per_second": hashes / ingest_seconds, "db_bytes": size},
+            "query": {"count": len(query_results),
+                      "latency_ms": latency_summary([elapsed for _, _, elapsed in query_results]),
+                      "accuracy": accuracy},
+            "stages_ms": {"ingest": ingest_metrics["stages_ms"], "query": query_metrics["stages_ms"]}}
+
+
+def compare_results(results, baseline, tolerance, accuracy_tolerance):
+    """Regressions of results against a baseline: a stage p50 or query latency slower by more than tolerance,
+    or an accuracy lower by more than accuracy_tolerance."""
+    regressions = []
+    for phase, stages in baseline.get("stages_ms", {}).items():
+        for stage, before in stages.items():
+            after = results["stages_ms"].get(phase, {}).get(stage)
+            if after is None or before["p50"] is None or after["p50"] is None:
+                continue
+            if after["p50"] > before["p50"] * (1 + tolerance):
+                regressions.append("{} {} p50 {:.2f}ms -> {:.2f}ms".format(phase, stage, before["p50"], after["p50"]))
+    for name in ("p50", "p90"):
+        before = baseline["query"]["latency_ms"][name]
+        after = results["query"]["latency_ms"][name]
+        if after > before * (1 + tolerance):
+            regressions.append("query latency {} {:.2f}ms -> {:.2f}ms".format(name, before, after))
+    for kind, before in baseline["query"]["accuracy"].items():
+        after = results["query"]["accuracy"].get(kind)
+        if after is not None and after < before - accuracy_tolerance:
+            regressions.append("accuracy {} {:.3f} -> {:.3f}".format(kind, before, after))
+    return regressions
+
+
+def print_suite(results):
+    ingest = results["ingest"]
+    print("ingest: {:.2f} songs/s {:.0f} hashes/s database: {:.1f} MB".format(
+        ingest["songs_per_second"], ingest["hashes_per_second"], ingest["db_bytes"] / 1e6))
+    latency = results["query"]["latency_ms"]
+    print("query latency p50: {:.1f}ms p90: {:.1f}ms p99: {:.1f}ms".format(latency["p50"], latency["p90"],
+                                                                           latency["p99"]))
+    print("accuracy: " + " ".join("{}: {:.3f}".format(k, v) for k, v in results["query"]["accuracy"].items()))
+    for phase, stages in results["stages_ms"].items():
+        for stage, summary in stages.items():
+            print("{:>6} {:<12} calls: {:>6} p50: {:8.2f}ms p99: {:8.2f}ms total: {:9.1f}ms".format(
+                phase, stage, summary["count"], summary["p50"], summary["p99"], summary["total"]))
+
+
+# import time budget of every entry point, and modules it must not load: they are only
+# needed on paths the entry point takes at run time, if at all
+STARTUP_BUDGETS_MS = {"query_song": 300, "batch_query": 350, "server": 350, "now_playing": 300,
+                      "register_songs_to_database": 350}
+QUERY_EXCLUDED = ["scipy.signal", "scipy.sparse", "pyaudio", "tinytag"]
+STARTUP_EXCLUDED = {"query_song": QUERY_EXCLUDED + ["record", "ingest"], "batch_query": QUERY_EXCLUDED + ["record"],
+                    "server": QUERY_EXCLUDED + ["record"], "now_playing": QUERY_EXCLUDED + ["ingest"],
+                    "register_songs_to_database": ["scipy.signal", "scipy.sparse", "pyaudio", "record"]}
+
+
+def import_time(module):
+    # (cumulative import time in ms, modules loaded) of importing module in a fresh interpreter
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import {}".format(module)],
+                         cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.PIPE, text=True, check=True)
+    loaded = set()
+    total = None
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        loaded.add(name.strip())
+        if name.strip() == module:
+            total = int(cumulative) / 1000
+    return total, loaded
+
+
+def bench_startup(modules, repeats):
+    """Check the import time and import graph of entry points, returns the failures."""
+    failures = []
+    for module in modules:
+        timings = []
+        for _ in range(repeats):
+            total, loaded = import_time(module)
+            timings.append(total)
+        median = float(np.median(timings))
+        excluded = sorted(name for name in STARTUP_EXCLUDED.get(module, []) if name in loaded)
+        print("{:<28} import: {:7.1f}ms budget: {:5}ms modules: {:4} excluded but loaded: {}".format(
+            module, median, STARTUP_BUDGETS_MS[module], len(loaded), ", ".join(excluded) or "none"))
+        if median > STARTUP_BUDGETS_MS[module]:
+            failures.append("{} imports in {:.1f}ms, over its {}ms budget".format(module, median,
+                                                                                STARTUP_BUDGETS_MS[module]))
+        if excluded:
+            failures.append("{} loads {}".format(module, ", ".join(excluded)))
+    return failures
+
+
+def bench_segments(seconds, worker_counts, segment_seconds, repeats, seed=0):
+    """Time fingerprint_file on one long synthetic file, serially and split into segments over 1..N processes.
+
+    Returns the worker counts whose hashes or offsets differ from the serial path.
+    """
+    rng = np.random.default_rng(seed)
+    sample_rate = SUITE_PARAMS["sample_rate"]
+    # alternate kinds every minute, a long file that isn't one repeated texture
+    song = np.concatenate([make_song(SONG_KINDS[i % len(SONG_KINDS)], rng, min(60.0, seconds - start), sample_rate)
+                           for i, start in enumerate(np.arange(0.0, seconds, 60.0))])
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "long.wav")
+        write_wav(path, song, sample_rate)
+        serial = fingerprint_file(path, **SUITE_PARAMS)
+        serial_time = median_seconds(lambda: fingerprint_file(path, **SUITE_PARAMS), repeats)
+        failures = []
+        print("{:.0f}s of audio, {} hashes, serial: {:8.2f}ms".format(seconds, len(serial.hashes), serial_time * 1e3))
+        for num_workers in worker_counts:
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                def run():
+                    return fingerprint_file(path, executor=executor, segment_seconds=segment_seconds, **SUITE_PARAMS)
+                fp = run()
+                elapsed = median_seconds(run, repeats)
+            identical = np.array_equal(fp.hashes, serial.hashes) and np.array_equal(fp.offsets, serial.offsets)
+            print("{:>3} workers, {:.0f}s segments: {:8.2f}ms speedup: {:5.2f}x identical: {}".format(
+                num_workers, segment_seconds, elapsed * 1e3, serial_time / elapsed, identical))
+            if not identical:
+                failures.append("segments: {} workers differ from the serial fingerprint".format(num_workers))
+    return failures
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--bench", type=str, default="pairing",
+                        choices=["pairing", "lookup", "ingest", "batch_query", "spectrogram", "suite", "startup",
+                                 "segments"])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 2000, 5000, 10000, 20000, 50000])
+    # the target_zone loop is quadratic, skip it above this size
+    parser.add_argument("--max_reference_points", type=int, default=10000)
+    parser.add_argument("--query_lengths", type=int, nargs="+", default=[100, 1000, 5000, 20000])
+    parser.add_argument("--num_songs", type=int, default=100)
+    parser.add_argument("--hashes_per_song", type=int, default=10000)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--num_shards", type=int, default=4)
+    parser.add_argument("--db_path", type=str, default=None)
+    parser.add_argument("--queries", type=str, nargs="+", default=[])
+    parser.add_argument("--num_workers", type=int, default=6)
+    parser.add_argument("--max_single_clips", type=int, default=10)
+    parser.add_argument("--seconds", type=float, default=240.0)
+    # 0 keeps every bin, or the default hop
+    parser.add_argument("--max_freqs", type=int, nargs="+", default=[0, 8000, 5000])
+    parser.add_argument("--hop_lengths", type=int, nargs="+", default=[0])
+    # the suite: a synthetic corpus ingested and queried end to end
+    parser.add_argument("--song_seconds", type=float, default=30.0)
+    parser.add_argument("--queries_per_song", type=int, default=1)
+    parser.add_argument("--query_seconds", type=float, default=8.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work_dir", type=str, default=None)
+    # JSON results of the suite
+    parser.add_argument("--results", type=str, default="bench_results.json")
+    # results of an earlier run, exits with 1 when a stage got slower or accuracy dropped
+    parser.add_argument("--baseline", type=str, default=None)
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--accuracy_tolerance", type=float, default=0.02)
+    # entry points of the startup check
+    parser.add_argument("--modules", type=str, nargs="+", default=list(STARTUP_BUDGETS_MS))
+    # fingerprinting one long file in segments, --seconds long
+    parser.add_argument("--worker_counts", type=int, nargs="+", default=None)
+    parser.add_argument("--segment_seconds", type=float, default=60.0)
+    parser.add_argument("--target_t", type=float, default=1.8)
+    parser.add_argument("--target_f", type=int, default=4000)
+    parser.add_argument("--target_start", type=float, default=0.05)
+
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == '__main__':
+    args = get_args()
+
+    failures = []
+    if args.bench == "pairing":
+        failures = bench_pairing(sizes=args.sizes, max_reference_points=args.max_reference_points,
+                                 target_t=args.target_t, target_f=args.target_f, target_start=args.target_start)
+    elif args.bench == "lookup":
+        failures = bench_lookup(query_lengths=args.query_lengths, num_songs=args.num_songs,
+                                hashes_per_song=args.hashes_per_song, repeats=args.repeats, num_shards=args.num_shards)
+    elif args.bench == "ingest":
+        bench_ingest(num_songs=args.num_songs, hashes_per_song=args.hashes_per_song)
+    elif args.bench == "batch_query":
+        bench_batch_query(db_path=args.db_path, queries=args.queries, num_workers=args.num_workers,
+                          max_single_clips=args.max_single_clips)
+    elif args.bench == "spectrogram":
+        bench_spectrogram(seconds=args.seconds, max_freqs=args.max_freqs, hop_lengths=args.hop_lengths,
+                          repeats=args.repeats)
+    elif args.bench == "suite":
+        results = bench_suite(num_songs=args.num_songs, song_seconds=args.song_seconds,
+                              queries_per_song=args.queries_per_song, query_seconds=args.query_seconds,
+                              num_workers=args.num_workers, seed=args.seed, work_dir=args.work_dir)
+        print_suite(results)
+        with open(args.results, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        if args.baseline is not None:
+            with open(args.baseline, encoding="utf-8") as f:
+                baseline = json.load(f)
+            regressions = compare_results(results, baseline, tolerance=args.tolerance,
+                                          accuracy_tolerance=args.accuracy_tolerance)
+            for regression in regressions:
+                print("Regression: {}".format(regression))
+            if regressions:
+                sys.exit(1)
+    elif args.bench == "startup":
+        failures = bench_startup(modules=args.modules, repeats=args.repeats)
+    elif args.bench == "segments":
+        worker_counts = args.worker_counts or list(range(1, (os.cpu_count() or 1) + 1))
+        failures = bench_segments(seconds=args.seconds, worker_counts=worker_counts,
+                                  segment_seconds=args.segment_seconds, repeats=args.repeats)
+    for failure in failures:
+        print("Failed: {}".format(failure))
+    if failures:
+        sys.exit(1)
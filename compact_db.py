@@ -0,0 +1,178 @@
+import os
+import time
+import sqlite3
+import argparse
+
+import numpy as np
+
+from fingerprint import TIME_RESOLUTION
+from storage import (songs_db_path, hash_db_paths, create_hash_index, has_covering_index, build_hash_df, lookup_rows,
+                     db_size, get_cursor)
+from shards import is_sharded_path, shard_of
+from hash_index import is_index_path
+
+# Rewrites the hash table of a database, or of every shard, without orphan rows (songs no
+# longer in song_info) and exact duplicates, optionally thinned to a number of hashes per
+# second of each song. Rows are written in hash order, so the rows of a lookup sit on few
+# pages. All the work is SQLite sorts that spill to temporary files, memory stays bounded
+# by the page cache, the disk needs room for a second copy of the hash table.
+COMPACT_PRAGMAS = [
+    # 256 MB page cache, sorts larger than it go to temporary files
+    "PRAGMA cache_size=-262144",
+    "PRAGMA temp_store=FILE",
+]
+# thinning keeps a hash when its mixed value is below the song's threshold, the same hash
+# values survive in every shard and every run
+HASH_MIX = 0x45d9f3b
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    # a single SQLite file or a .shards directory
+    parser.add_argument("--db_path", type=str, default="music.sqlite")
+    # keep at most this many hashes per second of each song, by default every hash is kept
+    parser.add_argument("--max_density", type=float, default=None)
+    # index (hash, song_id, offset) so lookups never read the table, about doubles the hash table size
+    parser.add_argument("--covering", action="store_true")
+    parser.add_argument("--no_vacuum", action="store_true")
+    # lookups timed before and after, of this many hashes sampled from the database
+    parser.add_argument("--num_keys", type=int, default=1000)
+    parser.add_argument("--repeats", type=int, default=5)
+
+    args = parser.parse_args()
+
+    return args
+
+
+def sample_keys(db_path, num_keys, seed=0):
+    # hashes of random rows, rowids of a table that was appended to are nearly dense
+    rng = np.random.default_rng(seed)
+    paths = hash_db_paths(db_path)
+    keys = []
+    for path in paths:
+        with get_cursor(db_path=path) as (conn, c):
+            max_rowid = c.execute("SELECT max(rowid) FROM hash").fetchone()[0] or 0
+            rowids = rng.integers(1, max_rowid + 1, num_keys // len(paths) + 1).tolist() if max_rowid else []
+            keys.extend(row[0] for row in c.execute("SELECT hash FROM hash WHERE rowid IN ({})".format(
+                ",".join(map(str, rowids)))))
+    return np.unique(np.array(keys, dtype=np.int64))
+
+
+def lookup_ms(db_path, keys, repeats):
+    """Median milliseconds to fetch the rows of keys, shard after shard, on fresh connections."""
+    paths = hash_db_paths(db_path)
+    shard = shard_of(keys, len(paths))
+    timings = []
+    for _ in range(repeats):
+        elapsed = 0.0
+        for i, path in enumerate(paths):
+            conn = sqlite3.connect(database=path, timeout=30)
+            start = time.perf_counter()
+            lookup_rows(conn, keys[shard == i] if len(paths) > 1 else keys)
+            elapsed += time.perf_counter() - start
+            conn.close()
+        timings.append(elapsed)
+    return float(np.median(timings)) * 1e3
+
+
+def song_thresholds(db_path, max_density):
+    """Map every song_id that has more than max_density hashes per second to its keep threshold."""
+    with get_cursor(db_path=songs_db_path(db_path)) as (conn, c):
+        known = {row[0] for row in c.execute("SELECT song_id FROM song_info")}
+    counts = {}
+    for path in hash_db_paths(db_path):
+        with get_cursor(db_path=path) as (conn, c):
+            for song_id, count, first, last in c.execute(
+                    "SELECT song_id, count(*), min(offset), max(offset) FROM hash GROUP BY song_id"):
+                total, low, high = counts.get(song_id, (0, first, last))
+                counts[song_id] = (total + count, min(low, first), max(high, last))
+    thresholds = {}
+    for song_id, (count, first, last) in counts.items():
+        if song_id not in known:
+            continue
+        keep = max_density * max(last - first, 1) * TIME_RESOLUTION / count
+        if keep < 1:
+            thresholds[song_id] = int(keep * 2 ** 32)
+    return thresholds
+
+
+def compact_hash_table(path, catalog, thresholds=None, covering=False):
+    """Rewrite one hash table in hash order without orphans and duplicates, returns the rows (before, after)."""
+    conn = sqlite3.connect(database=path, timeout=30)
+    c = conn.cursor()
+    for pragma in COMPACT_PRAGMAS:
+        c.execute(pragma)
+    covering = covering or has_covering_index(c)
+    songs = "song_info"
+    if path != catalog:
+        c.execute("ATTACH DATABASE ? AS catalog", (catalog,))
+        songs = "catalog.song_info"
+    before = c.execute("SELECT count(*) FROM hash").fetchone()[0]
+    c.execute("DROP TABLE IF EXISTS temp.thin")
+    c.execute("CREATE TEMP TABLE thin (song_id integer PRIMARY KEY, keep_below integer)")
+    c.executemany("INSERT INTO thin VALUES (?, ?)", (thresholds or {}).items())
+    c.execute("DROP TABLE IF EXISTS hash_compact")
+    c.execute("CREATE TABLE hash_compact (hash integer, offset integer, song_id integer)")
+    # the mixed hash stays below 2 ** 59, SQLite integers don't overflow to floats
+    c.execute("INSERT INTO hash_compact SELECT DISTINCT hash, offset, song_id FROM hash "
+              "WHERE song_id IN (SELECT song_id FROM {}) "
+              "AND (hash * ? & 4294967295) < coalesce((SELECT keep_below FROM thin WHERE thin.song_id = hash.song_id), "
+              "4294967296) ORDER BY hash, song_id, offset".format(songs), (HASH_MIX,))
+    # the old table and its index go in the same transaction, an interrupted compaction changes nothing
+    c.execute("DROP TABLE hash")
+    c.execute("ALTER TABLE hash_compact RENAME TO hash")
+    create_hash_index(c, covering=covering)
+    conn.commit()
+    after = c.execute("SELECT count(*) FROM hash").fetchone()[0]
+    conn.close()
+    return before, after
+
+
+def finish_file(path, vacuum=True):
+    # statistics for the planner, the space of the old table back, an empty WAL
+    conn = sqlite3.connect(database=path, timeout=30)
+    conn.execute("ANALYZE")
+    conn.commit()
+    if vacuum:
+        conn.execute("VACUUM")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+
+
+def compact_db(db_path, max_density=None, covering=False, vacuum=True, num_keys=1000, repeats=5):
+    if is_index_path(db_path):
+        raise ValueError("{} is a read-only index, compact its database and export it again".format(db_path))
+    catalog = songs_db_path(db_path)
+    keys = sample_keys(db_path, num_keys=num_keys)
+    size_before = db_size(db_path)
+    latency_before = lookup_ms(db_path, keys, repeats=repeats)
+
+    start = time.perf_counter()
+    thresholds = song_thresholds(db_path, max_density) if max_density is not None else {}
+    rows_before = rows_after = 0
+    for path in hash_db_paths(db_path):
+        before, after = compact_hash_table(path, catalog=catalog, thresholds=thresholds, covering=covering)
+        rows_before += before
+        rows_after += after
+    # document frequencies of the rows that are left
+    build_hash_df(db_path)
+    for path in set([catalog] + hash_db_paths(db_path)):
+        finish_file(path, vacuum=vacuum)
+    elapsed = time.perf_counter() - start
+
+    print("Hash rows: {} -> {}, {} songs thinned, in {:.1f} seconds".format(rows_before, rows_after, len(thresholds),
+                                                                             elapsed))
+    print("Database size: {:.1f} MB -> {:.1f} MB".format(size_before / 2 ** 20, db_size(db_path) / 2 ** 20))
+    print("Lookup of {} hashes: {:.2f}ms -> {:.2f}ms".format(len(keys), latency_before,
+                                                              lookup_ms(db_path, keys, repeats=repeats)))
+
+
+if __name__ == '__main__':
+    args = get_args()
+
+    assert os.path.exists(args.db_path) or is_sharded_path(args.db_path)
+    assert args.max_density is None or args.max_density > 0
+
+    compact_db(db_path=args.db_path, max_density=args.max_density, covering=args.covering,
+               vacuum=not args.no_vacuum, num_keys=args.num_keys, repeats=args.repeats)
@@ -32,7 +32,8 @@ cursor = conn.cursor()
 #                       target_f=4000, target_start=0.05, threshold=5)
 audio, sr = read_audio_file(audio_path=r"D:\1NamNguyenTheMinh.mp3", sr_desired=44100)
 print(np.min(audio), np.max(audio))
-audio += 0.15 * np.random.randn(audio.shape[0])
+# read_audio_file returns 16-bit samples, the noise is 15% of full scale
+audio = audio + 0.15 * 32768 * np.random.randn(audio.shape[0])
 start = time.time()
 hashes = fingerprint_audio(audio, sample_rate=44100,
                          fft_window_size=0.2, peak_box_size=30, point_efficiency=0.8, target_t=1.8,
@@ -44,7 +45,7 @@ end = time.time()
 print(song, end - start)
 
 cursor = conn.cursor()
-cursor.execute("SELECT * FROM hash WHERE song_id = ?", (str(uuid.uuid5(uuid.NAMESPACE_OID, os.path.basename(r"D:\Music\Han\Advice.mp3")).int),))
+cursor.execute("SELECT hash.* FROM hash JOIN song_info USING (song_id) WHERE uuid = ?", (str(uuid.uuid5(uuid.NAMESPACE_OID, os.path.basename(r"D:\Music\Han\Advice.mp3")).int),))
 song_hashes = cursor.fetchall()
 song_hashes.sort(key=lambda x: x[1])
 cursor.close()
@@ -52,8 +53,7 @@ print(len(song_hashes))
 
 hashes = fingerprint_file(filename=r"D:\Music\Han\Advice.mp3", sample_rate=44100, fft_window_size=0.2, peak_box_size=30,
                             point_efficiency=0.8, target_t=1.8, target_f=4000, target_start=0.05)
-hashes.sort(key=lambda x: x[1])
-print(len(hashes))
+print(len(hashes.hashes))
 #hashes_1 = fingerprint_file(filename=r"D:\Music\Han\Advice.mp3", sample_rate=44100, fft_window_size=0.2, peak_box_size=20,
 #                            point_efficiency=0.8, target_t=1.8, target_f=4000, target_start=0.05)
 #hashes_2 = fingerprint_file(filename=r"D:\Advice.mp3", sample_rate=44100, fft_window_size=0.2, peak_box_size=20,
@@ -0,0 +1,269 @@
+import io
+import wave
+import subprocess
+from math import gcd
+
+import numpy as np
+
+import metrics
+
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+
+class DecodeError(RuntimeError):
+    """The audio could not be decoded, a problem with the input rather than the decoder."""
+
+
+# Every path decodes to mono 16-bit samples at the target rate, downmixed and resampled
+# here, once, by the same polyphase filter, so a file fingerprints the same whether it
+# is registered, queried, streamed or sent to the server.
+
+
+def resample_filter(up, down):
+    # the low-pass filter resample_poly designs by default, scipy.signal is slow to import
+    # and only needed when a file isn't at the target rate
+    from scipy.signal import firwin
+
+    max_rate = max(up, down)
+    return firwin(20 * max_rate + 1, 1. / max_rate, window=("kaiser", 5.0))
+
+
+def to_int16(samples):
+    return np.clip(np.rint(samples), -32768, 32767).astype(np.int16)
+
+
+def convert_audio(samples, rate, sample_rate):
+    """Downmix (frames, channels) samples to mono and resample to sample_rate, only if needed."""
+    samples = np.asarray(samples)
+    if samples.ndim == 1:
+        samples = samples[:, None]
+    if samples.shape[1] == 1 and rate == sample_rate:
+        # no copy for mono input at the target rate
+        return samples.reshape(-1).astype(np.int16, copy=False)
+    mono = samples.mean(axis=1) if samples.shape[1] > 1 else samples[:, 0].astype(np.float64)
+    if rate == sample_rate:
+        return to_int16(mono)
+    from scipy.signal import resample_poly
+
+    g = gcd(sample_rate, rate)
+    up, down = sample_rate // g, rate // g
+    return to_int16(resample_poly(mono, up, down, window=resample_filter(up, down)))
+
+
+def iter_resampled(blocks, rate, sample_rate):
+    """Resample streamed mono blocks exactly as convert_audio resamples the whole signal."""
+    from scipy.signal import upfirdn
+
+    g = gcd(sample_rate, rate)
+    up, down = sample_rate // g, rate // g
+    h = resample_filter(up, down) * up
+    half_len = (len(h) - 1) // 2
+    n_pre_pad = down - half_len % down
+    h = np.concatenate((np.zeros(n_pre_pad), h))
+    # outputs before first_out are the filter's delay, resample_poly drops them too
+    first_out = (half_len + n_pre_pad) // down
+    buffer = np.empty(0)
+    start = 0
+    next_out = first_out
+    total = 0
+    for block in blocks:
+        buffer = np.concatenate((buffer, np.asarray(block, dtype=np.float64)))
+        total += len(block)
+        # outputs before end only depend on samples seen so far
+        end = -(-total * up // down)
+        if end > next_out:
+            y = upfirdn(h, buffer, up, down)
+            base = start * up // down
+            yield to_int16(y[next_out - base:end - base])
+            next_out = end
+        # keep the samples later outputs still need, from a multiple of down
+        keep_from = max(start, (next_out * down - len(h) + 1) // up // down * down)
+        buffer = buffer[keep_from - start:]
+        start = keep_from
+    end = first_out + -(-total * up // down)
+    if total and end > next_out:
+        padded = np.concatenate((buffer, np.zeros(len(h) // up + 1)))
+        y = upfirdn(h, padded, up, down)
+        base = start * up // down
+        yield to_int16(y[next_out - base:end - base])
+
+
+def convert_blocks(blocks, rate, sample_rate):
+    # blocks are (frames, channels)
+    mono = (block.mean(axis=1) if block.shape[1] > 1 else block[:, 0] for block in blocks)
+    if rate == sample_rate:
+        return (block if block.dtype == np.int16 else to_int16(block) for block in mono)
+    return iter_resampled(mono, rate, sample_rate)
+
+
+def ffmpeg_command(source):
+    # only decoding, to 16-bit WAV at the file's own rate and channels on stdout, the
+    # downmix and the resampling are the same as for every other decoder
+    return ["ffmpeg", "-nostdin", "-v", "error", "-i", source, "-f", "wav", "-acodec", "pcm_s16le", "-"]
+
+
+def read_wav_header(f):
+    """Read a 16-bit WAV header from a stream, returns (rate, channels) with f at the first sample.
+
+    The size of the data is ignored, ffmpeg writing to a pipe can't fill it in.
+    """
+    header = f.read(12)
+    if len(header) < 12 or header[:4] != b"RIFF" or header[8:] != b"WAVE":
+        raise DecodeError("not a WAV stream")
+    rate = channels = None
+    while True:
+        chunk = f.read(8)
+        if len(chunk) < 8:
+            raise DecodeError("WAV stream without samples")
+        chunk_id, size = chunk[:4], int.from_bytes(chunk[4:], "little")
+        if chunk_id == b"data":
+            if rate is None:
+                raise DecodeError("WAV stream without a format")
+            return rate, channels
+        body = f.read(size + size % 2)
+        if chunk_id == b"fmt ":
+            channels = int.from_bytes(body[2:4], "little")
+            rate = int.from_bytes(body[4:8], "little")
+
+
+def frames_of(data, channels):
+    # whole frames of interleaved 16-bit samples, as (frames, channels)
+    frame_bytes = 2 * channels
+    return np.frombuffer(data[:len(data) // frame_bytes * frame_bytes], np.int16).reshape(-1, channels)
+
+
+def decode_ffmpeg(source, sample_rate, data=None):
+    # ffmpeg decodes through a pipe, no temporary file
+    try:
+        p = subprocess.run(ffmpeg_command(source), input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        # ffmpeg isn't installed or can't be started
+        raise DecodeError("can't run ffmpeg to decode {}: {}".format(source, e)) from e
+    if p.returncode != 0:
+        raise DecodeError("ffmpeg failed to decode {}: {}".format(source, p.stderr.decode(errors="replace")))
+    f = io.BytesIO(p.stdout)
+    rate, channels = read_wav_header(f)
+    return convert_audio(frames_of(f.read(), channels), rate, sample_rate)
+
+
+def read_wav(f):
+    with wave.open(f, "rb") as wf:
+        if wf.getsampwidth() != 2:
+            raise wave.Error("only 16-bit WAV is supported without soundfile")
+        samples = np.frombuffer(wf.readframes(wf.getnframes()), np.int16)
+        return samples.reshape(-1, wf.getnchannels()), wf.getframerate()
+
+
+@metrics.timed("decode")
+def load_audio(source, sample_rate):
+    """Decode a file, or a file-like object, to mono 16-bit samples at sample_rate.
+
+    soundfile reads WAV, FLAC, OGG and MP3 straight into NumPy arrays, anything else
+    is piped through ffmpeg.
+    """
+    data = source.read() if hasattr(source, "read") else None
+    try:
+        if soundfile is not None:
+            samples, rate = soundfile.read(source if data is None else io.BytesIO(data), dtype="int16",
+                                           always_2d=True)
+        else:
+            samples, rate = read_wav(source if data is None else io.BytesIO(data))
+        return convert_audio(samples, rate, sample_rate)
+    except (RuntimeError, wave.Error, EOFError):
+        # soundfile.LibsndfileError is a RuntimeError
+        pass
+    if data is None:
+        return decode_ffmpeg(source, sample_rate)
+    return decode_ffmpeg("pipe:0", sample_rate, data=data)
+
+
+def decode_bytes(data, sample_rate):
+    """Decode an encoded clip held in memory to mono 16-bit samples."""
+    return load_audio(io.BytesIO(data), sample_rate=sample_rate)
+
+
+def iter_wav_blocks(f, block_size):
+    # yields the sample rate first, then (frames, channels) blocks
+    with wave.open(f, "rb") as wf:
+        if wf.getsampwidth() != 2:
+            raise wave.Error("only 16-bit WAV is supported without soundfile")
+        channels = wf.getnchannels()
+        yield wf.getframerate()
+        while True:
+            data = wf.readframes(block_size)
+            if not data:
+                break
+            yield np.frombuffer(data, np.int16).reshape(-1, channels)
+
+
+def iter_raw_blocks(f, channels, block_size):
+    while True:
+        data = f.read(block_size * 2 * channels)
+        if not data:
+            break
+        yield frames_of(data, channels)
+
+
+def iter_ffmpeg_blocks(filename, sample_rate, block_size):
+    try:
+        p = subprocess.Popen(ffmpeg_command(filename), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        raise DecodeError("can't run ffmpeg to decode {}: {}".format(filename, e)) from e
+    with p:
+        try:
+            try:
+                rate, channels = read_wav_header(p.stdout)
+            except DecodeError:
+                # ffmpeg failed before writing a header, its own error is raised below
+                rate = None
+            if rate is not None:
+                yield from convert_blocks(iter_raw_blocks(p.stdout, channels, block_size), rate, sample_rate)
+        except BaseException:
+            # a timeout or an abandoned generator, don't wait for a hung ffmpeg on exit
+            p.kill()
+            raise
+        error = p.stderr.read()
+        if p.wait() != 0:
+            raise DecodeError("ffmpeg failed to decode {}: {}".format(filename, error.decode(errors="replace")))
+        if rate is None:
+            raise DecodeError("ffmpeg gave no WAV stream for {}".format(filename))
+
+
+def open_blocks(filename, block_size):
+    # (rate, (frames, channels) blocks), or None when only ffmpeg can decode the file
+    try:
+        if soundfile is not None:
+            rate = soundfile.info(filename).samplerate
+            return rate, soundfile.blocks(filename, blocksize=block_size, dtype="int16", always_2d=True)
+        blocks = iter_wav_blocks(filename, block_size)
+        return next(blocks), blocks
+    except (RuntimeError, wave.Error, EOFError):
+        return None
+
+
+def iter_audio_blocks(filename, sample_rate, block_size):
+    """Yield the mono 16-bit samples of a file block by block, the same samples load_audio returns."""
+    opened = open_blocks(filename, block_size)
+    if opened is None:
+        return iter_ffmpeg_blocks(filename, sample_rate, block_size)
+    rate, blocks = opened
+    return convert_blocks(blocks, rate, sample_rate)
+
+
+def iter_pcm_stream_blocks(f, block_size):
+    """Yield raw 16-bit mono samples read from a binary stream such as stdin."""
+    while True:
+        data = f.read(block_size * 2)
+        if not data:
+            break
+        yield np.frombuffer(data[:len(data) // 2 * 2], np.int16)
+
+
+def iter_wav_stream_blocks(f, sample_rate, block_size):
+    """Yield mono 16-bit samples of a WAV read from a binary stream, no seeking needed."""
+    blocks = iter_wav_blocks(f, block_size)
+    rate = next(blocks)
+    return convert_blocks(blocks, rate, sample_rate)
@@ -0,0 +1,29 @@
+import argparse
+import time
+
+from hash_index import INDEX_SUFFIX, export_index
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--db_path", type=str, default="music.sqlite")
+    parser.add_argument("--index_path", type=str, default=None)
+
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == '__main__':
+    args = get_args()
+
+    index_path = args.index_path
+    if index_path is None:
+        index_path = args.db_path.rsplit(".", 1)[0] + INDEX_SUFFIX
+    # query_song.py and recognize_song pick the memory-mapped backend from the suffix
+    assert index_path.endswith(INDEX_SUFFIX)
+
+    start = time.perf_counter()
+    count = export_index(db_path=args.db_path, index_path=index_path)
+    print("Exported {} hashes to {} in {:.1f} seconds".format(count, index_path, time.perf_counter() - start))
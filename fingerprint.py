@@ -1,28 +1,39 @@
 import os.path
 import uuid
+import itertools
+from functools import partial
+from collections import namedtuple
 import numpy as np
-from pydub import AudioSegment
-from scipy.signal import spectrogram
 from scipy.ndimage import maximum_filter
 
-import librosa
+import metrics
+from decode import iter_audio_blocks, load_audio
+from spectrogram import spectrogram_plan, compute_spectrogram, DEFAULT_FRONT_END
 
-from utils import timethis, profile
+# hashes and offsets are parallel arrays, song_uuid identifies the file they came from
+Fingerprint = namedtuple("Fingerprint", ["hashes", "offsets", "song_uuid"])
 
+# a hash packs (anchor freq, target freq, time delta) into 32 bits: | f1: 11 | f2: 11 | dt: 10 |
+FREQ_BITS = 11
+DELTA_BITS = 10
+# 12 Hz frequency bins cover audio up to 48 kHz within FREQ_BITS
+FREQ_RESOLUTION = 12.0
+# offsets and time deltas are stored as integer ticks of 10 ms
+TIME_RESOLUTION = 0.01
+# with an executor, a file's spectrogram is split into segments of this length, each
+# computed and searched for local maxima by one worker
+SEGMENT_SECONDS = 300
 
-def read_audio_file(audio_path: str, sr_desired=44100):
-    y, sr = librosa.load(audio_path, sr=None)
-
-    if sr != sr_desired:
-        y = librosa.core.resample(y, sr, sr_desired)
-        sr = sr_desired
 
-    return y, sr
+def read_audio_file(audio_path: str, sr_desired=44100):
+    # the same samples the song path fingerprints
+    return load_audio(audio_path, sample_rate=sr_desired), sr_desired
 
 
-def my_spectrogram(audio, sample_rate, fft_window_size, n_mels=256):
-    nperseg = int(sample_rate * fft_window_size)
-    return spectrogram(audio, sample_rate, nperseg=nperseg)
+def my_spectrogram(audio, sample_rate, fft_window_size, n_mels=256, hop_length=None, max_freq=None,
+                   front_end=DEFAULT_FRONT_END):
+    plan = spectrogram_plan(sample_rate, fft_window_size, hop_length=hop_length, max_freq=max_freq, front_end=front_end)
+    return compute_spectrogram(audio, plan=plan, sample_rate=sample_rate)
     #mel_spectrogram = librosa.feature.melspectrogram(y=audio, sr=sample_rate,
     #                                                 hop_length=int(sample_rate * fft_window_size),
     #                                                 fmin=0., fmax=sample_rate / 2.0, n_mels=n_mels)
@@ -33,38 +44,64 @@ def my_spectrogram(audio, sample_rate, fft_window_size, n_mels=256):
     #return frequencies, timestamp, mel_spectrogram
 
 
-def file_to_spectrogram(filename, sample_rate, fft_window_size):
-    a = AudioSegment.from_file(filename).set_channels(1).set_frame_rate(frame_rate=sample_rate)
-    audio = np.frombuffer(a.raw_data, np.int16)
-    print(audio.shape)
-    return my_spectrogram(audio, sample_rate=sample_rate, fft_window_size=fft_window_size)
+def file_to_spectrogram(filename, sample_rate, fft_window_size, hop_length=None, max_freq=None,
+                        front_end=DEFAULT_FRONT_END):
+    audio = load_audio(filename, sample_rate=sample_rate)
+    return my_spectrogram(audio, sample_rate=sample_rate, fft_window_size=fft_window_size, hop_length=hop_length,
+                          max_freq=max_freq, front_end=front_end)
     #audio, sr = read_audio_file(audio_path=filename, sr_desired=sample_rate)
     #return my_spectrogram(audio=audio, sample_rate=sample_rate, fft_window_size=fft_window_size)
 
 
-def find_peaks(Sxx, peak_box_size, point_efficiency):
+def local_maxima(Sxx, peak_box_size):
     data_max = maximum_filter(Sxx, size=peak_box_size, mode='constant', cval=0.0)
-    peak_goodmask = (Sxx == data_max)  # good pixels are True
+    # good pixels are True, silent regions of zero energy are plateaus and not peaks
+    peak_goodmask = (Sxx == data_max) & (Sxx > 0)
     y_peaks, x_peaks = peak_goodmask.nonzero()
-    peak_values = Sxx[y_peaks, x_peaks]
-    i = peak_values.argsort()[::-1]
-    # get co-ordinates into arr
-    j = [(y_peaks[idx], x_peaks[idx]) for idx in i]
-    total = Sxx.shape[0] * Sxx.shape[1]
+    return y_peaks, x_peaks, Sxx[y_peaks, x_peaks]
+
+
+def select_peaks(y_peaks, x_peaks, peak_values, total, peak_box_size, point_efficiency):
     # in a square with a perfectly spaced grid, we could fit area / PEAK_BOX_SIZE^2 points
     # use point efficiency to reduce this, since it won't be perfectly spaced
     # accuracy vs speed tradeoff
-    peak_target = int((total / (peak_box_size ** 2)) * point_efficiency)
-    return j[:peak_target]
+    peak_target = min(int((total / (peak_box_size ** 2)) * point_efficiency), len(peak_values))
+    if peak_target < 1:
+        return np.empty((0, 2), dtype=np.intp)
+    # only the strongest peak_target peaks are selected, and only those get sorted
+    i = np.argpartition(peak_values, len(peak_values) - peak_target)[len(peak_values) - peak_target:]
+    i = i[peak_values[i].argsort()[::-1]]
+    # (freq index, time index) co-ordinates into arr
+    return np.column_stack((y_peaks[i], x_peaks[i]))
+
+
+@metrics.timed("peaks")
+def find_peaks(Sxx, peak_box_size, point_efficiency):
+    y_peaks, x_peaks, peak_values = local_maxima(Sxx, peak_box_size=peak_box_size)
+    peaks = select_peaks(y_peaks, x_peaks, peak_values, total=Sxx.shape[0] * Sxx.shape[1],
+                         peak_box_size=peak_box_size, point_efficiency=point_efficiency)
+    metrics.count("peaks", len(peaks))
+    return peaks
 
 
 def idxs_to_tf_pairs(idxs, t, f):
-    return np.array([(f[i[0]], t[i[1]]) for i in idxs])
-    #return np.array(list(map(lambda x: (f[x[0]], t[x[1]]), idxs)))
+    return np.column_stack((f[idxs[:, 0]], t[idxs[:, 1]]))
+
+
+def quantize_time(t):
+    return np.rint(np.asarray(t, dtype=np.float64) / TIME_RESOLUTION).astype(np.int64)
+
+
+def pack_hashes(f1, f2, dt):
+    f_max = (1 << FREQ_BITS) - 1
+    f1 = np.clip(np.rint(np.asarray(f1) / FREQ_RESOLUTION), 0, f_max).astype(np.uint32)
+    f2 = np.clip(np.rint(np.asarray(f2) / FREQ_RESOLUTION), 0, f_max).astype(np.uint32)
+    dt = np.clip(quantize_time(dt), 0, (1 << DELTA_BITS) - 1).astype(np.uint32)
+    return (f1 << np.uint32(FREQ_BITS + DELTA_BITS)) | (f2 << np.uint32(DELTA_BITS)) | dt
 
 
 def hash_point_pair(p1, p2):
-    return hash((p1[0], p2[0], p2[1] - p1[1]))
+    return int(pack_hashes(p1[0], p2[0], p2[1] - p1[1]))
 
 
 def target_zone(anchor, points, width, height, t):
@@ -80,35 +117,320 @@ def target_zone(anchor, points, width, height, t):
         yield point
 
 
+def song_uuid_for_file(filename):
+    return str(uuid.uuid5(uuid.NAMESPACE_OID, os.path.basename(filename)).int)
+
+
+@metrics.timed("pairing")
+def pair_points(points, target_t, target_f, target_start):
+    """Return (anchor, target) index arrays of every pair target_zone would yield.
+
+    Peaks are sorted by time once, each anchor's time window is found with a
+    binary search and the frequency band is applied as a mask. Pairs come back
+    in the same anchor-major, input order as the target_zone loop.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    freqs = points[:, 0]
+    times = points[:, 1]
+    order = np.argsort(times, kind="stable")
+    sorted_times = times[order]
+    # same arithmetic as target_zone so the float bounds are bit-identical
+    x_min = times + target_start
+    x_max = x_min + target_t
+    y_min = freqs - (target_f * 0.5)
+    y_max = y_min + target_f
+    starts = np.searchsorted(sorted_times, x_min, side="left")
+    ends = np.searchsorted(sorted_times, x_max, side="right")
+    counts = ends - starts
+    anchors = np.repeat(np.arange(len(points)), counts)
+    # position of every candidate inside its anchor's window
+    within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    targets = order[np.repeat(starts, counts) + within]
+    keep = (freqs[targets] >= y_min[anchors]) & (freqs[targets] <= y_max[anchors])
+    anchors = anchors[keep]
+    targets = targets[keep]
+    pair_order = np.lexsort((targets, anchors))
+    return anchors[pair_order], targets[pair_order]
+
+
 def hash_points(points, filename, target_t, target_f, target_start):
-    hashes = []
-    song_id = uuid.uuid5(uuid.NAMESPACE_OID, os.path.basename(filename)).int
-    for anchor in points:
-        for target in target_zone(
-                anchor=anchor, points=points, width=target_t, height=target_f, t=target_start
-        ):
-            hashes.append((
-                # hash
-                hash_point_pair(p1=anchor, p2=target),
-                # time offset
-                anchor[1],
-                # filename
-                str(song_id)
-            ))
-    return hashes
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    anchors, targets = pair_points(points=points, target_t=target_t, target_f=target_f, target_start=target_start)
+    hashes = pack_hashes(f1=points[anchors, 0], f2=points[targets, 0], dt=points[targets, 1] - points[anchors, 1])
+    metrics.count("hashes", len(hashes))
+    return Fingerprint(hashes=hashes, offsets=quantize_time(points[anchors, 1]),
+                       song_uuid=song_uuid_for_file(filename))
 
 
-def fingerprint_file(filename, sample_rate, fft_window_size, peak_box_size, point_efficiency, target_t, target_f,
-                     target_start):
-    f, t, Sxx = file_to_spectrogram(filename=filename, sample_rate=sample_rate, fft_window_size=fft_window_size)
+def segment_tasks(audio, plan, peak_box_size, segment_seconds, sample_rate):
+    """Split the spectrogram columns of audio into (samples, lo, start, end) segment tasks.
+
+    A segment owns the columns [start, end), its samples cover columns lo onwards through
+    end plus the maximum filter's reach, so its local maxima are those of the whole spectrogram.
+    """
+    num_columns = max((len(audio) - plan.nperseg) // plan.hop_length + 1, 0)
+    per_segment = max(int(segment_seconds * sample_rate / plan.hop_length), 1)
+    margin = peak_box_size // 2 + 1
+    tasks = []
+    for start in range(0, num_columns, per_segment):
+        end = min(start + per_segment, num_columns)
+        lo, hi = max(start - margin, 0), min(end + margin, num_columns)
+        tasks.append((audio[lo * plan.hop_length:(hi - 1) * plan.hop_length + plan.nperseg], lo, start, end))
+    return tasks, num_columns
+
+
+def segment_maxima(task, sample_rate, fft_window_size, peak_box_size, hop_length=None, max_freq=None,
+                   front_end=DEFAULT_FRONT_END):
+    """Worker side: (y_peaks, x_peaks, peak_values) of one segment task, x_peaks index the whole spectrogram."""
+    samples, lo, start, end = task
+    _, _, Sxx = my_spectrogram(samples, sample_rate=sample_rate, fft_window_size=fft_window_size,
+                               hop_length=hop_length, max_freq=max_freq, front_end=front_end)
+    with metrics.stage("peaks"):
+        y_peaks, x_peaks, peak_values = local_maxima(Sxx, peak_box_size=peak_box_size)
+    x_peaks = x_peaks + lo
+    keep = (x_peaks >= start) & (x_peaks < end)
+    return y_peaks[keep], x_peaks[keep], peak_values[keep]
+
+
+def audio_to_peaks_parallel(audio, executor, sample_rate, fft_window_size, peak_box_size, point_efficiency,
+                            hop_length=None, max_freq=None, front_end=DEFAULT_FRONT_END,
+                            segment_seconds=SEGMENT_SECONDS):
+    """The peaks of file_to_peaks, with the segments of the spectrogram mapped over executor.
+
+    executor is anything with map: a multiprocessing Pool or a concurrent.futures executor.
+    The strongest peaks are selected once from every segment's local maxima, so the
+    result is identical to the serial path.
+    """
+    plan = spectrogram_plan(sample_rate, fft_window_size, hop_length=hop_length, max_freq=max_freq, front_end=front_end)
+    tasks, num_columns = segment_tasks(audio, plan, peak_box_size=peak_box_size, segment_seconds=segment_seconds,
+                                       sample_rate=sample_rate)
+    if not tasks:
+        return np.empty((0, 2))
+    maxima = executor.map(partial(segment_maxima, sample_rate=sample_rate, fft_window_size=fft_window_size,
+                                  peak_box_size=peak_box_size, hop_length=hop_length, max_freq=max_freq,
+                                  front_end=front_end), tasks)
+    y_peaks, x_peaks, peak_values = (np.concatenate(c) for c in zip(*maxima))
+    # same row-major order as nonzero() over the whole spectrogram
+    order = np.lexsort((x_peaks, y_peaks))
+    peaks = select_peaks(y_peaks[order], x_peaks[order], peak_values[order], total=len(plan.freqs) * num_columns,
+                         peak_box_size=peak_box_size, point_efficiency=point_efficiency)
+    metrics.count("peaks", len(peaks))
+    t = (plan.nperseg / 2 + np.arange(num_columns) * plan.hop_length) / float(sample_rate)
+    return idxs_to_tf_pairs(idxs=peaks, t=t, f=plan.freqs)
+
+
+def file_to_peaks(filename, sample_rate, fft_window_size, peak_box_size, point_efficiency, hop_length=None,
+                  max_freq=None, front_end=DEFAULT_FRONT_END, executor=None, segment_seconds=SEGMENT_SECONDS):
+    if executor is not None:
+        return audio_to_peaks_parallel(load_audio(filename, sample_rate=sample_rate), executor=executor,
+                                       sample_rate=sample_rate, fft_window_size=fft_window_size,
+                                       peak_box_size=peak_box_size, point_efficiency=point_efficiency,
+                                       hop_length=hop_length, max_freq=max_freq, front_end=front_end,
+                                       segment_seconds=segment_seconds)
+    f, t, Sxx = file_to_spectrogram(filename=filename, sample_rate=sample_rate, fft_window_size=fft_window_size,
+                                    hop_length=hop_length, max_freq=max_freq, front_end=front_end)
     peaks = find_peaks(Sxx=Sxx, peak_box_size=peak_box_size, point_efficiency=point_efficiency)
-    peaks = idxs_to_tf_pairs(idxs=peaks, t=t, f=f)
+    return idxs_to_tf_pairs(idxs=peaks, t=t, f=f)
+
+
+def fingerprint_file(filename, sample_rate, fft_window_size, peak_box_size, point_efficiency, target_t, target_f,
+                     target_start, cache=None, hop_length=None, max_freq=None, front_end=DEFAULT_FRONT_END,
+                     executor=None, segment_seconds=SEGMENT_SECONDS):
+    """Fingerprint a file, with an executor its spectrogram segments are processed in parallel."""
+    peak_params = dict(sample_rate=sample_rate, fft_window_size=fft_window_size, peak_box_size=peak_box_size,
+                       point_efficiency=point_efficiency, hop_length=hop_length, max_freq=max_freq, front_end=front_end)
+    to_peaks = file_to_peaks
+    if executor is not None:
+        # identical peaks, the cache entry is shared with the serial path
+        to_peaks = partial(file_to_peaks, executor=executor, segment_seconds=segment_seconds)
+    if cache is None:
+        peaks = to_peaks(filename, **peak_params)
+    else:
+        peaks = cache.peaks(to_peaks, filename, **peak_params)
     return hash_points(points=peaks, filename=filename, target_t=target_t, target_f=target_f, target_start=target_start)
 
 
+def stream_spectrogram(blocks, sample_rate, fft_window_size, hop_length=None, max_freq=None,
+                       front_end=DEFAULT_FRONT_END):
+    """Yield (f, t, Sxx) for consecutive runs of spectrogram columns of streamed audio.
+
+    Frames are cut at the same samples as my_spectrogram over the whole signal, so the
+    concatenated columns equal the whole-signal spectrogram.
+    """
+    plan = spectrogram_plan(sample_rate, fft_window_size, hop_length=hop_length, max_freq=max_freq, front_end=front_end)
+    nperseg = plan.nperseg
+    step = plan.hop_length
+    buffer = np.empty(0, dtype=np.int16)
+    first_frame = 0
+    for block in blocks:
+        buffer = np.concatenate((buffer, block))
+        if len(buffer) < nperseg:
+            continue
+        num_frames = (len(buffer) - nperseg) // step + 1
+        f, _, Sxx = compute_spectrogram(buffer[:(num_frames - 1) * step + nperseg], plan=plan,
+                                        sample_rate=sample_rate)
+        t = (nperseg / 2 + np.arange(first_frame, first_frame + num_frames) * step) / float(sample_rate)
+        yield f, t, Sxx
+        # keep the overlap of the next frame
+        buffer = buffer[num_frames * step:]
+        first_frame += num_frames
+
+
+def iter_local_maxima(spectrogram_blocks, peak_box_size, run_columns=None):
+    """Yield (f, t, y_peaks, x_peaks, peak_values) for consecutive runs of streamed columns.
+
+    Local maxima are picked on a sliding window with the maximum filter's reach as margin
+    on each side, so only the window is kept in memory. Runs are at least run_columns
+    long, by default the margin. t holds the times of the run's columns and x_peaks
+    indexes into it.
+    """
+    # maximum_filter looks peak_box_size // 2 columns to either side
+    margin = peak_box_size // 2 + 1
+    run_columns = margin if run_columns is None else run_columns
+    f = columns = times = None
+    done = 0
+
+    def pick(start, end):
+        y_peaks, x_peaks, peak_values = local_maxima(columns, peak_box_size=peak_box_size)
+        keep = (x_peaks >= start) & (x_peaks < end)
+        return f, times[start:end], y_peaks[keep], x_peaks[keep] - start, peak_values[keep]
+
+    for f, t, Sxx in spectrogram_blocks:
+        columns = Sxx if columns is None else np.hstack((columns, Sxx))
+        times = t if times is None else np.concatenate((times, t))
+        # columns before ready have their whole right margin
+        ready = columns.shape[1] - margin
+        if ready - done < run_columns:
+            continue
+        yield pick(done, ready)
+        # keep the left margin of the next run
+        drop = max(ready - margin, 0)
+        columns = columns[:, drop:]
+        times = times[drop:]
+        done = ready - drop
+    if columns is not None and done < columns.shape[1]:
+        yield pick(done, columns.shape[1])
+
+
+def find_peaks_stream(spectrogram_blocks, peak_box_size, point_efficiency):
+    """find_peaks over streamed spectrogram columns, returns (f, t, peaks)."""
+    f = None
+    times = []
+    candidates = []
+    num_columns = 0
+    for f, t, y_peaks, x_peaks, peak_values in iter_local_maxima(spectrogram_blocks, peak_box_size=peak_box_size):
+        candidates.append((y_peaks, x_peaks + num_columns, peak_values))
+        times.append(t)
+        num_columns += len(t)
+    if f is None:
+        return np.empty(0), np.empty(0), np.empty((0, 2), dtype=np.intp)
+    t = np.concatenate(times)
+
+    y_peaks, x_peaks, peak_values = (np.concatenate(c) for c in zip(*candidates))
+    # same row-major order as nonzero() over the whole spectrogram
+    order = np.lexsort((x_peaks, y_peaks))
+    peaks = select_peaks(y_peaks[order], x_peaks[order], peak_values[order], total=len(f) * len(t),
+                         peak_box_size=peak_box_size, point_efficiency=point_efficiency)
+    return f, t, peaks
+
+
+def iter_live_peaks(spectrogram_blocks, peak_box_size, point_efficiency, run_columns=None):
+    """Yield (points, horizon) as soon as a run of streamed columns is final.
+
+    Unlike find_peaks_stream, the strongest peaks are selected within each run rather than
+    over the whole signal, which is never complete for live input. Every later peak is
+    after horizon, the time of the run's last column.
+    """
+    for f, t, y_peaks, x_peaks, peak_values in iter_local_maxima(spectrogram_blocks, peak_box_size=peak_box_size,
+                                                                  run_columns=run_columns):
+        peaks = select_peaks(y_peaks, x_peaks, peak_values, total=len(f) * len(t),
+                             peak_box_size=peak_box_size, point_efficiency=point_efficiency)
+        yield idxs_to_tf_pairs(idxs=peaks, t=t, f=f), t[-1]
+
+
+def iter_live_hashes(live_peaks, target_t, target_f, target_start, filename="recorded"):
+    """Hash streamed peaks incrementally, yielding a Fingerprint per run of peaks.
+
+    An anchor is hashed once its whole target zone is before the horizon, and only the
+    peaks later anchors can still pair with are kept.
+    """
+    points = np.empty((0, 2))
+    # points[:hashed] were anchors already and are only kept as targets
+    hashed = 0
+    horizon = np.inf
+    for new_points, horizon in itertools.chain(live_peaks, [(np.empty((0, 2)), np.inf)]):
+        points = np.concatenate((points, np.asarray(new_points, dtype=np.float64).reshape(-1, 2)))
+        points[hashed:] = points[hashed:][np.argsort(points[hashed:, 1], kind="stable")]
+        times = points[:, 1]
+        complete = hashed + np.searchsorted(times[hashed:] + target_start + target_t, horizon, side="right")
+        anchors, targets = pair_points(points=points, target_t=target_t, target_f=target_f,
+                                       target_start=target_start)
+        keep = (anchors >= hashed) & (anchors < complete)
+        anchors = anchors[keep]
+        targets = targets[keep]
+        yield Fingerprint(hashes=pack_hashes(f1=points[anchors, 0], f2=points[targets, 0],
+                                             dt=points[targets, 1] - points[anchors, 1]),
+                          offsets=quantize_time(points[anchors, 1]), song_uuid=song_uuid_for_file(filename))
+        if complete < len(points):
+            lo = min(complete, np.searchsorted(times, times[complete] + target_start, side="left"))
+        else:
+            lo = complete
+        points = points[lo:]
+        hashed = complete - lo
+
+
+def iter_hash_batches(points, filename, target_t, target_f, target_start, batch_size):
+    """hash_points in batches of batch_size anchors, in time order."""
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    points = points[np.argsort(points[:, 1], kind="stable")]
+    times = points[:, 1]
+    for i in range(0, len(points), batch_size):
+        j = min(i + batch_size, len(points))
+        # every target of the batch's anchors lies in points[lo:hi]
+        lo = min(i, np.searchsorted(times, times[i] + target_start, side="left"))
+        hi = max(j, np.searchsorted(times, times[j - 1] + target_start + target_t, side="right"))
+        window = points[lo:hi]
+        anchors, targets = pair_points(points=window, target_t=target_t, target_f=target_f,
+                                       target_start=target_start)
+        keep = (anchors >= i - lo) & (anchors < j - lo)
+        anchors = anchors[keep]
+        targets = targets[keep]
+        hashes = pack_hashes(f1=window[anchors, 0], f2=window[targets, 0],
+                             dt=window[targets, 1] - window[anchors, 1])
+        yield Fingerprint(hashes=hashes, offsets=quantize_time(window[anchors, 1]),
+                          song_uuid=song_uuid_for_file(filename))
+
+
+def stream_file_to_peaks(filename, sample_rate, fft_window_size, peak_box_size, point_efficiency, hop_length=None,
+                         max_freq=None, front_end=DEFAULT_FRONT_END, block_seconds=30):
+    blocks = iter_audio_blocks(filename, sample_rate=sample_rate, block_size=int(sample_rate * block_seconds))
+    spectrogram_blocks = stream_spectrogram(blocks, sample_rate=sample_rate, fft_window_size=fft_window_size,
+                                            hop_length=hop_length, max_freq=max_freq, front_end=front_end)
+    f, t, peaks = find_peaks_stream(spectrogram_blocks, peak_box_size=peak_box_size,
+                                    point_efficiency=point_efficiency)
+    return idxs_to_tf_pairs(idxs=peaks, t=t, f=f)
+
+
+def fingerprint_file_stream(filename, sample_rate, fft_window_size, peak_box_size, point_efficiency, target_t,
+                            target_f, target_start, batch_size=50000, cache=None, hop_length=None, max_freq=None,
+                            front_end=DEFAULT_FRONT_END):
+    """Fingerprint a file of any length in roughly constant memory, yielding Fingerprint batches."""
+    peak_params = dict(sample_rate=sample_rate, fft_window_size=fft_window_size, peak_box_size=peak_box_size,
+                       point_efficiency=point_efficiency, hop_length=hop_length, max_freq=max_freq, front_end=front_end)
+    if cache is None:
+        peaks = stream_file_to_peaks(filename, **peak_params)
+    else:
+        # same peaks as file_to_peaks, so both paths share cache entries
+        peaks = cache.peaks(stream_file_to_peaks, filename, **peak_params)
+    yield from iter_hash_batches(points=peaks, filename=filename, target_t=target_t, target_f=target_f,
+                                 target_start=target_start, batch_size=batch_size)
+
+
 def fingerprint_audio(frames, sample_rate, fft_window_size, peak_box_size,
-                      point_efficiency, target_t, target_f, target_start):
-    f, t, Sxx = my_spectrogram(audio=frames, sample_rate=sample_rate, fft_window_size=fft_window_size)
+                      point_efficiency, target_t, target_f, target_start, hop_length=None, max_freq=None,
+                      front_end=DEFAULT_FRONT_END):
+    f, t, Sxx = my_spectrogram(audio=frames, sample_rate=sample_rate, fft_window_size=fft_window_size,
+                               hop_length=hop_length, max_freq=max_freq, front_end=front_end)
     peaks = find_peaks(Sxx=Sxx, peak_box_size=peak_box_size, point_efficiency=point_efficiency)
     peaks = idxs_to_tf_pairs(idxs=peaks, t=t, f=f)
     return hash_points(points=peaks, filename="recorded", target_t=target_t,
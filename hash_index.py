@@ -0,0 +1,151 @@
+import os
+import json
+import sqlite3
+
+import numpy as np
+
+from matching import expand_ranges
+
+# An index file holds the hash table sorted by hash, column by column, so a read-only
+# query node can map it into memory and share the pages between worker processes:
+# | header | directory: int64[2 ** PREFIX_BITS + 1] | hash: uint32[n] | offset: int32[n] | song_id: int32[n] |
+# directory[p] is the first row whose hash has the top PREFIX_BITS bits equal to p.
+# song_info is kept next to it in <index_path>.songs.json and the meta table in <index_path>.meta.json
+INDEX_SUFFIX = ".hidx"
+INDEX_MAGIC = b"AUDHIDX1"
+PREFIX_BITS = 16
+HEADER_DTYPE = np.dtype([("magic", "S8"), ("count", "<u8")])
+DIRECTORY_SIZE = 2 ** PREFIX_BITS + 1
+
+
+def is_index_path(db_path):
+    return str(db_path).endswith(INDEX_SUFFIX)
+
+
+def songs_path(index_path):
+    return index_path + ".songs.json"
+
+
+def meta_path(index_path):
+    return index_path + ".meta.json"
+
+
+def export_index(db_path, index_path, chunk_size=1 << 20):
+    conn = sqlite3.connect(database=db_path, timeout=30)
+    try:
+        count = conn.execute("SELECT count(*) FROM hash").fetchone()[0]
+        directory_offset = HEADER_DTYPE.itemsize
+        hash_offset = directory_offset + DIRECTORY_SIZE * 8
+        offset_offset = hash_offset + count * 4
+        song_id_offset = offset_offset + count * 4
+        with open(index_path, "wb") as f:
+            f.truncate(song_id_offset + count * 4)
+        data = np.memmap(index_path, dtype=np.uint8, mode="r+")
+        data[:directory_offset] = np.frombuffer(np.array([(INDEX_MAGIC, count)], dtype=HEADER_DTYPE).tobytes(),
+                                                dtype=np.uint8)
+        hashes = np.ndarray((count,), dtype="<u4", buffer=data, offset=hash_offset)
+        offsets = np.ndarray((count,), dtype="<i4", buffer=data, offset=offset_offset)
+        song_ids = np.ndarray((count,), dtype="<i4", buffer=data, offset=song_id_offset)
+        bucket_sizes = np.zeros(DIRECTORY_SIZE - 1, dtype=np.int64)
+
+        # idx_hash returns the rows already sorted, only one chunk is held in memory at a time
+        c = conn.execute("SELECT hash, offset, song_id FROM hash ORDER BY hash")
+        position = 0
+        while True:
+            rows = c.fetchmany(chunk_size)
+            if not rows:
+                break
+            chunk = np.array(rows, dtype=np.int64)
+            end = position + len(chunk)
+            hashes[position:end] = chunk[:, 0]
+            offsets[position:end] = chunk[:, 1]
+            song_ids[position:end] = chunk[:, 2]
+            bucket_sizes += np.bincount(chunk[:, 0] >> (32 - PREFIX_BITS), minlength=DIRECTORY_SIZE - 1)
+            position = end
+        directory = np.ndarray((DIRECTORY_SIZE,), dtype="<i8", buffer=data, offset=directory_offset)
+        directory[0] = 0
+        directory[1:] = np.cumsum(bucket_sizes)
+        data.flush()
+        del data, hashes, offsets, song_ids, directory
+
+        songs = {song_id: [artist, album, title] for song_id, artist, album, title in
+                 conn.execute("SELECT song_id, artist, album, title FROM song_info")}
+        with open(songs_path(index_path), "w", encoding="utf-8") as f:
+            json.dump(songs, f, ensure_ascii=False)
+        with open(meta_path(index_path), "w", encoding="utf-8") as f:
+            json.dump(dict(conn.execute("SELECT key, value FROM meta")), f)
+    finally:
+        conn.close()
+    return count
+
+
+class HashIndex:
+    def __init__(self, index_path):
+        header = np.fromfile(index_path, dtype=HEADER_DTYPE, count=1)
+        if len(header) != 1 or header[0]["magic"] != INDEX_MAGIC:
+            raise ValueError("{} is not a hash index file".format(index_path))
+        count = int(header[0]["count"])
+        directory_offset = HEADER_DTYPE.itemsize
+        hash_offset = directory_offset + DIRECTORY_SIZE * 8
+        self.directory = np.memmap(index_path, dtype="<i8", mode="r", offset=directory_offset,
+                                   shape=(DIRECTORY_SIZE,))
+        # np.memmap refuses zero-length maps, an empty index gets empty arrays instead
+        if count > 0:
+            self.hashes = np.memmap(index_path, dtype="<u4", mode="r", offset=hash_offset, shape=(count,))
+            self.offsets = np.memmap(index_path, dtype="<i4", mode="r", offset=hash_offset + count * 4,
+                                     shape=(count,))
+            self.song_ids = np.memmap(index_path, dtype="<i4", mode="r", offset=hash_offset + count * 8,
+                                      shape=(count,))
+        else:
+            self.hashes = np.empty(0, dtype="<u4")
+            self.offsets = np.empty(0, dtype="<i4")
+            self.song_ids = np.empty(0, dtype="<i4")
+        with open(songs_path(index_path), encoding="utf-8") as f:
+            self.song_info = {int(song_id): tuple(info) for song_id, info in json.load(f).items()}
+        try:
+            with open(meta_path(index_path), encoding="utf-8") as f:
+                self.meta = json.load(f)
+        except FileNotFoundError:
+            # exported before the meta table was copied
+            self.meta = {}
+
+    def _bisect(self, keys, lo, hi, right):
+        # binary search of every key at once, each one inside its own [lo, hi) bucket
+        lo = lo.copy()
+        hi = hi.copy()
+        active = np.flatnonzero(lo < hi)
+        while len(active) > 0:
+            mid = (lo[active] + hi[active]) // 2
+            values = self.hashes[mid]
+            go_right = values <= keys[active] if right else values < keys[active]
+            lo[active[go_right]] = mid[go_right] + 1
+            hi[active[~go_right]] = mid[~go_right]
+            active = active[lo[active] < hi[active]]
+        return lo
+
+    def find(self, keys):
+        """Return the [start, end) row range of every key."""
+        keys = np.asarray(keys, dtype=np.uint32)
+        prefixes = (keys >> np.uint32(32 - PREFIX_BITS)).astype(np.intp)
+        lo = np.asarray(self.directory[prefixes])
+        hi = np.asarray(self.directory[prefixes + 1])
+        return self._bisect(keys, lo, hi, right=False), self._bisect(keys, lo, hi, right=True)
+
+    def lookup_hashes(self, keys):
+        start, end = self.find(keys)
+        rows = expand_ranges(start, end)
+        return np.asarray(self.hashes[rows]), np.asarray(self.offsets[rows]), np.asarray(self.song_ids[rows])
+
+    def get_info_for_song_id(self, song_id):
+        return self.song_info.get(song_id)
+
+
+_open_indexes = {}
+
+
+def open_index(index_path):
+    # mapping is cheap and the pages are shared, so every process keeps its index open
+    index_path = os.path.abspath(index_path)
+    if index_path not in _open_indexes:
+        _open_indexes[index_path] = HashIndex(index_path)
+    return _open_indexes[index_path]
@@ -0,0 +1,472 @@
+import os
+import json
+import time
+import queue
+import signal
+import logging
+import sqlite3
+import datetime
+import threading
+from contextlib import contextmanager
+from multiprocessing import Pool, Process, Queue, TimeoutError as PoolTimeout, current_process
+from functools import partial
+
+import numpy as np
+
+import metrics
+from fingerprint import Fingerprint, fingerprint_file, fingerprint_file_stream, song_uuid_for_file
+from spectrogram import DEFAULT_FRONT_END
+from storage import (insert_song_infos, song_rows, insert_hash_rows, update_hash_df, known_song_uuids,
+                     begin_bulk_load, finish_bulk_load, checkpoint_db, songs_db_path, hash_db_paths, song_ids_by_uuid,
+                     known_song_files, insert_song_files, remove_song_files, purge_stale_songs, get_cursor)
+from shards import is_sharded_path, split_by_shard
+
+KNOWN_EXTENSIONS = ["mp3", "wav", "flac", "m4a"]
+# where failures go when no failure_report is given
+DEFAULT_FAILURE_REPORT = "failed_songs.json"
+
+_write_queue = None
+
+
+def get_song_info(filename):
+    # only registering reads tags, queries import this module for find_songs
+    from tinytag import TinyTag
+
+    tag = TinyTag.get(filename)
+    artist = tag.artist if tag.albumartist is None else tag.albumartist
+    return (artist, tag.album, tag.title)
+
+
+def find_songs(path):
+    songs = []
+    for root, _, files in os.walk(path):
+        for f in files:
+            if f.split('.')[-1] not in KNOWN_EXTENSIONS:
+                continue
+            songs.append(os.path.join(root, f))
+    return songs
+
+
+def scan_files(path):
+    # (absolute path, size, mtime_ns) of every song file under path
+    files = []
+    for filename in find_songs(path):
+        stat = os.stat(filename)
+        files.append((os.path.abspath(filename), stat.st_size, stat.st_mtime_ns))
+    return files
+
+
+def plan_sync(path, db_path):
+    """Compare the song files under path with song_files.
+
+    Returns the files to fingerprint, the known files under path that were deleted or
+    changed, and song_files rows for files that need no fingerprinting: songs registered
+    before their files were tracked, and files whose name is taken by another song.
+    """
+    known_files = known_song_files(db_path=db_path)
+    song_ids = song_ids_by_uuid(db_path=db_path)
+    claimed = {song_id for _, _, song_id in known_files.values() if song_id is not None}
+    root = os.path.join(os.path.abspath(path), "")
+    seen = set()
+    to_register = []
+    changed = []
+    untracked = []
+    for filename, size, mtime_ns in scan_files(path):
+        seen.add(filename)
+        known = known_files.get(filename)
+        if known is not None:
+            # size and mtime_ns are NULL when the song's hash rows may not have been written
+            if known[:2] != (size, mtime_ns):
+                changed.append(filename)
+                to_register.append(filename)
+            continue
+        song_uuid = song_uuid_for_file(filename)
+        song_id = song_ids.get(song_uuid)
+        if song_id is not None and song_id not in claimed:
+            untracked.append((filename, size, mtime_ns, song_id))
+            claimed.add(song_id)
+        elif song_uuid in song_ids:
+            print("Song: {} already in database".format(filename))
+            untracked.append((filename, size, mtime_ns, None))
+        else:
+            # later files with the same name are skipped by the writer
+            song_ids[song_uuid] = None
+            to_register.append(filename)
+    deleted = [filename for filename in known_files if filename.startswith(root) and filename not in seen]
+    return to_register, deleted + changed, untracked
+
+
+def largest_first(filenames):
+    """Order files by size, largest first, returns (filenames, {filename: size}).
+
+    Started first, the largest files don't leave a single worker busy once the rest are done.
+    """
+    sizes = {}
+    for filename in filenames:
+        try:
+            sizes[filename] = os.path.getsize(filename)
+        except OSError:
+            # fails in the worker and goes to the failure report
+            sizes[filename] = 0
+    return sorted(filenames, key=sizes.get, reverse=True), sizes
+
+
+@contextmanager
+def time_limit(seconds):
+    """Raise TimeoutError in the block after seconds, no limit without seconds or on platforms without SIGALRM."""
+    if not seconds or not hasattr(signal, "setitimer"):
+        yield
+        return
+
+    def expire(signum, frame):
+        raise TimeoutError("timed out after {} seconds".format(seconds))
+
+    previous = signal.signal(signal.SIGALRM, expire)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def format_eta(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+
+def write_failure_report(path, failed, attempts):
+    # every file that failed on its last attempt, the run itself carries on
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump([{"path": filename, "error": error, "attempts": attempts[filename]}
+                   for filename, error in failed], f, indent=1)
+
+
+def queue_depth(q):
+    try:
+        return q.qsize()
+    except NotImplementedError:
+        # macOS has no sem_getvalue
+        return -1
+
+
+def init_worker(write_queue):
+    global _write_queue
+    _write_queue = write_queue
+
+
+def fingerprint_song(filename, sample_rate, fft_window_size, peak_box_size, point_efficiency, target_t, target_f,
+                     target_start, streaming=False, cache=None, front_end=DEFAULT_FRONT_END, timeout=None,
+                     hop_length=None, max_freq=None):
+    """Worker side: decode and fingerprint one file and hand it to the writer.
+
+    A file that takes longer than timeout seconds fails like one that raises, a hung
+    ffmpeg is killed. Waiting for room in the write queue doesn't count.
+    """
+    params = dict(sample_rate=sample_rate, fft_window_size=fft_window_size, peak_box_size=peak_box_size,
+                  point_efficiency=point_efficiency, target_t=target_t, target_f=target_f,
+                  target_start=target_start, cache=cache, hop_length=hop_length, max_freq=max_freq,
+                  front_end=front_end)
+    try:
+        with time_limit(timeout):
+            # the file as it was before reading it, a change while it is read shows up in the next sync
+            stat = os.stat(filename)
+            if streaming:
+                batches = list(fingerprint_file_stream(filename, **params))
+                hashes = np.concatenate([b.hashes for b in batches]) if batches else np.empty(0, dtype=np.uint32)
+                offsets = np.concatenate([b.offsets for b in batches]) if batches else np.empty(0, dtype=np.int64)
+            else:
+                fingerprint = fingerprint_file(filename, **params)
+                hashes, offsets = fingerprint.hashes, fingerprint.offsets
+            song_info = get_song_info(filename)
+    except Exception as e:
+        logging.exception(f"{current_process().name} failed to fingerprint {filename}")
+        return filename, repr(e), metrics.collect()
+    # compact arrays keep the pickled message small
+    _write_queue.put((filename, song_info, song_uuid_for_file(filename), hashes.astype(np.uint32),
+                      offsets.astype(np.int32), (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)))
+    # the parent merges the worker's stage timings, they would be lost with the process
+    return filename, None, metrics.collect()
+
+
+def write_shard(shard_queue, shard_path, bulk, ack_queue):
+    """Shard writer: the only process that writes the hash rows of one shard."""
+    conn = sqlite3.connect(database=shard_path, timeout=30)
+    c = conn.cursor()
+    if bulk:
+        begin_bulk_load(c)
+    while True:
+        item = shard_queue.get()
+        if item is None:
+            break
+        batch, rows = item
+        insert_hash_rows(c, *rows)
+        conn.commit()
+        ack_queue.put(batch)
+    if bulk:
+        finish_bulk_load(c)
+    conn.close()
+
+
+def check_shard_writers(shard_writers):
+    # with a shard writer gone, its queue fills up and the song writer would wait on it forever
+    for shard_writer in shard_writers:
+        if not shard_writer.is_alive() and shard_writer.exitcode != 0:
+            raise RuntimeError("A shard writer exited with code {}, see its traceback above".format(
+                shard_writer.exitcode))
+
+
+def put_to_shard(shard_queue, item, shard_writer, poll=1.0):
+    while True:
+        check_shard_writers([shard_writer])
+        try:
+            shard_queue.put(item, timeout=poll)
+            return
+        except queue.Full:
+            continue
+
+
+def complete_files(conn, c, ack_queue, incomplete, num_shards, timeout=None):
+    # fill in size and mtime_ns of the files of every batch that all shard writers have committed
+    while incomplete:
+        try:
+            batch = ack_queue.get(timeout=timeout) if timeout else ack_queue.get_nowait()
+        except queue.Empty:
+            return
+        timeout = None
+        incomplete[batch][1] += 1
+        if incomplete[batch][1] == num_shards:
+            files, _ = incomplete.pop(batch)
+            c.executemany("UPDATE song_files SET size = ?, mtime_ns = ? WHERE path = ?",
+                          [(size, mtime_ns, path) for path, size, mtime_ns in files])
+            conn.commit()
+
+
+def write_songs(write_queue, db_path, total, songs_per_transaction, bulk, report_every=10.0, metrics_queue=None):
+    """Writer side: the only process that writes song_info, many songs per transaction.
+
+    Each transaction also records the songs' files in song_files, so an interrupted import
+    resumes from its last commit. With a sharded database the hash rows are handed on to
+    one writer per shard, and a file is recorded as complete once every shard has its rows.
+    """
+    conn = sqlite3.connect(database=songs_db_path(db_path), timeout=30)
+    c = conn.cursor()
+    shard_queues = []
+    shard_writers = []
+    ack_queue = Queue()
+    if is_sharded_path(db_path):
+        for path in hash_db_paths(db_path):
+            shard_queues.append(Queue(maxsize=4))
+            # daemonic, so a song writer that fails doesn't wait on exit for the shard writers still reading
+            shard_writers.append(Process(target=write_shard, args=(shard_queues[-1], path, bulk, ack_queue),
+                                         daemon=True))
+            shard_writers[-1].start()
+    elif bulk:
+        # a bulk load is faster without maintaining the B-tree, the index is built once at the end
+        begin_bulk_load(c)
+    start = last_report = time.perf_counter()
+    written = 0
+    pending = []
+    files = []
+    # batch number: [files, shard writers done]
+    incomplete = {}
+    batch = 0
+    while True:
+        item = write_queue.get()
+        if item is not None:
+            filename, song_info, song_uuid, hashes, offsets, file = item
+            pending.append((Fingerprint(hashes=hashes, offsets=offsets, song_uuid=song_uuid), song_info))
+            files.append(file)
+        if len(pending) >= songs_per_transaction or (item is None and pending):
+            with metrics.stage("db_write"):
+                song_ids, fingerprints = insert_song_infos(c, pending)
+                if fingerprints:
+                    update_hash_df(c, [f.hashes for f in fingerprints])
+                    if not shard_queues:
+                        insert_hash_rows(c, *song_rows(song_ids, fingerprints))
+                inserted = dict(zip([f.song_uuid for f in fingerprints], song_ids))
+                sharded = bool(shard_queues and fingerprints)
+                insert_song_files(c, [(path, None if sharded else size, None if sharded else mtime_ns,
+                                       inserted.get(fingerprint.song_uuid))
+                                      for (path, size, mtime_ns), (fingerprint, _) in zip(files, pending)])
+                conn.commit()
+            if sharded:
+                incomplete[batch] = [files, 0]
+                rows = song_rows(song_ids, fingerprints)
+                for shard_queue, shard_writer, shard_rows in zip(shard_queues, shard_writers,
+                                                                 split_by_shard(len(shard_queues), *rows)):
+                    put_to_shard(shard_queue, (batch, shard_rows), shard_writer)
+                batch += 1
+                complete_files(conn, c, ack_queue, incomplete, len(shard_queues))
+            written += len(song_ids)
+            pending = []
+            files = []
+        if item is None:
+            break
+        now = time.perf_counter()
+        if now - last_report >= report_every:
+            print("Wrote {}/{} songs, {:.1f} songs/s, queue depth {}".format(
+                written, total, written / (now - start), queue_depth(write_queue)))
+            last_report = now
+    for shard_queue, shard_writer in zip(shard_queues, shard_writers):
+        put_to_shard(shard_queue, None, shard_writer)
+    while incomplete and any(shard_writer.is_alive() for shard_writer in shard_writers):
+        complete_files(conn, c, ack_queue, incomplete, len(shard_queues), timeout=1.0)
+    complete_files(conn, c, ack_queue, incomplete, len(shard_queues))
+    for shard_writer in shard_writers:
+        shard_writer.join()
+    # the files of a failed shard stay incomplete and are fingerprinted again by the next sync
+    check_shard_writers(shard_writers)
+    if bulk and not shard_queues:
+        finish_bulk_load(c)
+    conn.close()
+    elapsed = time.perf_counter() - start
+    print("Wrote {} songs in {:.1f} seconds, {:.1f} songs/s".format(written, elapsed, written / max(elapsed, 1e-9)))
+    if metrics_queue is not None:
+        metrics_queue.put(metrics.collect())
+
+
+def check_writer(writer):
+    # with the writer gone, workers would wait on a full write queue forever
+    if not writer.is_alive() and writer.exitcode != 0:
+        raise RuntimeError("The song writer exited with code {}, see its traceback above".format(writer.exitcode))
+
+
+def results_while_writing(results, writer, poll=1.0):
+    """Yield the results of an imap iterator, raise RuntimeError once the writer has died."""
+    while True:
+        try:
+            yield results.next(timeout=poll)
+        except StopIteration:
+            return
+        except PoolTimeout:
+            check_writer(writer)
+
+
+def join_while_writing(pool, writer, poll=1.0):
+    # workers still flush their last songs to the writer while the pool joins
+    joiner = threading.Thread(target=pool.join, daemon=True)
+    joiner.start()
+    while joiner.is_alive():
+        joiner.join(poll)
+        check_writer(writer)
+
+
+def stop_writer(write_queue, writer, poll=1.0):
+    # the end of the songs, unless the writer is gone and nothing reads the queue
+    while writer.is_alive():
+        try:
+            write_queue.put(None, timeout=poll)
+            break
+        except queue.Full:
+            continue
+    writer.join()
+
+
+def ingest_directory(path, num_workers, db_path, sample_rate, fft_window_size, peak_box_size, point_efficiency,
+                     target_t, target_f, target_start, streaming=False, songs_per_transaction=50,
+                     queue_size=None, bulk_import=False, cache=None, front_end=DEFAULT_FRONT_END, sync=False,
+                     file_timeout=None, retries=1, tasks_per_worker=100, failure_report=None, report_every=10.0,
+                     hop_length=None, max_freq=None):
+    """Fingerprint the songs under path that are not in the database yet.
+
+    With sync, files are tracked by path, size and mtime instead of by name: new and changed
+    files are fingerprinted, and the songs of changed or deleted files are removed first.
+    Rerunning it after an interruption picks up from the last committed transaction.
+
+    Files are fingerprinted largest first, each within file_timeout seconds. Files that fail
+    are tried again up to retries times once the others are done, then written to
+    failure_report, or to DEFAULT_FAILURE_REPORT if there are any. Workers are replaced after
+    tasks_per_worker files, which bounds what leaking decoders can hold on to.
+
+    bulk_import drops idx_hash and turns off syncing for the whole import, queries fall back
+    to full scans and a crash can corrupt the database, so it is only ever asked for.
+    """
+    # songs removed by an interrupted sync, before their song_ids can be reused
+    purge_stale_songs(db_path=db_path)
+    if sync:
+        to_register, removed, untracked = plan_sync(path, db_path=db_path)
+        removed_songs = remove_song_files(db_path=db_path, paths=removed)
+        with get_cursor(db_path=songs_db_path(db_path)) as (conn, c):
+            insert_song_files(c, untracked)
+            conn.commit()
+        print("Removed {} songs of {} changed or deleted files, tracking {} more files".format(
+            removed_songs, len(removed), len(untracked)))
+    else:
+        known = known_song_uuids(db_path=db_path)
+        to_register = {}
+        for filename in find_songs(path):
+            song_uuid = song_uuid_for_file(filename)
+            if song_uuid in known or song_uuid in to_register:
+                print("Song: {} already in database".format(filename))
+                continue
+            to_register[song_uuid] = filename
+        to_register = list(to_register.values())
+    to_register, sizes = largest_first(to_register)
+    print("Number of song: {}".format(len(to_register)))
+
+    # bounded, so fingerprinting can't run far ahead of the writer
+    write_queue = Queue(maxsize=queue_size or 4 * num_workers)
+    metrics_queue = Queue() if metrics.is_enabled() else None
+    writer = Process(target=write_songs, args=(write_queue, db_path, len(to_register), songs_per_transaction,
+                                               bulk_import),
+                     kwargs={"metrics_queue": metrics_queue})
+    writer.start()
+    fingerprint_a_song = partial(fingerprint_song, sample_rate=sample_rate, fft_window_size=fft_window_size,
+                                 peak_box_size=peak_box_size, point_efficiency=point_efficiency, target_t=target_t,
+                                 target_f=target_f, target_start=target_start, streaming=streaming,
+                                 cache=cache, front_end=front_end, timeout=file_timeout, hop_length=hop_length,
+                                 max_freq=max_freq)
+    # filename: error of its last attempt
+    errors = {}
+    attempts = dict.fromkeys(to_register, 0)
+    remaining = to_register
+    total_bytes = sum(sizes.values())
+    done = done_bytes = 0
+    try:
+        with Pool(processes=num_workers, initializer=init_worker, initargs=(write_queue,),
+                  maxtasksperchild=tasks_per_worker) as p:
+            start = last_report = time.perf_counter()
+            for attempt in range(retries + 1):
+                if not remaining:
+                    break
+                if attempt:
+                    print("Retrying {} failed files".format(len(remaining)))
+                    total_bytes += sum(sizes[filename] for filename in remaining)
+                results = p.imap_unordered(fingerprint_a_song, remaining)
+                for filename, error, collected in results_while_writing(results, writer):
+                    metrics.merge(collected)
+                    attempts[filename] += 1
+                    done_bytes += sizes[filename]
+                    if error is None:
+                        done += 1
+                        errors.pop(filename, None)
+                    else:
+                        errors[filename] = error
+                    now = time.perf_counter()
+                    if now - last_report >= report_every:
+                        rate = done_bytes / (now - start)
+                        print("Fingerprinted {}/{} files, {} failed, {:.1f} MB/s, ETA {}".format(
+                            done, len(to_register), len(errors), rate / 2 ** 20,
+                            format_eta((total_bytes - done_bytes) / max(rate, 1e-9))))
+                        last_report = now
+                remaining = [filename for filename in to_register if filename in errors]
+            # workers hand songs to a queue feeder thread, leaving the with block would terminate
+            # them before it flushes, and the writer would wait on a half-sent song
+            p.close()
+            join_while_writing(p, writer)
+    finally:
+        stop_writer(write_queue, writer)
+    check_writer(writer)
+    if metrics_queue is not None:
+        try:
+            metrics.merge(metrics_queue.get(timeout=1))
+        except queue.Empty:
+            logging.warning("The writer exited without its metrics")
+    failed = [(filename, errors[filename]) for filename in to_register if filename in errors]
+    for filename, error in failed:
+        print("Failed: {} {}".format(filename, error))
+    if failure_report is not None or failed:
+        write_failure_report(failure_report or DEFAULT_FAILURE_REPORT, failed, attempts)
+    # speed up future reads
+    checkpoint_db(db_path=db_path)
+    return failed
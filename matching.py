@@ -0,0 +1,90 @@
+from collections import namedtuple
+
+import numpy as np
+
+import metrics
+
+# one row per (database row, query offset) pair that shares a hash
+Matches = namedtuple("Matches", ["song_ids", "db_offsets", "query_offsets"])
+# added to offset bins so they pack into the low 32 bits of a vote key
+BIN_BIAS = 1 << 31
+
+
+def unique_hashes(hashes):
+    return np.unique(np.asarray(hashes.hashes))
+
+
+def expand_ranges(start, end):
+    # row numbers of every [start, end) range, concatenated
+    counts = end - start
+    return np.repeat(start - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+
+
+def sort_rows(row_hashes, row_offsets, row_song_ids):
+    order = np.argsort(row_hashes, kind="stable")
+    return row_hashes[order], row_offsets[order], row_song_ids[order]
+
+
+def select_rows(row_hashes, row_offsets, row_song_ids, keys):
+    """Select the rows, sorted by hash, whose hash is one of the sorted unique keys."""
+    rows = expand_ranges(np.searchsorted(row_hashes, keys, side="left"),
+                         np.searchsorted(row_hashes, keys, side="right"))
+    return row_hashes[rows], row_offsets[rows], row_song_ids[rows]
+
+
+def join_matches(hashes, row_hashes, row_offsets, row_song_ids):
+    """Pair every database row with every query offset of its hash."""
+    query_hashes = np.asarray(hashes.hashes)
+    order = np.argsort(query_hashes, kind="stable")
+    query_offsets = np.asarray(hashes.offsets)[order]
+    keys, starts, counts = np.unique(query_hashes[order], return_index=True, return_counts=True)
+    row_hashes = np.asarray(row_hashes)
+    position = np.searchsorted(keys, row_hashes)
+    found = position < len(keys)
+    found[found] = keys[position[found]] == row_hashes[found]
+    position = position[found]
+    rows = np.flatnonzero(found)
+    repeats = counts[position]
+    # each row is repeated once per query offset of its hash
+    within = np.arange(repeats.sum()) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+    query_index = np.repeat(starts[position], repeats) + within
+    rows = np.repeat(rows, repeats)
+    return Matches(song_ids=np.asarray(row_song_ids)[rows], db_offsets=np.asarray(row_offsets)[rows],
+                   query_offsets=query_offsets[query_index])
+
+
+def vote_counts(matches, binwidth):
+    """Histogram every candidate song's aligned offsets, as (song, offset bin) keys and their vote counts."""
+    bins = (np.asarray(matches.db_offsets, dtype=np.int64) - np.asarray(matches.query_offsets)) // binwidth
+    # the song in the high half, the offset bin made non-negative in the low half
+    keys = (np.asarray(matches.song_ids, dtype=np.int64) << 32) | (bins + BIN_BIAS)
+    return np.unique(keys, return_counts=True)
+
+
+def add_votes(keys, counts, new_keys, new_counts):
+    """Merge two vote histograms from vote_counts."""
+    keys, inverse = np.unique(np.concatenate((keys, new_keys)), return_inverse=True)
+    return keys, np.bincount(inverse, weights=np.concatenate((counts, new_counts))).astype(np.int64)
+
+
+def rank_votes(keys, counts, binwidth, top_k=1):
+    """Return (song_ids, scores, offsets) of the top_k songs of a vote histogram, see score_matches."""
+    if len(keys) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    key_songs = keys >> 32
+    # keys are sorted, so each song's keys are contiguous
+    order = np.lexsort((-counts, key_songs))
+    # the first key of each song in that order is its fullest bin
+    best = order[np.r_[True, key_songs[order][1:] != key_songs[order][:-1]]]
+    ranked = best[np.argsort(-counts[best], kind="stable")[:top_k]]
+    return key_songs[ranked], counts[ranked], ((keys[ranked] & 0xFFFFFFFF) - BIN_BIAS) * binwidth
+
+
+@metrics.timed("scoring")
+def score_matches(matches, binwidth, top_k=1):
+    """Score every candidate song at once by its largest aligned offset histogram bin.
+
+    Returns (song_ids, scores, offsets) arrays of the top_k songs, best first, where
+    offset is the start of the winning bin: the query's position inside the song.
+    """
+    return rank_votes(*vote_counts(matches, binwidth), binwidth=binwidth, top_k=top_k)
@@ -0,0 +1,307 @@
+import json
+import sys
+import time
+import pstats
+import cProfile
+import threading
+import tracemalloc
+from functools import wraps
+
+# Per-stage timing histograms, counters and sampled profiles of the pipeline.
+#
+# Everything is off until enable() is called, a disabled hook is one flag check, so the
+# hooks stay in the hot paths. Durations go into log2 buckets of nanoseconds, bucket i
+# holds values of bit length i, so histograms merge across processes by adding.
+STAGES = ["decode", "spectrogram", "peaks", "pairing", "db_write", "db_lookup", "scoring"]
+NUM_BUCKETS = 64
+# Prometheus buckets from 2 ** 10 ns (1 us) to 2 ** 36 ns (69 s)
+PROMETHEUS_BUCKETS = range(10, 37)
+PROFILERS = ["cprofile", "tracemalloc"]
+# functions kept per stage in a cProfile snapshot
+PROFILE_TOP = 20
+
+_enabled = False
+_profiler = None
+_profile_every = 0
+_profiling = False
+_lock = threading.Lock()
+_stages = {}
+_counters = {}
+_calls = {}
+_profiles = {}
+_peak_bytes = {}
+
+
+def enable(profiler=None, profile_every=100):
+    """Start recording. profiler is "cprofile" or "tracemalloc" to profile 1 call in profile_every per stage."""
+    global _enabled, _profiler, _profile_every
+    if profiler is not None and profiler not in PROFILERS:
+        raise ValueError("Unknown profiler {!r}, expected one of {}".format(profiler, PROFILERS))
+    _enabled = True
+    _profiler = profiler
+    _profile_every = profile_every
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    with _lock:
+        for table in (_stages, _counters, _calls, _profiles, _peak_bytes):
+            table.clear()
+
+
+def _new_histogram():
+    return {"count": 0, "sum": 0, "min": None, "max": 0, "buckets": [0] * NUM_BUCKETS}
+
+
+def _add(histogram, value, count=1):
+    histogram["count"] += count
+    histogram["sum"] += value * count
+    histogram["min"] = value if histogram["min"] is None else min(histogram["min"], value)
+    histogram["max"] = max(histogram["max"], value)
+    histogram["buckets"][min(int(value).bit_length(), NUM_BUCKETS - 1)] += count
+
+
+def observe(stage, ns):
+    """Record one duration of a stage in nanoseconds."""
+    if not _enabled:
+        return
+    with _lock:
+        if stage not in _stages:
+            _stages[stage] = _new_histogram()
+        _add(_stages[stage], ns)
+
+
+def count(name, value=1):
+    """Add value to a counter, the number of additions is kept too for per-call averages."""
+    if not _enabled:
+        return
+    with _lock:
+        if name not in _counters:
+            _counters[name] = _new_histogram()
+        _add(_counters[name], value)
+
+
+def _sampled(stage):
+    # True for 1 call in profile_every of a stage, never while another call is profiled
+    if _profiler is None or _profiling:
+        return False
+    with _lock:
+        _calls[stage] = _calls.get(stage, 0) + 1
+        return (_calls[stage] - 1) % _profile_every == 0
+
+
+def _profiled_call(stage, func, args, kwargs):
+    global _profiling
+    _profiling = True
+    try:
+        if _profiler == "cprofile":
+            profile = cProfile.Profile()
+            start = time.perf_counter_ns()
+            result = profile.runcall(func, *args, **kwargs)
+            observe(stage, time.perf_counter_ns() - start)
+            with _lock:
+                if stage in _profiles:
+                    _profiles[stage].add(profile)
+                else:
+                    _profiles[stage] = pstats.Stats(profile)
+            return result
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        start = time.perf_counter_ns()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter_ns() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            if not tracing:
+                tracemalloc.stop()
+        # tracing slows the call down, its duration is still recorded
+        observe(stage, elapsed)
+        with _lock:
+            if stage not in _peak_bytes:
+                _peak_bytes[stage] = _new_histogram()
+            _add(_peak_bytes[stage], peak)
+        return result
+    finally:
+        _profiling = False
+
+
+def timed(stage):
+    """Decorator recording every call of a function as one duration of stage."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            if _sampled(stage):
+                return _profiled_call(stage, func, args, kwargs)
+            start = time.perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(stage, time.perf_counter_ns() - start)
+        return wrapper
+    return decorator
+
+
+class _Timer:
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.stage, time.perf_counter_ns() - self.start)
+        return False
+
+
+class _NoTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_no_timer = _NoTimer()
+
+
+def stage(name):
+    """Context manager timing a block as one duration of stage, for stages inside a function."""
+    return _Timer(name) if _enabled else _no_timer
+
+
+def collect(clear=True):
+    """Raw histograms and counters, for merge() in another process. Profiles stay in this process."""
+    with _lock:
+        raw = {"stages": {k: dict(v, buckets=list(v["buckets"])) for k, v in _stages.items()},
+               "counters": {k: dict(v, buckets=list(v["buckets"])) for k, v in _counters.items()},
+               "peak_bytes": {k: dict(v, buckets=list(v["buckets"])) for k, v in _peak_bytes.items()}}
+        if clear:
+            for table in (_stages, _counters, _peak_bytes):
+                table.clear()
+    return raw
+
+
+def merge(raw):
+    """Add the raw data collected in another process."""
+    if not raw:
+        return
+    with _lock:
+        for key, table in (("stages", _stages), ("counters", _counters), ("peak_bytes", _peak_bytes)):
+            for name, other in raw.get(key, {}).items():
+                if name not in table:
+                    table[name] = _new_histogram()
+                histogram = table[name]
+                histogram["count"] += other["count"]
+                histogram["sum"] += other["sum"]
+                if other["min"] is not None:
+                    histogram["min"] = other["min"] if histogram["min"] is None else min(histogram["min"], other["min"])
+                histogram["max"] = max(histogram["max"], other["max"])
+                histogram["buckets"] = [a + b for a, b in zip(histogram["buckets"], other["buckets"])]
+
+
+def quantile(histogram, q):
+    """Estimate a quantile from the log2 buckets, interpolating inside the bucket."""
+    if histogram["count"] == 0:
+        return None
+    rank = q * histogram["count"]
+    seen = 0
+    for i, n in enumerate(histogram["buckets"]):
+        if n and seen + n >= rank:
+            low, high = (0, 1) if i == 0 else (1 << (i - 1), 1 << i)
+            value = low + (high - low) * (rank - seen) / n
+            return min(max(value, histogram["min"]), histogram["max"])
+        seen += n
+    return histogram["max"]
+
+
+def summarize(histogram, scale=1.0):
+    count = histogram["count"]
+    values = {"count": count, "total": histogram["sum"] * scale,
+              "mean": histogram["sum"] * scale / count if count else None,
+              "min": histogram["min"] * scale if histogram["min"] is not None else None,
+              "max": histogram["max"] * scale}
+    for name, q in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+        value = quantile(histogram, q)
+        values[name] = value * scale if value is not None else None
+    return values
+
+
+def profile_rows(stats, top=PROFILE_TOP):
+    # (function, calls, own seconds, cumulative seconds) of the top functions by cumulative time
+    rows = []
+    for (filename, line, function), (_, calls, own, cumulative, _) in stats.stats.items():
+        rows.append(("{}:{}({})".format(filename, line, function), calls, own, cumulative))
+    rows.sort(key=lambda row: -row[3])
+    return [{"function": f, "calls": n, "own_s": own, "cumulative_s": cumulative}
+            for f, n, own, cumulative in rows[:top]]
+
+
+def snapshot():
+    """Everything recorded so far, JSON serializable: stage timings in milliseconds, counters and profiles."""
+    with _lock:
+        return {"stages_ms": {name: summarize(h, scale=1e-6) for name, h in sorted(_stages.items())},
+                "counters": {name: summarize(h) for name, h in sorted(_counters.items())},
+                "cprofile": {name: profile_rows(stats) for name, stats in sorted(_profiles.items())},
+                "peak_bytes": {name: summarize(h) for name, h in sorted(_peak_bytes.items())}}
+
+
+def prometheus(prefix="audio_search"):
+    """Everything recorded so far in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        stages = sorted(_stages.items())
+        counters = sorted(_counters.items())
+        peaks = sorted(_peak_bytes.items())
+    if stages:
+        name = "{}_stage_seconds".format(prefix)
+        lines += ["# HELP {} Time spent in each pipeline stage.".format(name), "# TYPE {} histogram".format(name)]
+        for stage_name, h in stages:
+            cumulative = 0
+            for i in PROMETHEUS_BUCKETS:
+                # bucket i holds values below 2 ** i
+                cumulative = sum(h["buckets"][:i + 1])
+                lines.append('{}_bucket{{stage="{}",le="{:.9g}"}} {}'.format(name, stage_name, (1 << i) * 1e-9,
+                                                                             cumulative))
+            lines.append('{}_bucket{{stage="{}",le="+Inf"}} {}'.format(name, stage_name, h["count"]))
+            lines.append('{}_sum{{stage="{}"}} {:.9g}'.format(name, stage_name, h["sum"] * 1e-9))
+            lines.append('{}_count{{stage="{}"}} {}'.format(name, stage_name, h["count"]))
+    for counter_name, h in counters:
+        name = "{}_{}_total".format(prefix, counter_name)
+        lines += ["# TYPE {} counter".format(name), "{} {}".format(name, h["sum"])]
+        name = "{}_{}_observations_total".format(prefix, counter_name)
+        lines += ["# TYPE {} counter".format(name), "{} {}".format(name, h["count"])]
+    if peaks:
+        name = "{}_sampled_peak_bytes".format(prefix)
+        lines += ["# TYPE {} gauge".format(name)]
+        for stage_name, h in peaks:
+            lines.append('{}{{stage="{}"}} {}'.format(name, stage_name, h["max"]))
+    return "\n".join(lines) + "\n"
+
+
+def dump(path):
+    """Write a snapshot to path, Prometheus text for a .prom path, JSON otherwise, "-" for stdout."""
+    text = prometheus() if str(path).endswith(".prom") else json.dumps(snapshot(), indent=2) + "\n"
+    if path == "-":
+        sys.stdout.write(text)
+        return
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
@@ -0,0 +1,86 @@
+import os
+import argparse
+import sqlite3
+from multiprocessing import Pool
+from functools import partial
+
+import warnings
+warnings.filterwarnings("ignore")
+
+from fingerprint import fingerprint_file, song_uuid_for_file
+from storage import setup_db, store_song, checkpoint_db
+from ingest import find_songs
+
+# Old databases store Python's hash() of float tuples, which cannot be turned back into
+# the packed (freq, freq, delta) hash. Songs are therefore re-fingerprinted from the
+# music directory and written to a new database together with their existing tags.
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--old_db_path", type=str, default="music.sqlite")
+    parser.add_argument("--new_db_path", type=str, default=None)
+    parser.add_argument("--song_dir", type=str, default=None)
+    parser.add_argument("--num_workers", type=int, default=6)
+    parser.add_argument("--sample_rate", type=int, default=44100)
+    parser.add_argument("--fft_window_size", type=float, default=0.2)
+    parser.add_argument("--peak_box_size", type=int, default=30)
+    parser.add_argument("--point_efficiency", type=float, default=0.8)
+    parser.add_argument("--target_t", type=float, default=1.8)
+    parser.add_argument("--target_f", type=int, default=4000)
+    parser.add_argument("--target_start", type=float, default=0.05)
+
+    args = parser.parse_args()
+
+    return args
+
+
+def fingerprint_song(filename, **fingerprint_params):
+    # a file that can't be decoded is reported at the end, the rest is still migrated
+    try:
+        return fingerprint_file(filename, **fingerprint_params), None
+    except Exception as e:
+        return None, repr(e)
+
+
+def migrate_db(old_db_path, new_db_path, song_dir, num_workers, **fingerprint_params):
+    conn = sqlite3.connect(old_db_path)
+    old_songs = conn.execute("SELECT artist, album, title, song_id FROM song_info").fetchall()
+    conn.close()
+
+    song_files = {song_uuid_for_file(f): f for f in find_songs(song_dir)}
+    to_migrate = [(song[:3], song_files[song[3]]) for song in old_songs if song[3] in song_files]
+    missing = len(old_songs) - len(to_migrate)
+    print("Songs in old database: {}, found: {}, missing files: {}".format(len(old_songs), len(to_migrate), missing))
+
+    setup_db(db_path=new_db_path)
+    fingerprint = partial(fingerprint_song, **fingerprint_params)
+    failed = []
+    with Pool(processes=num_workers) as p:
+        for (song_info, filename), (hashes, error) in zip(to_migrate, p.imap(fingerprint, [f for _, f in to_migrate])):
+            if error is not None:
+                failed.append((filename, error))
+                continue
+            store_song(hashes, song_info, db_path=new_db_path)
+    checkpoint_db(db_path=new_db_path)
+    for filename, error in failed:
+        print("Failed to migrate {}: {}".format(filename, error))
+    print("Migrated {} songs, {} failed".format(len(to_migrate) - len(failed), len(failed)))
+
+    old_size = os.path.getsize(old_db_path)
+    new_size = os.path.getsize(new_db_path)
+    print("Database size: {:.1f} MB -> {:.1f} MB".format(old_size / 2 ** 20, new_size / 2 ** 20))
+
+
+if __name__ == '__main__':
+    args = get_args()
+
+    assert args.old_db_path != args.new_db_path
+    assert 0. < args.fft_window_size < 1.
+    assert 0. < args.point_efficiency <= 1.
+
+    migrate_db(old_db_path=args.old_db_path, new_db_path=args.new_db_path, song_dir=args.song_dir,
+               num_workers=args.num_workers, sample_rate=args.sample_rate, fft_window_size=args.fft_window_size,
+               peak_box_size=args.peak_box_size, point_efficiency=args.point_efficiency, target_t=args.target_t,
+               target_f=args.target_f, target_start=args.target_start)
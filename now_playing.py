@@ -0,0 +1,71 @@
+import sys
+import json
+import argparse
+
+import warnings
+warnings.filterwarnings("ignore")
+
+from decode import iter_audio_blocks, iter_pcm_stream_blocks, iter_wav_stream_blocks
+from recognize import recognize_stream
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--db_path", type=str, default=None)
+    # an audio file, "-" for a WAV on stdin, or "mic" for the microphone
+    parser.add_argument("--input", type=str, default="-")
+    # stdin carries raw 16-bit mono PCM at --sample_rate instead of a WAV
+    parser.add_argument("--raw", action="store_true")
+    parser.add_argument("--block_seconds", type=float, default=0.5)
+    # aligned votes a song needs before it is announced
+    parser.add_argument("--min_score", type=int, default=20)
+    # votes older than this are forgotten, so a new song can take over
+    parser.add_argument("--memory_seconds", type=float, default=10.0)
+    parser.add_argument("--sample_rate", type=int, default=44100)
+    parser.add_argument("--fft_window_size", type=float, default=0.2)
+    parser.add_argument("--peak_box_size", type=int, default=30)
+    parser.add_argument("--point_efficiency", type=float, default=0.8)
+    parser.add_argument("--target_t", type=float, default=1.8)
+    parser.add_argument("--target_f", type=int, default=4000)
+    parser.add_argument("--target_start", type=float, default=0.05)
+    # default to the front end, hop and highest frequency the database was built with
+    parser.add_argument("--front_end", type=str, default=None)
+    parser.add_argument("--hop_length", type=int, default=None)
+    parser.add_argument("--max_freq", type=float, default=None)
+
+    args = parser.parse_args()
+
+    return args
+
+
+def open_blocks(source, sample_rate, block_size, raw=False):
+    if source == "mic":
+        from record import stream_audio
+        return stream_audio(rate=sample_rate, chunk=block_size)
+    if source == "-":
+        if raw:
+            return iter_pcm_stream_blocks(sys.stdin.buffer, block_size=block_size)
+        return iter_wav_stream_blocks(sys.stdin.buffer, sample_rate=sample_rate, block_size=block_size)
+    return iter_audio_blocks(source, sample_rate=sample_rate, block_size=block_size)
+
+
+if __name__ == '__main__':
+    args = get_args()
+
+    assert 0. < args.fft_window_size < 1.
+    assert 0. < args.point_efficiency <= 1.
+
+    blocks = open_blocks(args.input, sample_rate=args.sample_rate,
+                         block_size=int(args.sample_rate * args.block_seconds), raw=args.raw)
+    events = recognize_stream(blocks, db_path=args.db_path, sample_rate=args.sample_rate,
+                              fft_window_size=args.fft_window_size, peak_box_size=args.peak_box_size,
+                              point_efficiency=args.point_efficiency, target_t=args.target_t,
+                              target_f=args.target_f, target_start=args.target_start,
+                              min_score=args.min_score, memory_seconds=args.memory_seconds,
+                              front_end=args.front_end, hop_length=args.hop_length, max_freq=args.max_freq)
+    try:
+        for event in events:
+            print(json.dumps(event, ensure_ascii=False), flush=True)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,115 @@
+import os
+import time
+import hashlib
+import tempfile
+
+import numpy as np
+
+# bump when peak picking changes, so old entries stop matching
+CACHE_VERSION = 2
+# bytes read from the start and the end of a file for its content key
+PARTIAL_DIGEST_BYTES = 1 << 16
+# every process keeps its own running total of the cache size, the directory is scanned
+# again after this many puts to count what the other workers wrote
+SCAN_EVERY = 100
+# eviction goes down to this fraction of max_bytes, so a full cache isn't scanned on every put
+EVICT_TO = 0.9
+# temporary files this old were left by a write that was interrupted
+STALE_TMP_SECONDS = 3600
+
+
+def file_key(filename):
+    # size, mtime and the first and last bytes identify the audio without reading all of it
+    st = os.stat(filename)
+    digest = hashlib.sha1()
+    with open(filename, "rb") as f:
+        digest.update(f.read(PARTIAL_DIGEST_BYTES))
+        if st.st_size > 2 * PARTIAL_DIGEST_BYTES:
+            f.seek(-PARTIAL_DIGEST_BYTES, os.SEEK_END)
+            digest.update(f.read(PARTIAL_DIGEST_BYTES))
+    return "{}:{}:{}".format(st.st_size, st.st_mtime_ns, digest.hexdigest())
+
+
+class PeakCache:
+    """On-disk cache of the (freq, time) peaks of audio files.
+
+    Peaks are the expensive decode + spectrogram + peak picking result. Entries are keyed
+    by file content and the peak parameters; hashing the peaks for any target zone is
+    cheap, so target zone sweeps reuse the same entries. The least recently used entries
+    are evicted once the cache grows past max_bytes.
+    """
+
+    def __init__(self, cache_dir, max_bytes=2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        # bytes in the cache as of the last scan plus what this process has written since
+        self.total_bytes = None
+        self.puts_since_scan = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def entry_path(self, filename, peak_params):
+        key = repr((CACHE_VERSION, file_key(filename), sorted(peak_params.items())))
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".npy")
+
+    def get(self, filename, peak_params):
+        path = self.entry_path(filename, peak_params)
+        try:
+            peaks = np.load(path)
+        except (OSError, ValueError):
+            return None
+        # mark as recently used
+        os.utime(path)
+        return peaks
+
+    def put(self, filename, peak_params, peaks):
+        path = self.entry_path(filename, peak_params)
+        # write then rename, so concurrent workers never read a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, np.asarray(peaks, dtype=np.float64))
+                size = f.tell()
+            os.replace(tmp_path, path)
+        finally:
+            # an exception or a timeout before the rename
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.puts_since_scan += 1
+        if self.total_bytes is not None:
+            self.total_bytes += size
+        # a full scan only when this process thinks the cache is over its size, or now and then
+        if self.total_bytes is None or self.total_bytes > self.max_bytes or self.puts_since_scan >= SCAN_EVERY:
+            self.evict()
+
+    def evict(self):
+        entries = []
+        now = time.time()
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".npy"):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+            elif entry.name.endswith(".tmp") and now - entry.stat().st_mtime > STALE_TMP_SECONDS:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+        total = sum(size for _, size, _ in entries)
+        if total <= self.max_bytes:
+            entries = []
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes * EVICT_TO:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.total_bytes = total
+        self.puts_since_scan = 0
+
+    def peaks(self, compute, filename, **peak_params):
+        peaks = self.get(filename, peak_params)
+        if peaks is None:
+            peaks = compute(filename, **peak_params)
+            self.put(filename, peak_params, peaks)
+        return peaks
@@ -9,8 +9,12 @@ warnings.filterwarnings("ignore")
 
 import numpy as np
 
+import metrics
 from fingerprint import fingerprint_file, read_audio_file, fingerprint_audio
-from recognize import recognize_song, get_matches, best_match, get_info_for_song_id
+from recognize import (recognize_song, get_matches, best_match, get_info_for_song_id, progressive_match,
+                       time_batches, best_of)
+from storage import get_spectrogram_params
+from peak_cache import PeakCache
 
 
 def str2bool(v):
@@ -37,6 +41,27 @@ def get_args():
     parser.add_argument("--target_t", type=float, default=1.8)
     parser.add_argument("--target_f", type=int, default=4000)
     parser.add_argument("--target_start", type=float, default=0.05)
+    # default to the front end, hop and highest frequency the database was built with
+    parser.add_argument("--front_end", type=str, default=None)
+    parser.add_argument("--hop_length", type=int, default=None)
+    parser.add_argument("--max_freq", type=float, default=None)
+    # hashes found in more songs than this are stop words and are not looked up
+    parser.add_argument("--max_df", type=int, default=None)
+    # look up the query a batch at a time and stop once the best song leads by min_margin votes
+    parser.add_argument("--progressive", action="store_true")
+    parser.add_argument("--batch_seconds", type=float, default=1.0)
+    parser.add_argument("--min_margin", type=int, default=20)
+    # fingerprint a long query in segments of segment_seconds over this many processes
+    parser.add_argument("--segment_workers", type=int, default=0)
+    parser.add_argument("--segment_seconds", type=float, default=300.0)
+    # reuse decoded peaks across runs and parameter sweeps of the target zone
+    parser.add_argument("--cache_dir", type=str, default=None)
+    parser.add_argument("--cache_max_mb", type=int, default=2048)
+    # record per-stage timings and counters, written to this path at the end, a .prom path gets Prometheus text
+    parser.add_argument("--metrics", type=str, default=None)
+    # also profile 1 call in profile_every of each stage
+    parser.add_argument("--profile", type=str, default=None, choices=metrics.PROFILERS)
+    parser.add_argument("--profile_every", type=int, default=100)
 
     args = parser.parse_args()
 
@@ -56,23 +81,51 @@ if __name__ == '__main__':
     target_t = args.target_t
     target_f = args.target_f
     target_start = args.target_start
+    spectrogram_params = get_spectrogram_params(db_path, front_end=args.front_end, hop_length=args.hop_length,
+                                                max_freq=args.max_freq)
+    max_df = args.max_df
+    stats = {}
+    cache = None if args.cache_dir is None else PeakCache(args.cache_dir, max_bytes=args.cache_max_mb * 1024 ** 2)
 
     assert 0. < fft_window_size < 1.
     assert 0. < point_efficiency <= 1.
 
+    if args.metrics is not None or args.profile is not None:
+        metrics.enable(profiler=args.profile, profile_every=args.profile_every)
+
     if song_mode:
         song = recognize_song(filename=query_song, db_path=db_path, sample_rate=sample_rate, fft_window_size=fft_window_size,
                               peak_box_size=peak_box_size, point_efficiency=point_efficiency, target_t=target_t,
-                              target_f=target_f, target_start=target_start, threshold=5)
+                              target_f=target_f, target_start=target_start, threshold=5, cache=cache,
+                              max_df=max_df, stats=stats, progressive=args.progressive,
+                              batch_seconds=args.batch_seconds, min_margin=args.min_margin,
+                              segment_workers=args.segment_workers, segment_seconds=args.segment_seconds,
+                              **spectrogram_params)
         print("Song mode, recognized song: {}".format(song))
 
     else:
         audio, sr = read_audio_file(audio_path=query_song, sr_desired=sample_rate)
         hashes = fingerprint_audio(frames=audio, sample_rate=sample_rate, fft_window_size=fft_window_size,
                                    peak_box_size=peak_box_size, point_efficiency=point_efficiency, target_t=target_t,
-                                   target_f=target_f, target_start=target_start)
-        matches = get_matches(hashes=hashes, db_path=db_path, threshold=5)
-        matched_song = best_match(matches=matches)
+                                   target_f=target_f, target_start=target_start, **spectrogram_params)
+        if args.progressive:
+            ranked = progressive_match(time_batches(hashes, batch_seconds=args.batch_seconds), db_path=db_path,
+                                       min_margin=args.min_margin, max_df=max_df, stats=stats)
+            matched_song = best_of(ranked)
+            stats["query_seconds"] = len(audio) / sample_rate
+        else:
+            matches = get_matches(hashes=hashes, db_path=db_path, threshold=5, max_df=max_df, stats=stats)
+            matched_song = best_match(matches=matches)
         song = get_info_for_song_id(song_id=matched_song, db_path=db_path)
 
         print("Audio mode, recognized song: {}".format(song))
+
+    if max_df is not None:
+        # nothing is looked up for a query without hashes
+        print("Dropped {} stop-word hashes, skipped {} rows".format(stats.get("stop_hashes", 0),
+                                                                    stats.get("rows_skipped", 0)))
+    if args.progressive:
+        print("Used {:.1f} of {:.1f} seconds of the query, {} hashes".format(
+            stats["used_seconds"], stats.get("query_seconds", stats["used_seconds"]), stats["hashes_used"]))
+    if metrics.is_enabled():
+        metrics.dump(args.metrics or "-")
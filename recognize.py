@@ -1,109 +1,159 @@
-import os
 import logging
-from multiprocessing import Pool, Lock, current_process, Manager
-from functools import partial
-import numpy as np
-from tinytag import TinyTag
-from record import record_audio
-from fingerprint import fingerprint_file, fingerprint_audio
-from storage import store_song, get_matches, get_info_for_song_id, song_in_db, checkpoint_db
-
-KNOWN_EXTENSIONS = ["mp3", "wav", "flac", "m4a"]
-
+from itertools import islice
 
-def get_song_info(filename):
-    tag = TinyTag.get(filename)
-    artist = tag.artist if tag.albumartist is None else tag.albumartist
-    return (artist, tag.album, tag.title)
+import numpy as np
+from multiprocessing import current_process
+import metrics
+from fingerprint import (fingerprint_file, fingerprint_file_stream, fingerprint_audio, stream_spectrogram,
+                         iter_live_peaks, iter_live_hashes, TIME_RESOLUTION, SEGMENT_SECONDS)
+from storage import store_song, get_matches, get_info_for_song_id, song_in_db, get_spectrogram_params
+from spectrogram import DEFAULT_FRONT_END, spectrogram_plan
+from matching import Matches, score_matches, vote_counts, add_votes, rank_votes
 
 
 def register_song(filename, db_path, sample_rate, fft_window_size, peak_box_size,
-                  point_efficiency, target_t, target_f, target_start, lock):
+                  point_efficiency, target_t, target_f, target_start, lock=None, streaming=False, cache=None,
+                  front_end=DEFAULT_FRONT_END, hop_length=None, max_freq=None):
     if song_in_db(filename, db_path=db_path):
         print("Song: {} already in database".format(filename))
         return
-    hashes = fingerprint_file(filename, sample_rate=sample_rate, fft_window_size=fft_window_size,
-                              peak_box_size=peak_box_size,
-                              point_efficiency=point_efficiency, target_t=target_t,
-                              target_f=target_f, target_start=target_start)
+    if streaming:
+        # the hash batches are small next to the decoded audio, collect them before taking the write lock
+        hashes = list(fingerprint_file_stream(filename, sample_rate=sample_rate, fft_window_size=fft_window_size,
+                                              peak_box_size=peak_box_size, point_efficiency=point_efficiency,
+                                              target_t=target_t, target_f=target_f, target_start=target_start,
+                                              cache=cache, hop_length=hop_length, max_freq=max_freq,
+                                              front_end=front_end))
+    else:
+        hashes = fingerprint_file(filename, sample_rate=sample_rate, fft_window_size=fft_window_size,
+                                  peak_box_size=peak_box_size,
+                                  point_efficiency=point_efficiency, target_t=target_t,
+                                  target_f=target_f, target_start=target_start, cache=cache, hop_length=hop_length,
+                                  max_freq=max_freq, front_end=front_end)
+    from ingest import get_song_info
+
     song_info = get_song_info(filename)
-    try:
-        logging.info(f"{current_process().name} waiting to write {filename}")
-        lock.acquire()
-        logging.info(f"{current_process().name} writing {filename}")
-        store_song(hashes, song_info, db_path=db_path)
-        logging.info(f"{current_process().name} wrote {filename}")
-        lock.release()
-    except NameError:
+    if lock is None:
         logging.info(f"Single-threaded write of {filename}")
         # running single-threaded, no lock needed
         store_song(hashes, song_info, db_path=db_path)
-    #store_song(hashes=hashes, song_info=song_info, db_path=db_path)
+        return
+    logging.info(f"{current_process().name} waiting to write {filename}")
+    # released even if the write raises
+    with lock:
+        logging.info(f"{current_process().name} writing {filename}")
+        store_song(hashes, song_info, db_path=db_path)
+        logging.info(f"{current_process().name} wrote {filename}")
 
 
 def register_directory(path, num_workers, db_path, sample_rate, fft_window_size, peak_box_size,
-                       point_efficiency, target_t, target_f, target_start):
-    #def pool_init(l):
-    #    global lock
-    #    lock = l
-    #    logging.info(f"Pool init in {current_process().name}")
-
-    to_register = []
-    for root, _, files in os.walk(path):
-        for f in files:
-            if f.split('.')[-1] not in KNOWN_EXTENSIONS:
-                continue
-            file_path = os.path.join(path, root, f)
-            to_register.append(file_path)
-    #l = Lock()
-    m = Manager()
-    l = m.Lock()
-    register_a_song = partial(register_song, db_path=db_path, sample_rate=sample_rate, fft_window_size=fft_window_size,
-                              peak_box_size=peak_box_size,
-                              point_efficiency=point_efficiency, target_t=target_t, target_f=target_f,
-                              target_start=target_start, lock=l)
-    #with Pool(processes=num_workers, initializer=pool_init, initargs=(l,)) as p:
-    #    p.map(register_a_song, to_register)
-    print("Number of song: {}".format(len(to_register)))
-    with Pool(processes=num_workers) as p:
-        p.map(register_a_song, to_register)
-    # speed up future reads
-    checkpoint_db(db_path=db_path)
-
-
-def score_match(offsets):
-    # Use bins spaced 0.5 seconds apart
-    binwidth = 0.5
-    tks = list(map(lambda x: x[0] - x[1], offsets))
-    hist, _ = np.histogram(tks,
-                           bins=np.arange(int(min(tks)),
-                                          int(max(tks)) + binwidth + 1,
-                                          binwidth))
-    return np.max(hist)
+                       point_efficiency, target_t, target_f, target_start, streaming=False,
+                       songs_per_transaction=50, bulk_import=False, cache=None, front_end=DEFAULT_FRONT_END,
+                       sync=False, file_timeout=None, retries=1, tasks_per_worker=100, failure_report=None,
+                       hop_length=None, max_freq=None):
+    # workers only decode and fingerprint, a single writer process batches songs into transactions,
+    # imported here so queries don't load the ingest pipeline
+    from ingest import ingest_directory
 
+    return ingest_directory(path=path, num_workers=num_workers, db_path=db_path, sample_rate=sample_rate,
+                            fft_window_size=fft_window_size, peak_box_size=peak_box_size,
+                            point_efficiency=point_efficiency, target_t=target_t, target_f=target_f,
+                            target_start=target_start, streaming=streaming,
+                            songs_per_transaction=songs_per_transaction, bulk_import=bulk_import, cache=cache,
+                            front_end=front_end, sync=sync, file_timeout=file_timeout, retries=retries,
+                            tasks_per_worker=tasks_per_worker, failure_report=failure_report, hop_length=hop_length,
+                            max_freq=max_freq)
 
-def best_match(matches):
-    matched_song = None
-    best_score = 0
-    for song_id, offsets in matches.items():
-        if len(offsets) < best_score:
-            # can't be best score, avoid expensive histogram
+
+# Use bins spaced 0.5 seconds apart
+BINWIDTH = int(round(0.5 / TIME_RESOLUTION))
+
+
+def rank_matches(matches, top_k=1):
+    song_ids, scores, offsets = score_matches(matches, binwidth=BINWIDTH, top_k=top_k)
+    return ranked_list(song_ids, scores, offsets)
+
+
+def ranked_list(song_ids, scores, offsets):
+    # (song_id, score, position of the query inside the song in seconds), best first
+    return list(zip(song_ids.tolist(), scores.tolist(), (offsets * TIME_RESOLUTION).tolist()))
+
+
+def time_batches(hashes, batch_seconds):
+    """Split a Fingerprint into consecutive batch_seconds long batches, in query time order."""
+    order = np.argsort(hashes.offsets, kind="stable")
+    batch = np.asarray(hashes.offsets)[order] // int(round(batch_seconds / TIME_RESOLUTION))
+    for rows in np.split(order, np.flatnonzero(np.diff(batch)) + 1):
+        yield hashes._replace(hashes=np.asarray(hashes.hashes)[rows], offsets=np.asarray(hashes.offsets)[rows])
+
+
+def progressive_match(batches, db_path, min_margin=20, top_k=1, max_df=None, stats=None):
+    """Match time-ordered Fingerprint batches until the best song is clearly ahead.
+
+    The offset histograms of all candidate songs grow batch by batch, and matching stops
+    as soon as the leading song has min_margin more aligned votes than the runner-up.
+    stats, if given, gets the query time used in "used_seconds" and the hashes used in
+    "hashes_used". Returns the ranked top_k songs.
+    """
+    keys = np.empty(0, dtype=np.int64)
+    counts = np.empty(0, dtype=np.int64)
+    ranked = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+    used = 0
+    hashes_used = 0
+    for batch in batches:
+        if len(batch.hashes) == 0:
             continue
-        score = score_match(offsets)
-        if score > best_score:
-            best_score = score
-            matched_song = song_id
-    return matched_song
+        used = max(used, int(np.max(batch.offsets)))
+        hashes_used += len(batch.hashes)
+        matches = get_matches(hashes=batch, db_path=db_path, max_df=max_df, stats=stats)
+        with metrics.stage("scoring"):
+            keys, counts = add_votes(keys, counts, *vote_counts(matches, binwidth=BINWIDTH))
+            ranked = rank_votes(keys, counts, binwidth=BINWIDTH, top_k=max(top_k, 2))
+        scores = ranked[1]
+        if len(scores) > 0 and scores[0] - (scores[1] if len(scores) > 1 else 0) >= min_margin:
+            break
+    if stats is not None:
+        stats["used_seconds"] = used * TIME_RESOLUTION
+        stats["hashes_used"] = hashes_used
+    return ranked_list(*(column[:top_k] for column in ranked))
+
+
+def best_match(matches):
+    ranked = rank_matches(matches, top_k=1)
+    if len(ranked) < 1:
+        return None
+    return ranked[0][0]
+
+
+def best_of(ranked):
+    return ranked[0][0] if ranked else None
 
 
 def recognize_song(filename, sample_rate, fft_window_size, peak_box_size,
-                   point_efficiency, target_t, target_f, target_start, db_path, threshold):
-    hashes = fingerprint_file(filename=filename, sample_rate=sample_rate,
-                              fft_window_size=fft_window_size, peak_box_size=peak_box_size,
-                              point_efficiency=point_efficiency, target_t=target_t,
-                              target_f=target_f, target_start=target_start)
-    matches = get_matches(hashes=hashes, db_path=db_path, threshold=threshold)
-    matched_song = best_match(matches=matches)
+                   point_efficiency, target_t, target_f, target_start, db_path, threshold, cache=None,
+                   front_end=None, max_df=None, stats=None, progressive=False, batch_seconds=1.0, min_margin=20,
+                   hop_length=None, max_freq=None, segment_workers=0, segment_seconds=SEGMENT_SECONDS):
+    # by default, the spectrogram parameters the database was built with
+    params = get_spectrogram_params(db_path, front_end=front_end, hop_length=hop_length, max_freq=max_freq)
+    fingerprint_params = dict(filename=filename, sample_rate=sample_rate, fft_window_size=fft_window_size,
+                              peak_box_size=peak_box_size, point_efficiency=point_efficiency, target_t=target_t,
+                              target_f=target_f, target_start=target_start, cache=cache, **params)
+    if segment_workers > 1:
+        # a long query's spectrogram segments over a pool, the hashes are those of the serial path
+        from multiprocessing import Pool
+        with Pool(processes=segment_workers) as p:
+            hashes = fingerprint_file(executor=p, segment_seconds=segment_seconds, **fingerprint_params)
+    else:
+        hashes = fingerprint_file(**fingerprint_params)
+    if progressive:
+        # stop fetching as soon as the query has clearly matched
+        matched_song = best_of(progressive_match(time_batches(hashes, batch_seconds=batch_seconds), db_path=db_path,
+                                                 min_margin=min_margin, max_df=max_df, stats=stats))
+        if stats is not None and len(hashes.offsets):
+            stats["query_seconds"] = int(np.max(hashes.offsets)) * TIME_RESOLUTION
+    else:
+        matches = get_matches(hashes=hashes, db_path=db_path, threshold=threshold, max_df=max_df, stats=stats)
+        matched_song = best_match(matches=matches)
     info = get_info_for_song_id(song_id=matched_song, db_path=db_path)
     if info is not None:
         return info
@@ -112,15 +162,105 @@ def recognize_song(filename, sample_rate, fft_window_size, peak_box_size,
 
 def listen_to_song(filename, format, channels, rate, chunk, record_seconds,
                    sample_rate, fft_window_size, peak_box_size, point_efficiency, target_t, target_f, target_start,
-                   db_path, threshold=5):
+                   db_path, threshold=5, front_end=None, progressive=False, batch_seconds=1.0, min_margin=20,
+                   stats=None, hop_length=None, max_freq=None):
+    # pyaudio is only loaded to record
+    from record import record_audio, stream_audio
+
+    params = get_spectrogram_params(db_path, front_end=front_end, hop_length=hop_length, max_freq=max_freq)
+    if progressive:
+        # fingerprint while recording and stop listening once the song is clear, filename is not written
+        capture = stream_audio(rate=rate, chunk=chunk, format=format, channels=channels)
+        try:
+            ranked = listen_progressive(islice(capture, int(rate / chunk * record_seconds)), db_path=db_path,
+                                        sample_rate=sample_rate, fft_window_size=fft_window_size,
+                                        peak_box_size=peak_box_size, point_efficiency=point_efficiency,
+                                        target_t=target_t, target_f=target_f, target_start=target_start,
+                                        min_margin=min_margin, batch_seconds=batch_seconds, stats=stats, **params)
+        finally:
+            capture.close()
+        matched_song = best_of(ranked)
+        info = get_info_for_song_id(matched_song, db_path=db_path)
+        return info if info is not None else matched_song
     audio = record_audio(filename=filename, format=format, channels=channels,
                          rate=rate, chunk=chunk, record_seconds=record_seconds)
     hashes = fingerprint_audio(frames=audio, sample_rate=sample_rate, fft_window_size=fft_window_size,
                                peak_box_size=peak_box_size, point_efficiency=point_efficiency,
-                               target_t=target_t, target_f=target_f, target_start=target_start)
+                               target_t=target_t, target_f=target_f, target_start=target_start, **params)
     matches = get_matches(hashes=hashes, db_path=db_path)
     matched_song = best_match(matches=matches)
     info = get_info_for_song_id(matched_song, db_path=db_path)
     if info is not None:
         return info
     return matched_song
+
+
+def listen_progressive(blocks, db_path, sample_rate, fft_window_size, peak_box_size, point_efficiency, target_t,
+                       target_f, target_start, min_margin=20, top_k=1, batch_seconds=1.0, hop_length=None,
+                       max_freq=None, front_end=None, max_df=None, stats=None):
+    """Fingerprint captured audio as it arrives and match it progressively, see progressive_match.
+
+    Peaks are picked in runs of batch_seconds, and blocks are only read until the match is
+    clear. stats also gets the audio read in "captured_seconds".
+    """
+    params = get_spectrogram_params(db_path, front_end=front_end, hop_length=hop_length, max_freq=max_freq)
+    plan = spectrogram_plan(sample_rate, fft_window_size, **params)
+    captured = 0
+
+    def count_samples(blocks):
+        nonlocal captured
+        for block in blocks:
+            captured += len(block)
+            yield block
+
+    spectrogram_blocks = stream_spectrogram(count_samples(blocks), sample_rate=sample_rate,
+                                            fft_window_size=fft_window_size, **params)
+    live_peaks = iter_live_peaks(spectrogram_blocks, peak_box_size=peak_box_size, point_efficiency=point_efficiency,
+                                 run_columns=max(1, int(round(batch_seconds * sample_rate / plan.hop_length))))
+    live_hashes = iter_live_hashes(live_peaks, target_t=target_t, target_f=target_f, target_start=target_start)
+    ranked = progressive_match(live_hashes, db_path=db_path, min_margin=min_margin, top_k=top_k, max_df=max_df,
+                               stats=stats)
+    if stats is not None:
+        stats["captured_seconds"] = captured / sample_rate
+    return ranked
+
+
+def recognize_stream(blocks, db_path, sample_rate, fft_window_size, peak_box_size, point_efficiency, target_t,
+                     target_f, target_start, min_score=20, memory_seconds=10.0, hop_length=None, max_freq=None,
+                     front_end=None):
+    """Recognize continuous audio, yielding an event dict whenever the song playing changes.
+
+    Only newly arrived audio is fingerprinted and looked up. Its matches join the votes of
+    the last memory_seconds of the stream, so a song is announced as soon as its aligned
+    score reaches min_score, and reported gone once it drops below.
+    """
+    params = get_spectrogram_params(db_path, front_end=front_end, hop_length=hop_length, max_freq=max_freq)
+    spectrogram_blocks = stream_spectrogram(blocks, sample_rate=sample_rate, fft_window_size=fft_window_size, **params)
+    live_peaks = iter_live_peaks(spectrogram_blocks, peak_box_size=peak_box_size,
+                                 point_efficiency=point_efficiency)
+    votes = Matches(song_ids=np.empty(0, dtype=np.int64), db_offsets=np.empty(0, dtype=np.int64),
+                    query_offsets=np.empty(0, dtype=np.int64))
+    playing = None
+    memory = int(round(memory_seconds / TIME_RESOLUTION))
+    for hashes in iter_live_hashes(live_peaks, target_t=target_t, target_f=target_f, target_start=target_start):
+        if len(hashes.hashes) == 0:
+            continue
+        matches = get_matches(hashes=hashes, db_path=db_path)
+        now = int(hashes.offsets.max())
+        keep = np.concatenate((votes.query_offsets, matches.query_offsets)) > now - memory
+        votes = Matches(*(np.concatenate((old, new))[keep] for old, new in zip(votes, matches)))
+        ranked = rank_matches(votes, top_k=1)
+        song_id, score, offset = ranked[0] if ranked else (None, 0, 0.0)
+        if score < min_score:
+            song_id = None
+        if song_id == playing:
+            continue
+        if playing is not None:
+            yield {"event": "ended", "time": now * TIME_RESOLUTION, "song_id": playing}
+        if song_id is not None:
+            info = get_info_for_song_id(song_id=song_id, db_path=db_path)
+            artist, album, title = info if info is not None else (None, None, None)
+            # offset is where the song was at the start of the stream
+            yield {"event": "now_playing", "time": now * TIME_RESOLUTION, "song_id": song_id, "artist": artist,
+                   "album": album, "title": title, "score": score, "position": offset + now * TIME_RESOLUTION}
+        playing = song_id
@@ -55,6 +55,19 @@ def record_audio(filename, format, channels, rate, chunk, record_seconds):
     return np.hstack(frames)
 
 
+def stream_audio(rate, chunk, format=pyaudio.paInt16, channels=1, stop_event=None):
+    """Yield the microphone input chunk by chunk, in memory, until stop_event is set."""
+    p = pyaudio.PyAudio()
+    stream = p.open(format=format, channels=channels, rate=rate, input=True, frames_per_buffer=chunk)
+    try:
+        while stop_event is None or not stop_event.is_set():
+            yield np.frombuffer(stream.read(chunk), dtype=np.int16)
+    finally:
+        stream.stop_stream()
+        stream.close()
+        p.terminate()
+
+
 class RecordThread(threading.Thread):
     def __init__(self, base_filename, rate, chunk, format, channels, save_directory,
                  piece_len=10, spacing=5):
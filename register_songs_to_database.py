@@ -3,7 +3,9 @@ import argparse
 import warnings
 warnings.filterwarnings("ignore")
 
-from storage import setup_db
+import metrics
+from storage import setup_db, get_spectrogram_params
+from peak_cache import PeakCache
 from recognize import register_directory
 
 
@@ -20,6 +22,38 @@ def get_args():
     parser.add_argument("--target_t", type=float, default=1.8)
     parser.add_argument("--target_f", type=int, default=4000)
     parser.add_argument("--target_start", type=float, default=0.05)
+    # spectrogram front end: linear, log, mel or logband, band counts as a suffix (mel256)
+    parser.add_argument("--front_end", type=str, default=None)
+    # spectrogram hop in samples, 7/8 of the window by default, and the highest frequency kept in Hz, all by
+    # default. Saved with the database like the front end, queries use the same values. Adding songs to an
+    # existing database defaults all three to the values it was built with
+    parser.add_argument("--hop_length", type=int, default=None)
+    parser.add_argument("--max_freq", type=float, default=None)
+    # only used when db_path is a .shards directory, hash rows are split across this many files
+    parser.add_argument("--num_shards", type=int, default=None)
+    # reuse decoded peaks across runs and parameter sweeps of the target zone
+    parser.add_argument("--cache_dir", type=str, default=None)
+    parser.add_argument("--cache_max_mb", type=int, default=2048)
+    # decode and fingerprint in blocks, for very long recordings
+    parser.add_argument("--streaming", action="store_true")
+    # first import of a large catalogue: no index while loading, bulk pragmas, index built at the end
+    parser.add_argument("--bulk_import", action="store_true")
+    # track files by path, size and mtime: fingerprint new and changed files, remove the songs of deleted ones
+    parser.add_argument("--sync", action="store_true")
+    # a file that takes longer to decode and fingerprint fails, 0 for no limit
+    parser.add_argument("--file_timeout", type=float, default=600.0)
+    # failed files are tried again this many times once the others are done
+    parser.add_argument("--retries", type=int, default=1)
+    # workers are replaced after this many files, bounding memory that decoders leak
+    parser.add_argument("--tasks_per_worker", type=int, default=100)
+    # files that failed on their last attempt and why, as JSON. Without it, a report is only written
+    # to failed_songs.json when a file failed
+    parser.add_argument("--failure_report", type=str, default=None)
+    # record per-stage timings and counters, written to this path at the end, a .prom path gets Prometheus text
+    parser.add_argument("--metrics", type=str, default=None)
+    # also profile 1 call in profile_every of each stage
+    parser.add_argument("--profile", type=str, default=None, choices=metrics.PROFILERS)
+    parser.add_argument("--profile_every", type=int, default=100)
 
     args = parser.parse_args()
 
@@ -39,11 +73,28 @@ if __name__ == '__main__':
     target_t = args.target_t
     target_f = args.target_f
     target_start = args.target_start
+    cache = None if args.cache_dir is None else PeakCache(args.cache_dir, max_bytes=args.cache_max_mb * 1024 ** 2)
+    streaming = args.streaming
+    bulk_import = args.bulk_import
+    spectrogram_params = get_spectrogram_params(db_path, front_end=args.front_end, hop_length=args.hop_length,
+                                                max_freq=args.max_freq)
 
     assert 0. < fft_window_size < 1.
     assert 0. < point_efficiency <= 1.
+    assert args.retries >= 0
 
-    setup_db(db_path=db_path)
+    if args.metrics is not None or args.profile is not None:
+        # before the workers fork, so they record too
+        metrics.enable(profiler=args.profile, profile_every=args.profile_every)
+
+    setup_db(db_path=db_path, bulk=bulk_import, num_shards=args.num_shards, **spectrogram_params)
     register_directory(path=song_dir, num_workers=num_workers, db_path=db_path, sample_rate=sample_rate,
                        fft_window_size=fft_window_size, peak_box_size=peak_box_size, point_efficiency=point_efficiency,
-                       target_t=target_t, target_f=target_f, target_start=target_start)
+                       target_t=target_t, target_f=target_f, target_start=target_start, streaming=streaming,
+                       bulk_import=bulk_import, cache=cache, sync=args.sync,
+                       file_timeout=args.file_timeout or None, retries=args.retries,
+                       tasks_per_worker=args.tasks_per_worker or None, failure_report=args.failure_report,
+                       **spectrogram_params)
+
+    if metrics.is_enabled():
+        metrics.dump(args.metrics or "-")
@@ -0,0 +1,78 @@
+import os
+import time
+import sqlite3
+import argparse
+
+import numpy as np
+
+from storage import (setup_db, get_spectrogram_params, songs_db_path, hash_db_paths, insert_hash_rows, begin_bulk_load,
+                     finish_bulk_load, build_hash_df, get_cursor)
+from shards import split_by_shard
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    # a single SQLite file or a .shards directory
+    parser.add_argument("--db_path", type=str, default="music.sqlite")
+    # a new .shards directory
+    parser.add_argument("--out_path", type=str, default="music.shards")
+    parser.add_argument("--num_shards", type=int, default=8)
+    parser.add_argument("--chunk_size", type=int, default=1 << 20)
+
+    args = parser.parse_args()
+
+    return args
+
+
+def reshard_db(db_path, out_path, num_shards, chunk_size=1 << 20):
+    """Copy a database into a new sharded database, song_ids and tracked files are kept."""
+    setup_db(db_path=out_path, bulk=True, num_shards=num_shards, **get_spectrogram_params(db_path))
+    with get_cursor(db_path=songs_db_path(out_path)) as (conn, c):
+        if c.execute("SELECT 1 FROM song_info LIMIT 1").fetchone() is not None:
+            raise ValueError("{} is not empty".format(out_path))
+        c.execute("ATTACH DATABASE ? AS source", (songs_db_path(db_path),))
+        c.execute("INSERT INTO song_info SELECT song_id, artist, album, title, uuid FROM source.song_info")
+        # the files --sync tracks, and removed songs whose copied hash rows the next ingest purges
+        source_tables = {row[0] for row in c.execute("SELECT name FROM source.sqlite_master WHERE type = 'table'")}
+        if "song_files" in source_tables:
+            c.execute("INSERT INTO song_files SELECT path, size, mtime_ns, song_id FROM source.song_files")
+        if "stale_songs" in source_tables:
+            c.execute("INSERT INTO stale_songs SELECT song_id FROM source.stale_songs")
+        conn.commit()
+        c.execute("DETACH DATABASE source")
+
+    shards = [sqlite3.connect(database=path, timeout=30) for path in hash_db_paths(out_path)]
+    cursors = [shard.cursor() for shard in shards]
+    for c in cursors:
+        begin_bulk_load(c)
+    count = 0
+    for source_path in hash_db_paths(db_path):
+        source = sqlite3.connect(database=source_path, timeout=30)
+        rows = source.execute("SELECT hash, offset, song_id FROM hash")
+        while True:
+            chunk = np.array(rows.fetchmany(chunk_size), dtype=np.int64).reshape(-1, 3)
+            if len(chunk) < 1:
+                break
+            for shard, c, shard_rows in zip(shards, cursors, split_by_shard(len(shards), *chunk.T)):
+                insert_hash_rows(c, *shard_rows)
+                shard.commit()
+            count += len(chunk)
+        source.close()
+    for shard, c in zip(shards, cursors):
+        finish_bulk_load(c)
+        shard.close()
+    build_hash_df(out_path)
+    return count
+
+
+if __name__ == '__main__':
+    args = get_args()
+
+    assert os.path.abspath(args.db_path) != os.path.abspath(args.out_path)
+
+    start = time.perf_counter()
+    count = reshard_db(db_path=args.db_path, out_path=args.out_path, num_shards=args.num_shards,
+                       chunk_size=args.chunk_size)
+    print("Copied {} hashes into {} shards in {:.1f} seconds".format(count, args.num_shards,
+                                                                    time.perf_counter() - start))
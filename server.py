@@ -0,0 +1,238 @@
+import sys
+import json
+import time
+import asyncio
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+import warnings
+warnings.filterwarnings("ignore")
+
+import numpy as np
+
+from decode import decode_bytes, convert_audio, DecodeError
+from fingerprint import fingerprint_audio
+from storage import get_info_for_song_id, get_spectrogram_params
+from batch_query import recognize_batch, describe_matches
+
+# Recognition service: POST a clip to /recognize, GET /metrics for latency percentiles.
+# The clip is an encoded file (WAV, MP3, ...) or raw little-endian 16-bit mono PCM when
+# the request has ?format=pcm, with ?rate=<sample rate> if it differs from --sample_rate.
+
+MAX_BODY_BYTES = 64 * 1024 * 1024
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--db_path", type=str, default=None)
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    # listen on a Unix socket instead of TCP
+    parser.add_argument("--unix_socket", type=str, default=None)
+    parser.add_argument("--num_workers", type=int, default=4)
+    # requests fingerprinted within this window share one database lookup
+    parser.add_argument("--batch_window_ms", type=float, default=20.0)
+    parser.add_argument("--max_batch_size", type=int, default=64)
+    parser.add_argument("--top_k", type=int, default=1)
+    # hashes found in more songs than this are stop words and are not looked up
+    parser.add_argument("--max_df", type=int, default=None)
+    parser.add_argument("--sample_rate", type=int, default=44100)
+    parser.add_argument("--fft_window_size", type=float, default=0.2)
+    parser.add_argument("--peak_box_size", type=int, default=30)
+    parser.add_argument("--point_efficiency", type=float, default=0.8)
+    parser.add_argument("--target_t", type=float, default=1.8)
+    parser.add_argument("--target_f", type=int, default=4000)
+    parser.add_argument("--target_start", type=float, default=0.05)
+    # default to the front end, hop and highest frequency the database was built with
+    parser.add_argument("--front_end", type=str, default=None)
+    parser.add_argument("--hop_length", type=int, default=None)
+    parser.add_argument("--max_freq", type=float, default=None)
+
+    args = parser.parse_args()
+
+    return args
+
+
+def fingerprint_clip(data, pcm, rate, sample_rate, fingerprint_params):
+    # runs in a pool worker
+    if pcm:
+        frames = convert_audio(np.frombuffer(data[:len(data) // 2 * 2], np.int16), rate, sample_rate)
+    else:
+        frames = decode_bytes(data, sample_rate=sample_rate)
+    return fingerprint_audio(frames, sample_rate=sample_rate, **fingerprint_params)
+
+
+def warm_up(sample_rate, fingerprint_params):
+    # a second of noise pulls in the imports and first-call setup before the first request
+    noise = np.random.default_rng(0).integers(-1000, 1000, sample_rate).astype(np.int16)
+    fingerprint_audio(noise, sample_rate=sample_rate, **fingerprint_params)
+    return True
+
+
+class RecognitionServer:
+    def __init__(self, db_path, num_workers, batch_window_ms, max_batch_size, top_k, sample_rate,
+                 fingerprint_params, latency_window=10000, max_df=None):
+        self.db_path = db_path
+        self.batch_window = batch_window_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self.top_k = top_k
+        self.max_df = max_df
+        self.sample_rate = sample_rate
+        self.fingerprint_params = fingerprint_params
+        self.num_workers = num_workers
+        self.workers = ProcessPoolExecutor(max_workers=num_workers)
+        # one thread keeps the database connection and its page cache warm
+        self.db_thread = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+        self.fingerprinting = 0
+        self.latencies = deque(maxlen=latency_window)
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.rows_skipped = 0
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.workers, warm_up, self.sample_rate, self.fingerprint_params)
+                               for _ in range(self.num_workers)])
+        await loop.run_in_executor(self.db_thread, get_info_for_song_id, 0, self.db_path)
+        self.pending = asyncio.Queue()
+        self.batcher = asyncio.ensure_future(self.run_batches())
+
+    async def recognize(self, data, pcm, rate):
+        loop = asyncio.get_running_loop()
+        self.fingerprinting += 1
+        try:
+            fingerprint = await loop.run_in_executor(self.workers, fingerprint_clip,
+                                                     data, pcm, rate or self.sample_rate, self.sample_rate,
+                                                     self.fingerprint_params)
+        finally:
+            self.fingerprinting -= 1
+        result = loop.create_future()
+        await self.pending.put((fingerprint, result))
+        return await result
+
+    async def run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.pending.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.pending.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.batches += 1
+            try:
+                results = await loop.run_in_executor(self.db_thread, self.lookup_batch,
+                                                     [fingerprint for fingerprint, _ in batch])
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+
+    def lookup_batch(self, fingerprints):
+        results = []
+        for _, ranked, stats in recognize_batch(list(enumerate(fingerprints)), db_path=self.db_path,
+                                                top_k=self.top_k, max_df=self.max_df):
+            results.append({"matches": describe_matches(ranked, db_path=self.db_path), **(stats or {})})
+            if stats is not None:
+                self.rows_skipped += stats.get("rows_skipped", 0)
+        return results
+
+    def metrics(self):
+        latencies = np.array(self.latencies) * 1000.0
+        percentiles = np.percentile(latencies, [50, 90, 99]).tolist() if len(latencies) else [None] * 3
+        return {"requests": self.requests, "errors": self.errors, "batches": self.batches,
+                "rows_skipped": self.rows_skipped,
+                "fingerprint_queue_depth": self.fingerprinting, "lookup_queue_depth": self.pending.qsize(),
+                "latency_ms": dict(zip(["p50", "p90", "p99"], percentiles))}
+
+    async def handle(self, reader, writer):
+        try:
+            status, body = await self.handle_request(reader)
+        except Exception as e:
+            self.errors += 1
+            status, body = "500 Internal Server Error", {"error": repr(e)}
+        payload = json.dumps(body, ensure_ascii=False).encode()
+        writer.write("HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n"
+                     "Connection: close\r\n\r\n".format(status, len(payload)).encode() + payload)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def handle_request(self, reader):
+        request_line = (await reader.readline()).decode("latin-1").split()
+        if len(request_line) < 2:
+            return "400 Bad Request", {"error": "malformed request"}
+        method, target = request_line[0], request_line[1]
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        url = urlsplit(target)
+        if method == "GET" and url.path == "/metrics":
+            return "200 OK", self.metrics()
+        if method != "POST" or url.path != "/recognize":
+            return "404 Not Found", {"error": "unknown endpoint"}
+        length = int(headers.get("content-length", 0))
+        if length > MAX_BODY_BYTES:
+            return "413 Payload Too Large", {"error": "clip too large"}
+        data = await reader.readexactly(length)
+        query = parse_qs(url.query)
+        pcm = query.get("format", [""])[0] == "pcm"
+        try:
+            rate = int(query["rate"][0]) if "rate" in query else None
+        except ValueError:
+            rate = 0
+        if rate is not None and rate <= 0:
+            return "400 Bad Request", {"error": "rate must be a positive integer"}
+        start = time.perf_counter()
+        self.requests += 1
+        try:
+            result = await self.recognize(data, pcm=pcm, rate=rate)
+        except DecodeError as e:
+            # the client sent something that isn't audio, not a fault of the server
+            return "400 Bad Request", {"error": str(e)}
+        self.latencies.append(time.perf_counter() - start)
+        return "200 OK", result
+
+
+async def serve(args):
+    fingerprint_params = dict(fft_window_size=args.fft_window_size, peak_box_size=args.peak_box_size,
+                              point_efficiency=args.point_efficiency, target_t=args.target_t,
+                              target_f=args.target_f, target_start=args.target_start,
+                              **get_spectrogram_params(args.db_path, front_end=args.front_end,
+                                                       hop_length=args.hop_length, max_freq=args.max_freq))
+    server = RecognitionServer(db_path=args.db_path, num_workers=args.num_workers,
+                               batch_window_ms=args.batch_window_ms, max_batch_size=args.max_batch_size,
+                               top_k=args.top_k, sample_rate=args.sample_rate, fingerprint_params=fingerprint_params,
+                               max_df=args.max_df)
+    await server.start()
+    if args.unix_socket is not None:
+        listener = await asyncio.start_unix_server(server.handle, path=args.unix_socket)
+    else:
+        listener = await asyncio.start_server(server.handle, host=args.host, port=args.port)
+    print("Listening on {}".format(args.unix_socket or "{}:{}".format(args.host, args.port)), file=sys.stderr)
+    async with listener:
+        await listener.serve_forever()
+
+
+if __name__ == '__main__':
+    args = get_args()
+
+    assert 0. < args.fft_window_size < 1.
+    assert 0. < args.point_efficiency <= 1.
+
+    asyncio.run(serve(args))
@@ -0,0 +1,36 @@
+import os
+
+import numpy as np
+
+# A sharded database is a directory: songs.sqlite holds song_info and meta, and the hash
+# table is partitioned by hash prefix across hash-000.sqlite ... hash-<N-1>.sqlite, so
+# each shard has its own writer and a small index.
+SHARD_SUFFIX = ".shards"
+DEFAULT_NUM_SHARDS = 8
+# shards are picked by the top bits of the hash: the anchor frequency and part of the target's
+SHARD_PREFIX_SHIFT = 16
+
+
+def is_sharded_path(db_path):
+    return str(db_path).rstrip("/\\").endswith(SHARD_SUFFIX)
+
+
+def catalog_path(db_path):
+    return os.path.join(db_path, "songs.sqlite")
+
+
+def shard_paths(db_path, num_shards):
+    return [os.path.join(db_path, "hash-{:03d}.sqlite".format(i)) for i in range(num_shards)]
+
+
+def shard_of(hashes, num_shards):
+    return (np.asarray(hashes, dtype=np.uint32) >> np.uint32(SHARD_PREFIX_SHIFT)) % np.uint32(num_shards)
+
+
+def split_by_shard(num_shards, hashes, *columns):
+    """Split hashes and their parallel columns into one tuple of arrays per shard."""
+    shard = shard_of(hashes, num_shards)
+    order = np.argsort(shard, kind="stable")
+    bounds = np.searchsorted(shard[order], np.arange(num_shards + 1))
+    arrays = [np.asarray(hashes)[order]] + [np.asarray(column)[order] for column in columns]
+    return [tuple(a[bounds[i]:bounds[i + 1]] for a in arrays) for i in range(num_shards)]
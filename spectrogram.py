@@ -0,0 +1,131 @@
+from functools import lru_cache
+from collections import namedtuple
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from scipy import fft
+
+import metrics
+
+# everything about a spectrogram that only depends on its parameters, bands maps the
+# rFFT bins to the output rows of a band front end
+SpectrogramPlan = namedtuple("SpectrogramPlan", ["nperseg", "hop_length", "window", "weights", "num_bins", "bands",
+                                                 "log_reference", "freqs"])
+
+# linear: STFT power, log: STFT power in dB, mel and logband: dB power in triangular bands
+# spaced on the mel scale or geometrically. Band front ends take their band count as a
+# suffix, "mel128", and default to DEFAULT_BANDS.
+FRONT_ENDS = ["linear", "log", "mel", "logband"]
+DEFAULT_FRONT_END = "linear"
+DEFAULT_BANDS = 256
+# dB front ends keep this range below full scale, quieter cells become 0 and are never peaks
+LOG_RANGE_DB = 80.0
+# lowest band edge of logband
+MIN_BAND_FREQ = 100.0
+
+
+def parse_front_end(front_end):
+    """Split a front end id into (kind, number of bands)."""
+    kind = front_end.rstrip("0123456789")
+    suffix = front_end[len(kind):]
+    if kind not in FRONT_ENDS or (suffix and kind in ("linear", "log")):
+        raise ValueError("Unknown front end {!r}, expected one of {}".format(front_end, FRONT_ENDS))
+    if kind in ("mel", "logband"):
+        return kind, int(suffix) if suffix else DEFAULT_BANDS
+    return kind, None
+
+
+def hz_to_mel(f):
+    return 2595.0 * np.log10(1.0 + np.asarray(f) / 700.0)
+
+
+def mel_to_hz(m):
+    return 700.0 * (10.0 ** (np.asarray(m) / 2595.0) - 1.0)
+
+
+def tukey_window(nperseg, alpha):
+    """The periodic Tukey window of scipy.signal.get_window(("tukey", alpha), nperseg).
+
+    Built here because importing scipy.signal costs more than a whole query.
+    """
+    if nperseg <= 1:
+        return np.ones(nperseg)
+    # a periodic window is the symmetric window one sample longer, without its last sample
+    m = nperseg + 1
+    n = np.arange(0, m)
+    width = int(np.floor(alpha * (m - 1) / 2.0))
+    n1 = n[0:width + 1]
+    n3 = n[m - width - 1:]
+    w1 = 0.5 * (1 + np.cos(np.pi * (-1 + 2.0 * n1 / alpha / (m - 1))))
+    w3 = 0.5 * (1 + np.cos(np.pi * (-2.0 / alpha + 1 + 2.0 * n3 / alpha / (m - 1))))
+    return np.concatenate((w1, np.ones(m - len(w1) - len(w3)), w3))[:-1]
+
+
+def triangular_bands(freqs, edges):
+    # only the band front ends need scipy.sparse
+    from scipy import sparse
+
+    # band i rises from edges[i] to edges[i + 1] and falls to edges[i + 2]
+    lo, center, hi = edges[:-2, None], edges[1:-1, None], edges[2:, None]
+    rising = (freqs - lo) / np.maximum(center - lo, 1e-9)
+    falling = (hi - freqs) / np.maximum(hi - center, 1e-9)
+    return sparse.csr_matrix(np.maximum(0.0, np.minimum(rising, falling)).astype(np.float32))
+
+
+@lru_cache(maxsize=32)
+def spectrogram_plan(sample_rate, fft_window_size, hop_length=None, max_freq=None, front_end=DEFAULT_FRONT_END):
+    """Window, bin weights, bands and frequency axis for one parameter set, built once.
+
+    The linear defaults match scipy.signal.spectrogram: a Tukey window, a hop of 7/8 of
+    the window and one-sided power spectral density. Bins above max_freq are dropped.
+    """
+    kind, num_bands = parse_front_end(front_end)
+    nperseg = int(sample_rate * fft_window_size)
+    if hop_length is None:
+        hop_length = nperseg - nperseg // 8
+    window = tukey_window(nperseg, 0.25)
+    freqs = fft.rfftfreq(nperseg, 1.0 / sample_rate)
+    # one-sided density doubles every bin but DC and, for an even window, Nyquist
+    weights = np.full(len(freqs), 2.0 / (sample_rate * (window * window).sum()))
+    weights[0] /= 2
+    if nperseg % 2 == 0:
+        weights[-1] /= 2
+    num_bins = len(freqs) if max_freq is None else int(np.searchsorted(freqs, max_freq, side="right"))
+    freqs = freqs[:num_bins]
+    bands = None
+    if kind == "mel":
+        edges = mel_to_hz(np.linspace(0.0, hz_to_mel(freqs[-1]), num_bands + 2))
+    elif kind == "logband":
+        edges = np.geomspace(MIN_BAND_FREQ, freqs[-1], num_bands + 2)
+    if kind in ("mel", "logband"):
+        bands = triangular_bands(freqs, edges)
+        freqs = edges[1:-1]
+    # power of a full-scale 16-bit sine in one bin
+    log_reference = None if kind == "linear" else (32767.0 * window.sum() / 2) ** 2 * weights[1]
+    return SpectrogramPlan(nperseg=nperseg, hop_length=hop_length, window=window.astype(np.float32),
+                           weights=weights[:num_bins].astype(np.float32), num_bins=num_bins, bands=bands,
+                           log_reference=log_reference, freqs=freqs)
+
+
+def frame_signal(audio, nperseg, hop_length):
+    # overlapping frames as a strided view, nothing is copied
+    num_frames = max((len(audio) - nperseg) // hop_length + 1, 0)
+    return as_strided(audio, shape=(num_frames, nperseg), strides=(hop_length * audio.strides[0], audio.strides[0]),
+                      writeable=False)
+
+
+@metrics.timed("spectrogram")
+def compute_spectrogram(audio, plan, sample_rate):
+    """Return (f, t, Sxx) of the plan's float32 front end, Sxx is (freq, time)."""
+    audio = np.ascontiguousarray(audio, dtype=np.float32)
+    frames = frame_signal(audio, plan.nperseg, plan.hop_length)
+    # remove each frame's mean, like scipy's constant detrend
+    frames = (frames - frames.mean(axis=1, keepdims=True)) * plan.window
+    spectrum = fft.rfft(frames, axis=1)[:, :plan.num_bins]
+    Sxx = ((spectrum.real ** 2 + spectrum.imag ** 2) * plan.weights).T
+    if plan.bands is not None:
+        Sxx = plan.bands @ Sxx
+    if plan.log_reference is not None:
+        Sxx = np.maximum(10 * np.log10(Sxx / plan.log_reference + 1e-30) + LOG_RANGE_DB, 0).astype(np.float32)
+    t = (plan.nperseg / 2 + np.arange(len(frames)) * plan.hop_length) / float(sample_rate)
+    return plan.freqs, t, np.ascontiguousarray(Sxx)
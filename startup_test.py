@@ -0,0 +1,14 @@
+import unittest
+
+from benchmark import bench_startup, STARTUP_BUDGETS_MS
+
+
+class StartupTest(unittest.TestCase):
+    # every entry point imports within its budget and without the modules only other commands need
+    def test_entry_points(self):
+        failures = bench_startup(modules=list(STARTUP_BUDGETS_MS), repeats=3)
+        self.assertEqual(failures, [], "\n".join(failures))
+
+
+if __name__ == '__main__':
+    unittest.main()
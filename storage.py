@@ -1,9 +1,46 @@
 import os.path
 import uuid
 import sqlite3
-from collections import defaultdict
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
 from contextlib import contextmanager
 
+import numpy as np
+
+import metrics
+from hash_index import is_index_path, open_index
+from shards import (is_sharded_path, catalog_path, shard_paths, split_by_shard, shard_of,
+                    DEFAULT_NUM_SHARDS)
+from matching import unique_hashes, join_matches
+from spectrogram import DEFAULT_FRONT_END, parse_front_end
+
+
+SCHEMA_VERSION = 2
+# query hashes are bound in fixed-size chunks so every lookup reuses one prepared statement
+LOOKUP_CHUNK_SIZE = 500
+LOOKUP_SQL = "SELECT hash, offset, song_id FROM hash WHERE hash IN ({})".format(
+    ",".join("?" * LOOKUP_CHUNK_SIZE))
+HASH_DF_SQL = "SELECT hash, songs, rows FROM hash_df WHERE hash IN ({})".format(",".join("?" * LOOKUP_CHUNK_SIZE))
+# spectrogram parameters kept in meta, a query has to fingerprint with the ones the hashes were built with
+SPECTROGRAM_DEFAULTS = {"front_end": DEFAULT_FRONT_END, "hop_length": None, "max_freq": None}
+SPECTROGRAM_TYPES = {"front_end": str, "hop_length": int, "max_freq": float}
+
+# pragmas for the writer connection of a bulk import, a crash during the import can leave
+# the database corrupt, rerun it from scratch
+BULK_PRAGMAS = [
+    "PRAGMA synchronous=OFF",
+    # 256 MB page cache
+    "PRAGMA cache_size=-262144",
+    "PRAGMA temp_store=MEMORY",
+    # checkpoint every ~400 MB of WAL instead of every 1000 pages
+    "PRAGMA wal_autocheckpoint=100000",
+]
+
+_connections = {}
+_shard_pools = {}
+_shard_counts = {}
+
 
 @contextmanager
 def get_cursor(db_path):
@@ -14,59 +51,531 @@ def get_cursor(db_path):
         conn.close()
 
 
-def setup_db(db_path):
-    with get_cursor(db_path=db_path) as (conn, c):
-        c.execute("CREATE TABLE IF NOT EXISTS hash (hash int, offset real, song_id text)")
-        c.execute("CREATE TABLE IF NOT EXISTS song_info (artist text, album text, title text, song_id text)")
-        # dramatically speed up recognition
-        c.execute("CREATE INDEX IF NOT EXISTS idx_hash ON hash (hash)")
-        # faster write mode that enables greater concurrency
-        # https://sqlite.org/wal.html
-        c.execute("PRAGMA journal_mode=WAL")
-        # reduce load at a checkpoint and reduce chance of a timeout
-        c.execute("PRAGMA wal_autocheckpoint=300")
+def get_connection(db_path):
+    # long-lived connection for lookups, sqlite3 connections can't be shared across processes or threads
+    key = (os.getpid(), threading.get_ident(), os.path.abspath(db_path))
+    if key not in _connections:
+        _connections[key] = sqlite3.connect(database=db_path, timeout=30)
+    return _connections[key]
+
+
+def setup_db(db_path, bulk=False, front_end=DEFAULT_FRONT_END, num_shards=None, hop_length=None, max_freq=None):
+    # bulk creates the tables without idx_hash, finish_bulk_load builds it after the import
+    parse_front_end(front_end)
+    params = dict(front_end=front_end, hop_length=hop_length, max_freq=max_freq)
+    if is_sharded_path(db_path):
+        build_df = setup_sharded_db(db_path, bulk=bulk, num_shards=num_shards, **params)
+    else:
+        with get_cursor(db_path=db_path) as (conn, c):
+            create_hash_table(c, bulk=bulk)
+            build_df = create_song_tables(c, **params)
+            conn.commit()
+    if build_df:
+        build_hash_df(db_path)
+
+
+def create_song_tables(c, front_end, hop_length=None, max_freq=None):
+    # returns True when hash_df is new on a database that already has songs
+    set_wal_mode(c)
+    c.execute("CREATE TABLE IF NOT EXISTS song_info "
+              "(song_id integer PRIMARY KEY, artist text, album text, title text, uuid text UNIQUE)")
+    c.execute("CREATE TABLE IF NOT EXISTS meta (key text PRIMARY KEY, value text)")
+    c.execute("INSERT OR IGNORE INTO meta VALUES ('schema_version', ?)", (str(SCHEMA_VERSION),))
+    check_schema(c)
+    check_spectrogram_params(c, front_end=front_end, hop_length=hop_length, max_freq=max_freq)
+    create_song_files_tables(c)
+    return create_hash_df_table(c)
+
+
+def create_song_files_tables(c):
+    # the file each song came from, so a sync only fingerprints new or changed files. size and
+    # mtime_ns stay NULL until the song's hash rows are committed, song_id is NULL for a file
+    # that gave no song. stale_songs holds removed songs whose hash rows are not deleted yet
+    c.execute("CREATE TABLE IF NOT EXISTS song_files "
+              "(path text PRIMARY KEY, size integer, mtime_ns integer, song_id integer)")
+    c.execute("CREATE TABLE IF NOT EXISTS stale_songs (song_id integer PRIMARY KEY)")
+
+
+def create_hash_df_table(c):
+    # document frequency of every hash: the number of songs that have it, and of hash rows
+    new = c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'hash_df'").fetchone() is None
+    c.execute("CREATE TABLE IF NOT EXISTS hash_df (hash integer PRIMARY KEY, songs integer, rows integer)")
+    return new and c.execute("SELECT 1 FROM song_info LIMIT 1").fetchone() is not None
+
+
+def create_hash_table(c, bulk=False):
+    # hash is a 32-bit packed fingerprint, offset is in TIME_RESOLUTION ticks and
+    # song_id is the integer key of the song in song_info
+    set_wal_mode(c)
+    c.execute("CREATE TABLE IF NOT EXISTS hash (hash integer, offset integer, song_id integer)")
+    if not bulk:
+        create_hash_index(c)
+
+
+def set_wal_mode(c):
+    # faster write mode that enables greater concurrency
+    # https://sqlite.org/wal.html
+    c.execute("PRAGMA journal_mode=WAL")
+    # reduce load at a checkpoint and reduce chance of a timeout
+    c.execute("PRAGMA wal_autocheckpoint=300")
+
+
+def setup_sharded_db(db_path, bulk=False, front_end=DEFAULT_FRONT_END, num_shards=None, hop_length=None,
+                     max_freq=None):
+    os.makedirs(db_path, exist_ok=True)
+    with get_cursor(db_path=catalog_path(db_path)) as (conn, c):
+        build_df = create_song_tables(c, front_end=front_end, hop_length=hop_length, max_freq=max_freq)
+        c.execute("INSERT OR IGNORE INTO meta VALUES ('num_shards', ?)", (str(num_shards or DEFAULT_NUM_SHARDS),))
+        stored = int(c.execute("SELECT value FROM meta WHERE key = 'num_shards'").fetchone()[0])
+        if num_shards is not None and stored != num_shards:
+            raise ValueError("Database has {} shards, not {}, change it with reshard_db.py".format(stored, num_shards))
+        conn.commit()
+    for path in shard_paths(db_path, stored):
+        with get_cursor(db_path=path) as (conn, c):
+            create_hash_table(c, bulk=bulk)
+            conn.commit()
+    return build_df
+
+
+def songs_db_path(db_path):
+    # the file that holds song_info and meta
+    return catalog_path(db_path) if is_sharded_path(db_path) else db_path
+
+
+def hash_db_paths(db_path):
+    # the files that hold the hash table
+    return shard_paths(db_path, shard_count(db_path)) if is_sharded_path(db_path) else [db_path]
+
+
+def shard_count(db_path):
+    key = os.path.abspath(db_path)
+    if key not in _shard_counts:
+        _shard_counts[key] = int(get_meta(db_path)["num_shards"])
+    return _shard_counts[key]
+
+
+def check_schema(c):
+    columns = [row[1] for row in c.execute("PRAGMA table_info(song_info)")]
+    if "uuid" not in columns:
+        raise ValueError("Database uses the old text song_id schema, convert it with migrate_db.py")
+
+
+def meta_value(key, value):
+    # None, the default, is stored as an empty string, numbers in one canonical form
+    if value is None:
+        return ""
+    return str(SPECTROGRAM_TYPES[key](value))
+
+
+def parse_meta_value(key, text):
+    return SPECTROGRAM_TYPES[key](text) if text else None
+
+
+def check_spectrogram_params(c, **params):
+    # hashes from before a parameter was stored were built with its default
+    has_hashes = c.execute("SELECT 1 FROM song_info LIMIT 1").fetchone() is not None
+    for key, value in params.items():
+        c.execute("INSERT OR IGNORE INTO meta VALUES (?, ?)",
+                  (key, meta_value(key, SPECTROGRAM_DEFAULTS[key] if has_hashes else value)))
+        stored = c.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()[0]
+        if stored != meta_value(key, value):
+            raise ValueError("Database was built with {} {}, not {}".format(key, stored or "default",
+                                                                           meta_value(key, value) or "default"))
+
+
+def get_meta(db_path):
+    if is_index_path(db_path):
+        return open_index(db_path).meta
+    # nothing stored yet for a database that isn't set up, or was set up before meta existed
+    if not os.path.exists(songs_db_path(db_path)):
+        return {}
+    with get_cursor(db_path=songs_db_path(db_path)) as (conn, c):
+        if c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'meta'").fetchone() is None:
+            return {}
+        return dict(c.execute("SELECT key, value FROM meta"))
+
+
+def get_front_end(db_path):
+    """The front end the database was built with, queries must use the same one."""
+    return get_meta(db_path).get("front_end", DEFAULT_FRONT_END)
+
+
+def get_spectrogram_params(db_path, **params):
+    """front_end, hop_length and max_freq the database was built with, for the ones params leaves None."""
+    meta = get_meta(db_path)
+    stored = {key: parse_meta_value(key, meta[key]) if key in meta else default
+              for key, default in SPECTROGRAM_DEFAULTS.items()}
+    stored.update((key, value) for key, value in params.items() if value is not None)
+    return stored
+
+
+def db_size(db_path):
+    """Bytes on disk of a database with its WAL and shared memory files, or of every file of a .shards directory."""
+    if os.path.isdir(db_path):
+        return sum(os.path.getsize(os.path.join(db_path, name)) for name in os.listdir(db_path))
+    return sum(os.path.getsize(path) for path in (db_path, db_path + "-wal", db_path + "-shm") if os.path.exists(path))
 
 
 def checkpoint_db(db_path):
-    with get_cursor(db_path=db_path) as (conn, c):
-        c.execute("PRAGMA wal_checkpoint(FULL)")
+    for path in set([songs_db_path(db_path)] + hash_db_paths(db_path)):
+        with get_cursor(db_path=path) as (conn, c):
+            c.execute("PRAGMA wal_checkpoint(FULL)")
 
 
 def song_in_db(filename, db_path):
-    with get_cursor(db_path=db_path) as (conn, c):
-        song_id = str(uuid.uuid5(uuid.NAMESPACE_OID, os.path.basename(filename)).int)
-        c.execute("SELECT * FROM song_info WHERE song_id=?", (song_id,))
+    with get_cursor(db_path=songs_db_path(db_path)) as (conn, c):
+        song_uuid = str(uuid.uuid5(uuid.NAMESPACE_OID, os.path.basename(filename)).int)
+        c.execute("SELECT song_id FROM song_info WHERE uuid=?", (song_uuid,))
         return c.fetchone() is not None
 
 
+@metrics.timed("db_write")
+def insert_song(c, hashes, song_info):
+    # hashes is a Fingerprint, or an iterable of Fingerprint batches of one song
+    # returns the new song_id, or None when there was nothing to insert
+    batches = [hashes] if hasattr(hashes, "hashes") else hashes
+    song_id = None
+    song_hashes = []
+    for batch in batches:
+        if len(batch.hashes) < 1:
+            continue
+        if song_id is None:
+            insert_info = [i if i is not None else "Unknown" for i in song_info]
+            c.execute("INSERT INTO song_info (artist, album, title, uuid) VALUES (?, ?, ?, ?)",
+                      (*insert_info, batch.song_uuid))
+            song_id = c.lastrowid
+        rows = zip(batch.hashes.tolist(), batch.offsets.tolist(), repeat(song_id))
+        c.executemany("INSERT INTO hash VALUES (?, ?, ?)", rows)
+        song_hashes.append(np.asarray(batch.hashes))
+    if song_id is not None:
+        update_hash_df(c, [np.concatenate(song_hashes)])
+    return song_id
+
+
 def store_song(hashes, song_info, db_path):
-    if len(hashes) < 1:
-        # TODO: After experiments have run, change this to raise error
-        # Probably should re-run the peaks finding with higher efficiency
-        # or maybe widen the target zone
+    if is_sharded_path(db_path):
+        batches = [hashes] if hasattr(hashes, "hashes") else list(hashes)
+        if batches:
+            fingerprint = batches[0]._replace(hashes=np.concatenate([b.hashes for b in batches]),
+                                              offsets=np.concatenate([b.offsets for b in batches]))
+            store_songs_sharded([(fingerprint, song_info)], db_path=db_path)
         return
     with get_cursor(db_path=db_path) as (conn, c):
-        c.executemany("INSERT INTO hash VALUES (?, ?, ?)", hashes)
+        if insert_song(c, hashes, song_info) is None:
+            # TODO: After experiments have run, change this to raise error
+            # Probably should re-run the peaks finding with higher efficiency
+            # or maybe widen the target zone
+            return
+        conn.commit()
+
+
+@metrics.timed("db_write")
+def insert_songs(c, songs):
+    """Insert many (Fingerprint, song_info) songs with all their hash rows in hash order.
+
+    Songs already in song_info are skipped. Returns the number of songs inserted.
+    """
+    song_ids, fingerprints = insert_song_infos(c, songs)
+    if len(fingerprints) < 1:
+        return 0
+    insert_hash_rows(c, *song_rows(song_ids, fingerprints))
+    update_hash_df(c, [f.hashes for f in fingerprints])
+    return len(song_ids)
+
+
+def insert_song_infos(c, songs):
+    # returns the song_ids and fingerprints of the songs that were not in song_info yet
+    song_ids = []
+    fingerprints = []
+    for fingerprint, song_info in songs:
+        if len(fingerprint.hashes) < 1:
+            continue
         insert_info = [i if i is not None else "Unknown" for i in song_info]
-        c.execute("INSERT INTO song_info VALUES (?, ?, ?, ?)", (*insert_info, hashes[0][2]))
+        c.execute("INSERT OR IGNORE INTO song_info (artist, album, title, uuid) VALUES (?, ?, ?, ?)",
+                  (*insert_info, fingerprint.song_uuid))
+        if c.rowcount < 1:
+            continue
+        song_ids.append(c.lastrowid)
+        fingerprints.append(fingerprint)
+    return song_ids, fingerprints
+
+
+def song_rows(song_ids, fingerprints):
+    # (hashes, offsets, song_ids) columns of every hash row of the songs
+    return (np.concatenate([f.hashes for f in fingerprints]), np.concatenate([f.offsets for f in fingerprints]),
+            np.repeat(song_ids, [len(f.hashes) for f in fingerprints]))
+
+
+def update_hash_df(c, song_hashes, removed=False):
+    """Add the hashes of newly inserted songs, one array per song, to hash_df, or take out those of removed songs."""
+    if len(song_hashes) < 1:
+        return
+    per_song = np.concatenate([np.unique(hashes) for hashes in song_hashes])
+    keys, songs = np.unique(per_song, return_counts=True)
+    rows = np.bincount(np.searchsorted(keys, np.concatenate(song_hashes)), minlength=len(keys))
+    if removed:
+        c.executemany("UPDATE hash_df SET songs = songs - ?, rows = rows - ? WHERE hash = ?",
+                      zip(songs.tolist(), rows.tolist(), keys.tolist()))
+        c.execute("DELETE FROM hash_df WHERE songs <= 0")
+        return
+    c.executemany("INSERT INTO hash_df VALUES (?, ?, ?) "
+                  "ON CONFLICT (hash) DO UPDATE SET songs = songs + excluded.songs, rows = rows + excluded.rows",
+                  zip(keys.tolist(), songs.tolist(), rows.tolist()))
+
+
+def build_hash_df(db_path):
+    # rebuild hash_df from the hash rows, for databases created before it was kept up to date
+    with get_cursor(db_path=songs_db_path(db_path)) as (conn, c):
+        c.execute("DELETE FROM hash_df")
+        for path in hash_db_paths(db_path):
+            table = "hash"
+            if path != songs_db_path(db_path):
+                # shards hold disjoint hashes, so their counts don't overlap
+                c.execute("ATTACH DATABASE ? AS shard", (path,))
+                table = "shard.hash"
+            c.execute("INSERT INTO hash_df SELECT hash, count(DISTINCT song_id), count(*) FROM {} GROUP BY hash"
+                      .format(table))
+            conn.commit()
+            if table != "hash":
+                c.execute("DETACH DATABASE shard")
+
+
+def insert_hash_rows(c, hashes, offsets, song_ids):
+    # sorted rows append to the index B-tree instead of updating it at random
+    order = np.argsort(hashes, kind="stable")
+    c.executemany("INSERT INTO hash VALUES (?, ?, ?)",
+                  zip(np.asarray(hashes)[order].tolist(), np.asarray(offsets)[order].tolist(),
+                      np.asarray(song_ids)[order].tolist()))
+
+
+@metrics.timed("db_write")
+def store_songs_sharded(songs, db_path):
+    # song_info is committed first, then every shard gets its rows
+    with get_cursor(db_path=catalog_path(db_path)) as (conn, c):
+        song_ids, fingerprints = insert_song_infos(c, songs)
+        if fingerprints:
+            update_hash_df(c, [f.hashes for f in fingerprints])
         conn.commit()
+    if len(fingerprints) < 1:
+        return 0
+    paths = hash_db_paths(db_path)
+    for path, rows in zip(paths, split_by_shard(len(paths), *song_rows(song_ids, fingerprints))):
+        if len(rows[0]) < 1:
+            continue
+        with get_cursor(db_path=path) as (conn, c):
+            insert_hash_rows(c, *rows)
+            conn.commit()
+    return len(song_ids)
 
 
-def get_matches(hashes, db_path, threshold=5):
-    h_dict = {}
-    for h, t, _ in hashes:
-        h_dict[h] = t
-    in_values = f"({','.join([str(h[0]) for h in hashes])})"
-    with get_cursor(db_path=db_path) as (conn, c):
-        c.execute(f"SELECT hash, offset, song_id FROM hash WHERE hash IN {in_values}")
-        results = c.fetchall()
-    result_dict = defaultdict(list)
-    for r in results:
-        result_dict[r[2]].append((r[1], h_dict[r[0]]))
-    return result_dict
+def begin_bulk_load(c):
+    drop_hash_index(c)
+    for pragma in BULK_PRAGMAS:
+        c.execute(pragma)
+
+
+def finish_bulk_load(c):
+    # call with no open transaction
+    create_hash_index(c)
+    c.execute("ANALYZE")
+    c.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+def known_song_uuids(db_path):
+    with get_cursor(db_path=songs_db_path(db_path)) as (conn, c):
+        return {row[0] for row in c.execute("SELECT uuid FROM song_info")}
+
+
+def song_ids_by_uuid(db_path):
+    with get_cursor(db_path=songs_db_path(db_path)) as (conn, c):
+        return dict(c.execute("SELECT uuid, song_id FROM song_info"))
+
+
+def known_song_files(db_path):
+    """Map the path of every file in song_files to its (size, mtime_ns, song_id)."""
+    with get_cursor(db_path=songs_db_path(db_path)) as (conn, c):
+        return {row[0]: row[1:] for row in c.execute("SELECT path, size, mtime_ns, song_id FROM song_files")}
+
+
+def insert_song_files(c, files):
+    # (path, size, mtime_ns, song_id) rows, a file that is already known is replaced
+    c.executemany("INSERT OR REPLACE INTO song_files VALUES (?, ?, ?, ?)", files)
+
+
+def remove_song_files(db_path, paths):
+    """Forget files and remove their songs: song_info, hash_df counts and hash rows.
+
+    The songs leave song_info and become stale in one transaction, their hash rows are
+    deleted after it, so a removal that is interrupted is finished by purge_stale_songs.
+    """
+    purge_stale_songs(db_path)
+    if len(paths) < 1:
+        return 0
+    with get_cursor(db_path=songs_db_path(db_path)) as (conn, c):
+        files = [c.execute("SELECT song_id, size FROM song_files WHERE path = ?", (path,)).fetchone() for path in paths]
+    files = [row for row in files if row is not None and row[0] is not None]
+    song_ids = sorted({song_id for song_id, _ in files})
+    # a song whose hash rows may be partly written was counted in hash_df in full
+    rebuild_df = any(size is None for _, size in files)
+    song_hashes = [] if rebuild_df else song_hash_rows(db_path, song_ids)
+    with get_cursor(db_path=songs_db_path(db_path)) as (conn, c):
+        c.executemany("INSERT OR IGNORE INTO stale_songs VALUES (?)", ((i,) for i in song_ids))
+        c.executemany("DELETE FROM song_info WHERE song_id = ?", ((i,) for i in song_ids))
+        c.executemany("DELETE FROM song_files WHERE path = ?", ((path,) for path in paths))
+        update_hash_df(c, song_hashes, removed=True)
+        conn.commit()
+    removed = purge_stale_songs(db_path)
+    if rebuild_df:
+        build_hash_df(db_path)
+    return removed
+
+
+def pick_song_ids(c, song_ids):
+    # a temp table of song_ids, so a statement over many songs is one scan of the hash table
+    c.execute("CREATE TEMP TABLE IF NOT EXISTS picked_songs (song_id integer PRIMARY KEY)")
+    c.execute("DELETE FROM picked_songs")
+    c.executemany("INSERT OR IGNORE INTO picked_songs VALUES (?)", ((i,) for i in song_ids))
+
+
+def song_hash_rows(db_path, song_ids):
+    # the hashes of every song, one array per song
+    if len(song_ids) < 1:
+        return []
+    rows = []
+    for path in hash_db_paths(db_path):
+        with get_cursor(db_path=path) as (conn, c):
+            pick_song_ids(c, song_ids)
+            rows.extend(c.execute("SELECT hash, song_id FROM hash WHERE song_id IN (SELECT song_id FROM picked_songs)"))
+    rows = np.array(rows, dtype=np.int64).reshape(-1, 2)
+    rows = rows[np.argsort(rows[:, 1], kind="stable")]
+    _, starts = np.unique(rows[:, 1], return_index=True)
+    return np.split(rows[:, 0], starts[1:]) if len(rows) else []
+
+
+def purge_stale_songs(db_path):
+    """Delete the hash rows of stale songs, before a new song can reuse their song_id. Returns how many there were."""
+    with get_cursor(db_path=songs_db_path(db_path)) as (conn, c):
+        stale = [row[0] for row in c.execute("SELECT song_id FROM stale_songs")]
+    if len(stale) < 1:
+        return 0
+    for path in hash_db_paths(db_path):
+        with get_cursor(db_path=path) as (conn, c):
+            pick_song_ids(c, stale)
+            c.execute("DELETE FROM hash WHERE song_id IN (SELECT song_id FROM picked_songs)")
+            conn.commit()
+    with get_cursor(db_path=songs_db_path(db_path)) as (conn, c):
+        c.executemany("DELETE FROM stale_songs WHERE song_id = ?", ((i,) for i in stale))
+        conn.commit()
+    return len(stale)
+
+
+def drop_hash_index(c):
+    c.execute("DROP INDEX IF EXISTS idx_hash")
+
+
+def create_hash_index(c, covering=False):
+    # dramatically speed up recognition, a covering index also holds song_id and offset so a
+    # lookup never reads the table, at the cost of a second copy of every row
+    columns = "hash, song_id, offset" if covering else "hash"
+    c.execute("CREATE INDEX IF NOT EXISTS idx_hash ON hash ({})".format(columns))
+
+
+def has_covering_index(c):
+    sql = c.execute("SELECT sql FROM sqlite_master WHERE type = 'index' AND name = 'idx_hash'").fetchone()
+    return sql is not None and "offset" in sql[0]
+
+
+@metrics.timed("db_lookup")
+def lookup_hashes(keys, db_path):
+    """Fetch the (hash, offset, song_id) rows of the unique keys as parallel arrays."""
+    if is_index_path(db_path):
+        return open_index(db_path).lookup_hashes(keys)
+    if is_sharded_path(db_path):
+        return lookup_hashes_sharded(keys, db_path=db_path)
+    return lookup_hashes_sqlite(keys, db_path=db_path)
+
+
+def lookup_hashes_sqlite(keys, db_path):
+    return lookup_rows(get_connection(db_path=db_path), keys)
+
+
+def lookup_rows(conn, keys):
+    keys = keys.tolist()
+    rows = []
+    for i in range(0, len(keys), LOOKUP_CHUNK_SIZE):
+        chunk = keys[i:i + LOOKUP_CHUNK_SIZE]
+        # pad the last chunk with its last key, duplicates in IN don't add rows
+        chunk += chunk[-1:] * (LOOKUP_CHUNK_SIZE - len(chunk))
+        rows.extend(conn.execute(LOOKUP_SQL, chunk))
+    rows = np.array(rows, dtype=np.int64).reshape(-1, 3)
+    return rows[:, 0], rows[:, 1], rows[:, 2]
+
+
+def lookup_hashes_sharded(keys, db_path):
+    """lookup_hashes on every shard a key falls in, in parallel."""
+    paths = hash_db_paths(db_path)
+    shard = shard_of(keys, len(paths))
+    parts = [(path, keys[shard == i]) for i, path in enumerate(paths)]
+    parts = [(path, shard_keys) for path, shard_keys in parts if len(shard_keys) > 0]
+    # sqlite3 releases the GIL while it runs a query, each pool thread keeps its own connections
+    key = (os.getpid(), os.path.abspath(db_path))
+    if key not in _shard_pools:
+        _shard_pools[key] = ThreadPoolExecutor(max_workers=len(paths))
+    results = list(_shard_pools[key].map(lambda part: lookup_hashes_sqlite(part[1], db_path=part[0]), parts))
+    if not results:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return tuple(np.concatenate(column) for column in zip(*results))
+
+
+def lookup_hash_df(keys, db_path):
+    """Return the (songs, rows) document frequencies of the sorted unique keys, 0 for unknown hashes.
+
+    A hash index has no hash_df, it counts the rows of each key, which bound its songs from above.
+    """
+    if is_index_path(db_path):
+        start, end = open_index(db_path).find(keys)
+        return end - start, end - start
+    conn = get_connection(db_path=songs_db_path(db_path))
+    chunks = keys.tolist()
+    found = []
+    for i in range(0, len(chunks), LOOKUP_CHUNK_SIZE):
+        chunk = chunks[i:i + LOOKUP_CHUNK_SIZE]
+        chunk += chunk[-1:] * (LOOKUP_CHUNK_SIZE - len(chunk))
+        found.extend(conn.execute(HASH_DF_SQL, chunk))
+    found = np.array(found, dtype=np.int64).reshape(-1, 3)
+    songs = np.zeros(len(keys), dtype=np.int64)
+    rows = np.zeros(len(keys), dtype=np.int64)
+    position = np.searchsorted(keys, found[:, 0])
+    songs[position] = found[:, 1]
+    rows[position] = found[:, 2]
+    return songs, rows
+
+
+def drop_stop_hashes(keys, db_path, max_df, stats=None):
+    """Drop the stop-word keys, hashes found in more than max_df songs, before any row is fetched.
+
+    stats, if given, counts the dropped hashes in "stop_hashes" and the rows they would
+    have fetched in "rows_skipped".
+    """
+    songs, rows = lookup_hash_df(keys, db_path=db_path)
+    stop = songs > max_df
+    if stats is not None:
+        stats["stop_hashes"] = stats.get("stop_hashes", 0) + int(stop.sum())
+        stats["rows_skipped"] = stats.get("rows_skipped", 0) + int(rows[stop].sum())
+    return keys[~stop]
+
+
+def get_matches(hashes, db_path, threshold=5, max_df=None, stats=None):
+    keys = unique_hashes(hashes)
+    if max_df is not None:
+        keys = drop_stop_hashes(keys, db_path=db_path, max_df=max_df, stats=stats)
+    row_hashes, row_offsets, row_song_ids = lookup_hashes(keys, db_path=db_path)
+    metrics.count("candidate_rows", len(row_hashes))
+    return join_matches(hashes, row_hashes, row_offsets, row_song_ids)
 
 
 def get_info_for_song_id(song_id, db_path):
-    with get_cursor(db_path=db_path) as (conn, c):
-        c.execute("SELECT artist, album, title FROM song_info WHERE song_id = ?", (song_id,))
-        return c.fetchone()
+    if is_index_path(db_path):
+        return open_index(db_path).get_info_for_song_id(song_id)
+    conn = get_connection(db_path=songs_db_path(db_path))
+    return conn.execute("SELECT artist, album, title FROM song_info WHERE song_id = ?", (song_id,)).fetchone()
@@ -0,0 +1,40 @@
+import os
+import wave
+import tempfile
+import unittest
+
+import numpy as np
+
+from fingerprint import fingerprint_file, fingerprint_file_stream
+from synthetic_corpus import make_song
+from benchmark import SUITE_PARAMS
+
+
+def sorted_pairs(hashes, offsets):
+    order = np.lexsort((hashes, offsets))
+    return list(zip(offsets[order].tolist(), hashes[order].tolist()))
+
+
+class StreamingTest(unittest.TestCase):
+    # a resampled stereo file decoded in several blocks and hashed in several batches
+    def test_stream_matches_whole_file(self):
+        rng = np.random.default_rng(0)
+        left, right = (make_song("tones", rng, 75.0, 22050) for _ in range(2))
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "stereo.wav")
+            with wave.open(path, "wb") as wf:
+                wf.setnchannels(2)
+                wf.setsampwidth(2)
+                wf.setframerate(22050)
+                wf.writeframes(np.stack([left, right], axis=1).astype("<i2").tobytes())
+            whole = fingerprint_file(path, **SUITE_PARAMS)
+            batches = list(fingerprint_file_stream(path, batch_size=200, **SUITE_PARAMS))
+        self.assertGreater(len(batches), 1)
+        # the same (hash, offset) pairs, streaming yields them in time order
+        self.assertEqual(sorted_pairs(np.concatenate([b.hashes for b in batches]),
+                                      np.concatenate([b.offsets for b in batches])),
+                         sorted_pairs(whole.hashes, whole.offsets))
+
+
+if __name__ == '__main__':
+    unittest.main()
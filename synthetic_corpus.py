@@ -0,0 +1,144 @@
+import os
+import json
+import wave
+import argparse
+
+import numpy as np
+
+# Reproducible test audio, no network or music files needed: "songs" are tone mixtures
+# or noise shaped by a moving spectral envelope, and queries are crops of them, with
+# noise added or the gain shifted. The same seed always gives the same files.
+SONG_KINDS = ["tones", "shaped_noise"]
+QUERY_KINDS = ["crop", "noise", "gain"]
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--out_dir", type=str, default="synthetic_corpus")
+    parser.add_argument("--num_songs", type=int, default=20)
+    parser.add_argument("--song_seconds", type=float, default=30.0)
+    parser.add_argument("--queries_per_song", type=int, default=1)
+    parser.add_argument("--query_seconds", type=float, default=8.0)
+    # signal to noise ratio of noise queries
+    parser.add_argument("--snr_db", type=float, default=5.0)
+    # gain of gain queries, clipped at full scale
+    parser.add_argument("--gain_db", type=float, default=-12.0)
+    parser.add_argument("--sample_rate", type=int, default=44100)
+    parser.add_argument("--seed", type=int, default=0)
+
+    args = parser.parse_args()
+
+    return args
+
+
+def tone_song(rng, seconds, sample_rate):
+    # a sequence of notes, each a chord of a few partials with a short fade in and out
+    num_samples = int(seconds * sample_rate)
+    audio = np.zeros(num_samples)
+    start = 0
+    while start < num_samples:
+        length = min(int(rng.uniform(0.15, 0.6) * sample_rate), num_samples - start)
+        t = np.arange(length) / sample_rate
+        note = np.zeros(length)
+        for freq in rng.uniform(100.0, 5000.0, rng.integers(2, 5)):
+            note += rng.uniform(0.2, 1.0) * np.sin(2 * np.pi * freq * t + rng.uniform(0, 2 * np.pi))
+        fade = min(length // 2, int(0.01 * sample_rate))
+        if fade > 0:
+            ramp = np.linspace(0.0, 1.0, fade)
+            note[:fade] *= ramp
+            note[length - fade:] *= ramp[::-1]
+        audio[start:start + length] = note
+        start += length
+    return audio + 0.01 * rng.standard_normal(num_samples)
+
+
+def shaped_noise_song(rng, seconds, sample_rate, segment_seconds=0.25):
+    # white noise filtered segment by segment with a random smooth envelope and a few sharp resonances
+    num_samples = int(seconds * sample_rate)
+    segment = int(segment_seconds * sample_rate)
+    audio = np.zeros(num_samples)
+    freqs = np.fft.rfftfreq(segment, 1.0 / sample_rate)
+    for start in range(0, num_samples, segment):
+        spectrum = np.fft.rfft(rng.standard_normal(segment))
+        envelope = np.interp(freqs, np.linspace(0, freqs[-1], 8), rng.uniform(0.05, 1.0, 8))
+        for center in rng.uniform(200.0, 6000.0, rng.integers(2, 6)):
+            envelope += rng.uniform(5.0, 20.0) * np.exp(-0.5 * ((freqs - center) / 15.0) ** 2)
+        audio[start:start + segment] = np.fft.irfft(spectrum * envelope, n=segment)[:num_samples - start]
+    return audio
+
+
+def to_pcm(audio, peak=0.8):
+    # scale to 16-bit with the peak at peak of full scale
+    return np.round(audio / max(np.abs(audio).max(), 1e-12) * peak * 32767).astype(np.int16)
+
+
+def make_song(kind, rng, seconds, sample_rate):
+    if kind == "tones":
+        return to_pcm(tone_song(rng, seconds, sample_rate))
+    if kind == "shaped_noise":
+        return to_pcm(shaped_noise_song(rng, seconds, sample_rate))
+    raise ValueError("Unknown song kind {!r}, expected one of {}".format(kind, SONG_KINDS))
+
+
+def make_query(song, kind, rng, seconds, sample_rate, snr_db=5.0, gain_db=-12.0):
+    """Crop a random part of a song and degrade it, returns (samples, start in seconds)."""
+    length = min(int(seconds * sample_rate), len(song))
+    start = int(rng.integers(0, len(song) - length + 1))
+    query = song[start:start + length].astype(np.float64)
+    if kind == "noise":
+        noise = rng.standard_normal(length)
+        query += noise * np.sqrt(np.mean(query ** 2) / 10 ** (snr_db / 10.0))
+    elif kind == "gain":
+        query *= 10 ** (gain_db / 20.0)
+    elif kind != "crop":
+        raise ValueError("Unknown query kind {!r}, expected one of {}".format(kind, QUERY_KINDS))
+    return np.clip(np.round(query), -32768, 32767).astype(np.int16), start / sample_rate
+
+
+def write_wav(path, samples, sample_rate):
+    with wave.open(path, "wb") as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(sample_rate)
+        wf.writeframes(samples.astype("<i2").tobytes())
+
+
+def generate_corpus(out_dir, num_songs, song_seconds, queries_per_song, query_seconds, sample_rate=44100,
+                    snr_db=5.0, gain_db=-12.0, seed=0):
+    """Write songs/ and queries/ WAV files and return the manifest of queries, also saved as manifest.json.
+
+    Every manifest entry has the query file, the song file it was cut from, its kind and
+    where it starts in the song.
+    """
+    songs_dir = os.path.join(out_dir, "songs")
+    queries_dir = os.path.join(out_dir, "queries")
+    os.makedirs(songs_dir, exist_ok=True)
+    os.makedirs(queries_dir, exist_ok=True)
+    manifest = []
+    for i in range(num_songs):
+        # one generator per song, so a song doesn't change when num_songs does
+        rng = np.random.default_rng([seed, i])
+        kind = SONG_KINDS[i % len(SONG_KINDS)]
+        song = make_song(kind, rng, song_seconds, sample_rate)
+        song_path = os.path.join(songs_dir, "song{:04d}_{}.wav".format(i, kind))
+        write_wav(song_path, song, sample_rate)
+        for query_kind in QUERY_KINDS:
+            for j in range(queries_per_song):
+                query, start = make_query(song, query_kind, rng, query_seconds, sample_rate, snr_db=snr_db,
+                                          gain_db=gain_db)
+                query_path = os.path.join(queries_dir, "query{:04d}_{}_{}.wav".format(i, query_kind, j))
+                write_wav(query_path, query, sample_rate)
+                manifest.append({"query": query_path, "song": song_path, "kind": query_kind, "start": start})
+    with open(os.path.join(out_dir, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+
+if __name__ == '__main__':
+    args = get_args()
+
+    manifest = generate_corpus(out_dir=args.out_dir, num_songs=args.num_songs, song_seconds=args.song_seconds,
+                               queries_per_song=args.queries_per_song, query_seconds=args.query_seconds,
+                               sample_rate=args.sample_rate, snr_db=args.snr_db, gain_db=args.gain_db, seed=args.seed)
+    print("Wrote {} songs and {} queries to {}".format(args.num_songs, len(manifest), args.out_dir))
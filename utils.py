@@ -1,32 +0,0 @@
-import cProfile
-import io
-import pstats
-import time
-from functools import wraps
-
-
-def timethis(func):
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        start = time.time()
-        result = func(*args, **kwargs)
-        end = time.time()
-        print("Time execution of module {} function {} is {} seconds".format(func.__module__, func.__name__, end - start))
-        return result
-    return wrapper
-
-
-def profile(func):
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        pr = cProfile.Profile()
-        pr.enable()
-        result = func(*args, **kwargs)
-        pr.disable()
-        s = io.StringIO()
-        sortby = "cumulative"
-        ps = pstats.Stats(pr, stream=s).sort_stats(sortby)
-        ps.print_stats()
-        print(s.getvalue())
-        return result
-    return wrapper